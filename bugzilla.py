@@ -18,16 +18,18 @@
 # This document is not confidential.
 
 import catalog
+import lru
 import os
 import re
 import string
+import time
 import types
 
 error = 'Bugzilla database error'
 
 class bugzilla:
 
-    schema_version = '5'
+    schema_version = '6'
     # particular Bugzilla features.  Maybe should have a 'feature'
     # dictionary.
     features = {}
@@ -40,6 +42,11 @@ class bugzilla:
     logger = None
     bugmail_commands = None
     cache = None
+    mysql_version = None
+
+    # Metrics object in which to record statistics, or None (see
+    # metrics.py).
+    metrics = None
 
     # 2. BUGZILLA INTERFACE
 
@@ -53,9 +60,21 @@ class bugzilla:
         self.sid = config.sid
         self.bugzilla_directory = config.bugzilla_directory
         self.bugmail_command = config.bugmail_command
+        self.change_queue = config.bugzilla_change_queue
+        self.transactions = config.bugzilla_transactions
+        self.longdesc_cache = lru.lru_cache(self.longdesc_cache_size)
         self.check_mysql_version()
         self.check_bugzilla_version()
         self.update_p4dti_schema()
+        self.update_change_queue_triggers()
+        if self.transactions:
+            self.check_transactional_tables()
+            self.execute("set autocommit = 1;")
+
+        # Tell the change queue triggers that changes made on this
+        # connection are made by a replicator; see section 10.9.
+        self.execute("set @p4dti_replicator = %s;"
+                     % self.quote_string(self.rid))
 
         # Make a configuration dictionary and pass it to set_config to
         # ensure that the copy of the configuration in the Bugzilla
@@ -82,6 +101,15 @@ class bugzilla:
         msg = catalog.msg(id, args)
         self.logger.log(msg)
 
+    # log_deferred(id, args_function) is like log(), but the message
+    # arguments are only computed (by calling args_function) if the
+    # message is going to be logged.  Use it for debugging messages
+    # whose arguments are expensive to compute.
+
+    def log_deferred(self, id, args_function):
+        if self.logger.logs(catalog.priority(id)):
+            self.logger.log(catalog.deferred_msg(id, args_function))
+
 
     # 3. DATABASE INTERFACE
     #
@@ -103,11 +131,17 @@ class bugzilla:
     def execute(self, sql, params=None):
         assert isinstance(sql, basestring)
         # "Executing SQL command '%s'."
-        self.log(100, repr((sql, params)))
+        self.log_deferred(100, lambda: repr((sql, params)))
+        start = time.time()
         self.cursor.execute(sql, params)
         rows = self.cursor.rowcount
+        if self.metrics:
+            self.metrics.observe('sql_statement_seconds',
+                                 time.time() - start,
+                                 (('statement',
+                                   string.lower(string.split(sql)[0])),))
         # "MySQL returned '%s'."
-        self.log(101, repr(rows))
+        self.log_deferred(101, lambda: repr(rows))
         return rows
 
     # fetchone() fetches one row from the current result set and returns
@@ -116,7 +150,7 @@ class bugzilla:
     def fetchone(self):
         row = self.cursor.fetchone()
         # "fetchone() returned '%s'."
-        self.log(102, repr(row))
+        self.log_deferred(102, lambda: repr(row))
         return row
 
     # fetchall() fetches all the rows from the current result and
@@ -125,7 +159,7 @@ class bugzilla:
     def fetchall(self):
         rows = self.cursor.fetchall()
         # "fetchall() returned '%s'."
-        self.log(103, repr(rows))
+        self.log_deferred(103, lambda: repr(rows))
         return rows
 
 
@@ -847,6 +881,7 @@ class bugzilla:
             "MySQL version string")
         if version_row:
             mysql_version_string = version_row[1]
+            self.mysql_version = mysql_version_string
             for (pattern, fn) in self.mysql_version_patterns:
                 if re.match(pattern, mysql_version_string):
                     fn(self, mysql_version_string)
@@ -935,6 +970,7 @@ class bugzilla:
          "    sid varchar(32) not null, "
          "    jobname text not null, "
          "    migrated datetime, "
+         "    digest varchar(32), "
          "    index(bug_id) "
          "  );"),
 
@@ -997,6 +1033,14 @@ class bugzilla:
          "    index(rid, sid)"
          "  );"),
 
+        ('p4dti_change_queue',
+         "create table p4dti_change_queue "
+         "  ( seq int not null auto_increment primary key, "
+         "    bug_id mediumint not null, "
+         "    queued datetime not null, "
+         "    index(queued) "
+         "  );"),
+
         ('p4dti_replications',
          "create table p4dti_replications "
          "  ( rid varchar(32) not null, "
@@ -1040,6 +1084,10 @@ class bugzilla:
                     '  add completed int not null default 0',
                     'update p4dti_replications'
                     '  set completed=1 where end >= start']),
+        # Schema version 6 records the digest of each bug as last
+        # replicated; see replicator.issue_digest.
+        '5': ('6', ['alter table p4dti_bugs'
+                    '  add digest varchar(32)']),
         }
 
     schema_config = {
@@ -1049,10 +1097,57 @@ class bugzilla:
         'sid': '',
         }
 
+    # p4dti_indexes is a list of triples (table, index name, columns)
+    # giving indexes that the P4DTI's queries rely on (see
+    # changed_bugs_query).  Some are on the P4DTI schema extensions and
+    # some on Bugzilla's own tables.  add_p4dti_indexes adds any that
+    # are missing.
+
+    p4dti_indexes = [
+        ('p4dti_bugs_activity', 'p4dti_activity_idx',
+         ['bug_id', 'bug_when', 'who', 'fieldid']),
+        ('p4dti_bugs', 'p4dti_rid_sid_idx', ['rid', 'sid']),
+        ('bugs_activity', 'p4dti_bug_when_idx', ['bug_when']),
+        ]
+
     # update_p4dti_schema() ensures that the P4DTI schema extensions are
-    # present in the Bugzilla database and up to date.
+    # present in the Bugzilla database and up to date, that the indexes
+    # the P4DTI relies on are present, and logs the plan for the main
+    # polling query.
 
     def update_p4dti_schema(self):
+        self.upgrade_p4dti_schema()
+        self.add_p4dti_indexes()
+        self.check_changed_bugs_query()
+
+    # add_p4dti_indexes() adds the indexes in p4dti_indexes, unless
+    # the table already has an index whose leading columns are the
+    # same.
+
+    def add_p4dti_indexes(self):
+        for table, name, columns in self.p4dti_indexes:
+            indexes = {}
+            for i in self.fetch_rows_as_list_of_dictionaries(
+                "show index from %s" % table,
+                "Getting indexes for the %s table." % table):
+                indexes.setdefault(i['Key_name'], []).append(
+                    (int(i['Seq_in_index']), i['Column_name']))
+            found = 0
+            for index in indexes.values():
+                index.sort()
+                if map(lambda c: c[1], index[:len(columns)]) == columns:
+                    found = 1
+                    break
+            if not found:
+                # "Adding index '%s' on columns %s of table '%s'."
+                self.log(144, (name, string.join(columns, ', '), table))
+                self.execute("alter table %s add index %s (%s)"
+                             % (table, name, string.join(columns, ', ')))
+
+    # upgrade_p4dti_schema() creates any missing P4DTI tables and
+    # upgrades the tables from an old schema version.
+
+    def upgrade_p4dti_schema(self):
         # Create missing tables.
         up_to_date = 0
         for table, sql in self.p4dti_schema_extensions:
@@ -1172,16 +1267,79 @@ class bugzilla:
             bug = self.fetch_one_row_as_dictionary(
                 "select * from bugs where bug_id = %d;" % bug_id,
                 "bug id %d" % bug_id)
-            if self.features.has_key('normalized tables'):
-                bug['product'] = self.product_name_from_id(bug['product_id'])
-                bug['component'] = self.component_name_from_id(bug['component_id'])
-                del bug['product_id']
-                del bug['component_id']
+            self.normalize_bug(bug)
             bug['groups'] = self.bug_groups(bug)
-            bug['longdesc'] = self.bug_get_longdesc(bug)
+            if self.load_longdesc:
+                bug['longdesc'] = self.bug_get_longdesc(bug)
             self.cache[('bugs', bug_id)] = bug
         return self.cache[('bugs', bug_id)]
 
+    def normalize_bug(self, bug):
+        if self.features.has_key('normalized tables'):
+            bug['product'] = self.product_name_from_id(bug['product_id'])
+            bug['component'] = self.component_name_from_id(bug['component_id'])
+            del bug['product_id']
+            del bug['component_id']
+
+    # bugs_from_bug_ids(bug_ids).  Return a list of the bugs with the
+    # given ids, like map(self.bug_from_bug_id, bug_ids), but fetch the
+    # bugs that aren't in the cache in a fixed number of queries per
+    # bug_id_chunk_size bugs, rather than several queries per bug.
+    # The bugs' groups and p4dti_bugs records are cached too (see
+    # bug_groups and bug_p4dti_bug).
+
+    bug_id_chunk_size = 500
+
+    def bugs_from_bug_ids(self, bug_ids):
+        wanted = []
+        seen = {}
+        for bug_id in bug_ids:
+            if not (seen.has_key(bug_id)
+                    or self.cache.has_key(('bugs', bug_id))):
+                wanted.append(bug_id)
+                seen[bug_id] = 1
+        for i in range(0, len(wanted), self.bug_id_chunk_size):
+            self.fetch_bugs(wanted[i:i + self.bug_id_chunk_size])
+        return map(self.bug_from_bug_id, bug_ids)
+
+    def fetch_bugs(self, bug_ids):
+        ids = string.join(map(lambda b: str(int(b)), bug_ids), ',')
+        bugs = self.fetch_rows_as_list_of_dictionaries(
+            "select * from bugs where bug_id in (%s);" % ids,
+            "%d bugs" % len(bug_ids))
+        groups = {}
+        p4dti_bugs = {}
+        for bug in bugs:
+            groups[bug['bug_id']] = []
+            p4dti_bugs[bug['bug_id']] = None
+        if not self.features.has_key('bitset groups'):
+            for bug_id, name in self.fetch_rows_as_list_of_sequences(
+                "select bug_group_map.bug_id, groups.name"
+                "  from groups, bug_group_map"
+                " where groups.id = bug_group_map.group_id"
+                "   and bug_group_map.bug_id in (%s)" % ids,
+                "groups for %d bugs" % len(bug_ids)):
+                groups[bug_id].append(name)
+        if self.load_longdesc:
+            longdescs = self.fetch_longdescs(map(lambda bug: bug['bug_id'],
+                                                 bugs))
+        for p4dti_bug in self.fetch_rows_as_list_of_dictionaries(
+            "select * from p4dti_bugs where bug_id in (%s)" % ids,
+            "p4dti_bugs for %d bugs" % len(bug_ids)):
+            p4dti_bugs[p4dti_bug['bug_id']] = p4dti_bug
+        for bug in bugs:
+            bug_id = bug['bug_id']
+            self.normalize_bug(bug)
+            if self.features.has_key('bitset groups'):
+                bug['groups'] = self.groupset_groups(bug['groupset'])
+            else:
+                bug['groups'] = groups[bug_id]
+            self.cache[('bug_groups', bug_id)] = bug['groups']
+            if self.load_longdesc:
+                bug['longdesc'] = longdescs[bug_id]
+            self.cache[('bugs', bug_id)] = bug
+            self.cache[('p4dti_bugs', bug_id)] = p4dti_bugs[bug_id]
+
     def all_bugs_since(self, date):
         # Find all bugs replicated by this replicator, and all
         # unreplicated bugs new, touched, or changed since the given
@@ -1200,43 +1358,55 @@ class bugzilla:
               self.quote_string(self.rid),
               self.quote_string(self.sid))),
             "all bugs since '%s'" % date)
-        return map(self.bug_from_bug_id, map(lambda b: b[0], bug_ids))
+        return self.bugs_from_bug_ids(map(lambda b: b[0], bug_ids))
 
     def changed_bugs_since(self, date):
-        # Find bugs new, touched, or changed (by someone other than
-        # this replicator) since the given date, which are not
-        # being replicated by any other replicator.
-
-        # We exclude changes which have the same timestamp as the
-        # current replication; they will get picked up by the next
-        # replication. This avoids these changes being replicated by
-        # two consecutive replications (which causes an overwrite).
-        # See job000235.  NB 2001-03-01.  However, it causes
-        # job000337.
+        date = self.changes_window_start(date)
+        bug_ids = self.fetch_rows_as_list_of_sequences(
+            self.changed_bugs_query(date, self.replication),
+            "changed bugs since '%s'" % date)
+        return self.bugs_from_bug_ids(map(lambda b: b[0], bug_ids))
 
-        # We do this by combining the results of three SELECTs.
-        # These results are disjoint.  We could almost certainly
-        # do it in a smaller number of SELECTs.
+    # changed_bugs_query(date, replication).  Return an SQL query
+    # which finds bugs new, touched, or changed (by someone other than
+    # this replicator) since the given date, which are not being
+    # replicated by any other replicator.
+    #
+    # We exclude changes which have the same timestamp as the current
+    # replication; they will get picked up by the next replication.
+    # This avoids these changes being replicated by two consecutive
+    # replications (which causes an overwrite).  See job000235.  NB
+    # 2001-03-01.  However, it causes job000337.
+    #
+    # The query is the union of three SELECTs, whose results are
+    # disjoint.  We run them as one query to save round trips.  Each
+    # SELECT refers to the tables by different aliases, because MySQL
+    # won't let a query refer to a locked table twice by the same name
+    # (see tables_to_lock).  The SELECTs depend on the indexes in
+    # p4dti_indexes; see check_changed_bugs_query.
+
+    def changed_bugs_query(self, date, replication):
+        date = self.quote_string(date)
+        replication = self.quote_string(replication)
+        rid = self.quote_string(self.rid)
+        sid = self.quote_string(self.sid)
 
         # First, bugs which have been created since the date (but not
         # by migration by me from a new Perforce job), which are not
         # being replicated by any other replicator.
 
-        new_ids = self.fetch_rows_as_list_of_sequences(
-            ("select bugs.bug_id from bugs "
-             "  left join p4dti_bugs using (bug_id) " # what replication
-             "  where bugs.creation_ts >= %s "        # recent timestamp
-             "    and bugs.creation_ts < %s "         # NOT just now
-             "    and (p4dti_bugs.rid is null "       # NOT replicated
-             "         or (p4dti_bugs.rid = %s "      # or replicated by me.
-             "             and p4dti_bugs.sid = %s "
-             "             and p4dti_bugs.migrated is null))" %
-                                                      # but not migrated by me.
-             (self.quote_string(date),
-              self.quote_string(self.replication),
-              self.quote_string(self.rid),
-              self.quote_string(self.sid))),
-            "new bugs since '%s'" % date)
+        new_bugs = (
+            "select nb.bug_id from bugs nb "
+            "  left join p4dti_bugs np "            # what replication
+            "    on (nb.bug_id = np.bug_id) "
+            "  where nb.creation_ts >= %s "         # recent timestamp
+            "    and nb.creation_ts < %s "          # NOT just now
+            "    and (np.rid is null "              # NOT replicated
+            "         or (np.rid = %s "             # or replicated by me.
+            "             and np.sid = %s "
+            "             and np.migrated is null))"
+                                                    # but not migrated by me.
+            % (date, replication, rid, sid))
 
         # Next, bugs which are not new but have been touched since the
         # date, but not changed, (no matching rows in bugs_activity),
@@ -1245,69 +1415,81 @@ class bugzilla:
         # Note that we have to specifically exclude bugs which we have
         # just migrated, as the migration might set creation_ts.
 
-        touched_ids = self.fetch_rows_as_list_of_sequences(
-            ("select bugs.bug_id from bugs "
-             "  left join p4dti_bugs using (bug_id) " # what replication
-             "  left join bugs_activity "             # what activity
-             "    on (bugs_activity.bug_when >= %s and " # since 'date'
-             "        bugs_activity.bug_when < %s and " # and NOT just now
-             "        bugs.bug_id = bugs_activity.bug_id) " # on this bug
-             "  where bugs.delta_ts >= %s "           # since 'date'
-             "    and bugs.delta_ts < %s "            # NOT just now
-             "    and creation_ts < %s "              # NOT brand new
-             "    and bugs_activity.fieldid is null"  # NO recent activity
-             "    and (p4dti_bugs.rid is null "       # NOT replicated
-             "         or (p4dti_bugs.rid = %s "      # or replicated by me.
-             "             and p4dti_bugs.sid = %s)) "
-             "    and (p4dti_bugs.migrated is null "  # NOT migrated lately
-             "         or p4dti_bugs.migrated < %s) " %
-             (self.quote_string(date),
-              self.quote_string(self.replication),
-              self.quote_string(date),
-              self.quote_string(self.replication),
-              self.quote_string(date),
-              self.quote_string(self.rid),
-              self.quote_string(self.sid),
-              self.quote_string(date))),
-            "bugs touched since '%s'" % date)
+        touched_bugs = (
+            "select tb.bug_id from bugs tb "
+            "  left join p4dti_bugs tp "            # what replication
+            "    on (tb.bug_id = tp.bug_id) "
+            "  left join bugs_activity ta "         # what activity
+            "    on (ta.bug_when >= %s and "        # since 'date'
+            "        ta.bug_when < %s and "         # and NOT just now
+            "        tb.bug_id = ta.bug_id) "       # on this bug
+            "  where tb.delta_ts >= %s "            # since 'date'
+            "    and tb.delta_ts < %s "             # NOT just now
+            "    and tb.creation_ts < %s "          # NOT brand new
+            "    and ta.fieldid is null"            # NO recent activity
+            "    and (tp.rid is null "              # NOT replicated
+            "         or (tp.rid = %s "             # or replicated by me.
+            "             and tp.sid = %s)) "
+            "    and (tp.migrated is null "         # NOT migrated lately
+            "         or tp.migrated < %s) "
+            % (date, replication, date, replication, date,
+               rid, sid, date))
 
         # Next, bugs which have been changed since the date, by
         # someone other than me, which are not being replicated by
         # any other replicator.
 
-        changed_ids = self.fetch_rows_as_list_of_sequences(
-            ("select bugs.bug_id from bugs, bugs_activity ba "  # bug activity
-             "left join p4dti_bugs using (bug_id) "        # what replication
-             "left join p4dti_bugs_activity pba "   # what replication activity
-             "  on (ba.bug_id = pba.bug_id and "    # by me
-             "      ba.bug_when = pba.bug_when and "
-             "      ba.who = pba.who and "
-             "      ba.fieldid = pba.fieldid and "
-             "      ba.removed = pba.oldvalue and "
-             "      ba.added = pba.newvalue and "
-             "      pba.rid = %s and "
-             "      pba.sid = %s) "
-             "  where ba.bug_when >= %s "        # recent bug activity
-             "    and ba.bug_when < %s "         # but not too recent
-             "    and bugs.bug_id = ba.bug_id "  # on this bug
-             "    and pba.rid is null "          # NO recent activity by me
-             "    and (p4dti_bugs.rid is null "  # NOT replicated
-             "         or (p4dti_bugs.rid = %s " # or replicated by me
-             "             and p4dti_bugs.sid =  %s))"
-             "    and (bugs.creation_ts < %s or " # NOT new, or newly
-             "         p4dti_bugs.migrated is not null) " # migrated
-             "  group by bugs.bug_id " %         # each bug only once
-             (self.quote_string(self.rid),
-              self.quote_string(self.sid),
-              self.quote_string(date),
-              self.quote_string(self.replication),
-              self.quote_string(self.rid),
-              self.quote_string(self.sid),
-              self.quote_string(date))),
-            "changed bugs since '%s'" % date)
-
-        bug_ids = new_ids + touched_ids + changed_ids
-        return map(self.bug_from_bug_id, map(lambda b: b[0], bug_ids))
+        changed_bugs = (
+            "select cb.bug_id from bugs cb, bugs_activity ba " # bug activity
+            "  left join p4dti_bugs cp "            # what replication
+            "    on (ba.bug_id = cp.bug_id) "
+            "  left join p4dti_bugs_activity pba "  # what replication activity
+            "    on (ba.bug_id = pba.bug_id and "   # by me
+            "        ba.bug_when = pba.bug_when and "
+            "        ba.who = pba.who and "
+            "        ba.fieldid = pba.fieldid and "
+            "        ba.removed = pba.oldvalue and "
+            "        ba.added = pba.newvalue and "
+            "        pba.rid = %s and "
+            "        pba.sid = %s) "
+            "  where ba.bug_when >= %s "            # recent bug activity
+            "    and ba.bug_when < %s "             # but not too recent
+            "    and cb.bug_id = ba.bug_id "        # on this bug
+            "    and pba.rid is null "              # NO recent activity by me
+            "    and (cp.rid is null "              # NOT replicated
+            "         or (cp.rid = %s "             # or replicated by me
+            "             and cp.sid =  %s))"
+            "    and (cb.creation_ts < %s or "      # NOT new, or newly
+            "         cp.migrated is not null) "    # migrated
+            "  group by cb.bug_id "                 # each bug only once
+            % (rid, sid, date, replication, rid, sid, date))
+
+        return ("(%s) union all (%s) union all (%s)"
+                % (new_bugs, touched_bugs, changed_bugs))
+
+    # check_changed_bugs_query().  Ask MySQL how it will run the query
+    # made by changed_bugs_query, log the plan, and warn if it will
+    # scan the whole of any large table (this suggests that an index
+    # is missing; see p4dti_indexes).
+
+    changed_bugs_scan_threshold = 1000
+
+    def check_changed_bugs_query(self):
+        now = self.now()
+        plan = self.fetch_rows_as_list_of_dictionaries(
+            "explain " + self.changed_bugs_query(now, now),
+            "query plan for changed bugs")
+        for step in plan:
+            # "Query plan for changed bugs: table '%s', access type
+            # '%s', key '%s', rows %s."
+            self.log(142, (step.get('table'), step.get('type'),
+                           step.get('key'), step.get('rows')))
+            if (step.get('type') == 'ALL'
+                and step.get('rows') > self.changed_bugs_scan_threshold):
+                # "The query for changed bugs scans all %s rows of
+                # table '%s'; polling may be slow.  Is an index
+                # missing?"
+                self.log(143, (step.get('rows'), step.get('table')))
 
     def add_bug(self, bug):
         longdesc = bug['longdesc']
@@ -1319,7 +1501,8 @@ class bugzilla:
                 bug['product_id'] = self.product_id_from_name(bug['product'])
                 del bug['product']
             if bug.has_key('component'):
-                bug['component_id'] = self.component_id_from_name(bug['component'])
+                bug['component_id'] = self.component_id_from_name(
+                    bug['component'], bug.get('product_id'))
                 del bug['component']
         if self.features.has_key('bitset groups'):
             bug['groupset'] = self.groups_groupset(bug['groups'])
@@ -1357,7 +1540,12 @@ class bugzilla:
                     changes['product_id'] = self.product_id_from_name(changes['product'])
                     del changes['product']
                 if changes.has_key('component'):
-                    changes['component_id'] = self.component_id_from_name(changes['component'])
+                    product_id = changes.get('product_id')
+                    if (product_id == None
+                        and self.products().has_key(bug.get('product'))):
+                        product_id = self.product_id_from_name(bug['product'])
+                    changes['component_id'] = self.component_id_from_name(
+                        changes['component'], product_id)
                     del bug['component']
             # if we wanted to update delta_ts, this is where
             # we would do it.  job000484.
@@ -1393,8 +1581,11 @@ class bugzilla:
         for (table, column) in column_names.items():
             if table in tables:
                 self.delete_rows(table, '%s = %d' % (column, bug_id))
-        if self.cache.has_key(('bugs', bug_id)):
-            del self.cache[('bugs', bug_id)]
+        self.longdesc_cache.remove(bug_id)
+        for key in [('bugs', bug_id), ('bug_groups', bug_id),
+                    ('p4dti_bugs', bug_id)]:
+            if self.cache.has_key(key):
+                del self.cache[key]
 
 
     # 9.2. Table "bugs_activity"
@@ -1477,10 +1668,25 @@ class bugzilla:
     def component_name_from_id(self, component_id):
         return self.components()[component_id]['name']
 
-    def component_id_from_name(self, component_name):
-        for c in self.components().values():
-            if c['name'] == component_name:
-                return c['id']
+    # components_by_name() returns a dictionary mapping (product id,
+    # component name) to component id.  It also maps (None, component
+    # name) to the id of one of the components with that name, for
+    # when we don't know the product.
+
+    def components_by_name(self):
+        if not self.cache.has_key('components_by_name'):
+            index = {}
+            for c in self.components().values():
+                index[(c['product_id'], c['name'])] = c['id']
+                index.setdefault((None, c['name']), c['id'])
+            self.cache['components_by_name'] = index
+        return self.cache['components_by_name']
+
+    def component_id_from_name(self, component_name, product_id = None):
+        index = self.components_by_name()
+        if index.has_key((product_id, component_name)):
+            return index[(product_id, component_name)]
+        return index.get((None, component_name))
 
     # 9.5. Table "dependencies"
 
@@ -1613,26 +1819,49 @@ class bugzilla:
             self.cache['groups'] = groups
         return self.cache['groups']
 
+    # A dictionary mapping group bit to group name (for Bugzillas with
+    # bitset groups).
+    def groups_by_bit(self):
+        if not self.cache.has_key('groups_by_bit'):
+            index = {}
+            for (name, group) in self.groups().items():
+                index[long(group['bit'])] = name
+            self.cache['groups_by_bit'] = index
+        return self.cache['groups_by_bit']
+
     # The group names corresponding to this groupset.
     def groupset_groups(self, groupset):
         groups = []
         if groupset:
-            gs = self.groups()
-            for (name, group) in gs.items():
-                if group['bit'] & groupset:
-                    groups.append(name)
+            index = self.groups_by_bit()
+            groupset = long(groupset)
+            bit = 1L
+            while bit <= groupset:
+                if bit & groupset and index.has_key(bit):
+                    groups.append(index[bit])
+                bit = bit << 1
         return groups
 
-    # The group names corresponding to this groupset.
+    # The groupset corresponding to these group names.
     def groups_groupset(self, groups):
         groupset = 0L
-        if groups:
-            gs = self.groups()
-            for (name, group) in gs.items():
-                if name in groups:
-                    groupset += group['bit']
+        gs = self.groups()
+        for name in self.unique_groups(groups):
+            groupset = groupset | gs[name]['bit']
         return groupset
 
+    # The names in this list that are the names of groups, without
+    # duplicates.
+    def unique_groups(self, groups):
+        gs = self.groups()
+        seen = {}
+        result = []
+        for name in groups or []:
+            if gs.has_key(name) and not seen.has_key(name):
+                seen[name] = 1
+                result.append(name)
+        return result
+
     # The names of groups which this bug is in.
     def bug_groups(self, bug):
         bug_id = bug['bug_id']
@@ -1678,10 +1907,9 @@ class bugzilla:
                    'isbless': 0,
                    'isderived': 0,
                    }
-            for (name, group) in gs.items():
-                if name in groups:
-                    row['group_id'] = group['id']
-                    self.insert_row('user_group_map', row)
+            for name in self.unique_groups(groups):
+                row['group_id'] = gs[name]['id']
+                self.insert_row('user_group_map', row)
 
     # Put the bug in the named groups.
     def add_bug_groups(self, bug_id, groups):
@@ -1691,10 +1919,9 @@ class bugzilla:
             gs = self.groups()
             row = {'bug_id': bug_id,
                    }
-            for (name, group) in gs.items():
-                if name in groups:
-                    row['group_id'] = group['id']
-                    self.insert_row('bug_group_map', row)
+            for name in self.unique_groups(groups):
+                row['group_id'] = gs[name]['id']
+                self.insert_row('bug_group_map', row)
 
     # 9.8. Table "longdescs"
 
@@ -1703,35 +1930,136 @@ class bugzilla:
     # See job000375.
     blank_line_re = re.compile('^[ \t]+$', re.M)
 
+    # A bug's long description is made from all its longdescs records
+    # (its comments), which may run to hundreds of records and
+    # megabytes of text, so:
+    #
+    #  1. We fetch the long description only if the replicator needs it
+    # (load_longdesc is set by the configuration generator if the
+    # longdesc field is replicated).  Otherwise bugs have no 'longdesc'
+    # key, and dt_bugzilla.bugzilla_bug fetches it if asked for.
+    #
+    #  2. We remember the long descriptions of recently fetched bugs
+    # from one poll to the next, in longdesc_cache.  Comments can only
+    # be added to a bug, not changed, so when we fetch the long
+    # description again we fetch only the records from the time of the
+    # last record we have, and append the new ones.
+    #
+    #  3. When comments are appended to the job's Description in
+    # Perforce, update_longdesc adds the appended text as one new
+    # longdescs record.  The existing records are never rewritten.
+    #
+    # Each entry in longdesc_cache is a dictionary with keys 'text' (the
+    # long description so far, without the final line inviting more
+    # comments), 'bug_when' (the time of the last record), and 'count'
+    # (the number of records at that time).
+
+    load_longdesc = 1
+    longdesc_cache_size = 200
+
     def bug_get_longdesc(self, bug):
-        bug_id = bug['bug_id']
-        longdescs = self.fetch_rows_as_list_of_dictionaries(
-            "select profiles.login_name, profiles.realname, "
-            "       longdescs.bug_when, longdescs.thetext "
+        return self.fetch_longdescs([bug['bug_id']])[bug['bug_id']]
+
+    # fetch_longdescs(bug_ids).  Return a map from bug id to long
+    # description, for the given bugs, in one query.
+
+    def fetch_longdescs(self, bug_ids):
+        if not bug_ids:
+            return {}
+        conditions = []
+        uncached = []
+        entries = {}
+        for bug_id in bug_ids:
+            entry = self.longdesc_cache.get(bug_id)
+            if entry == None:
+                uncached.append(str(int(bug_id)))
+            else:
+                entries[bug_id] = entry
+                when = self.quote_string(str(entry['bug_when']))
+                conditions.append("(longdescs.bug_id = %d"
+                                  " and longdescs.bug_when >= %s)"
+                                  % (bug_id, when))
+        if uncached:
+            conditions.append("longdescs.bug_id in (%s)"
+                              % string.join(uncached, ','))
+        records = {}
+        for bug_id in bug_ids:
+            records[bug_id] = []
+        for record in self.fetch_rows_as_list_of_dictionaries(
+            "select longdescs.bug_id, profiles.login_name, "
+            "       profiles.realname, longdescs.bug_when, "
+            "       longdescs.thetext "
             "  from longdescs, profiles "
             " where profiles.userid = longdescs.who "
-            "   and longdescs.bug_id = %d"
-            " order by longdescs.bug_when" % bug_id,
-            "long descriptions for bug %d" % bug_id)
-        longdesc = ""
-        first = 1
-        for record in longdescs:
+            "   and (%s)"
+            " order by longdescs.bug_id, longdescs.bug_when"
+            % string.join(conditions, ' or '),
+            "long descriptions for %d bugs" % len(bug_ids)):
+            records[record['bug_id']].append(record)
+        longdescs = {}
+        for bug_id in bug_ids:
+            entry = entries.get(bug_id)
+            new = records[bug_id]
+            if entry != None:
+                # Drop the records we already have: there should be
+                # 'count' of them at the time of the last record.  If
+                # there are more, we can't tell which of them are new;
+                # if there are fewer, the bug isn't the one we
+                # remember.  Either way, fetch the whole long
+                # description.
+                at_last = len(filter(lambda r, when=entry['bug_when']:
+                                     r['bug_when'] == when, new))
+                if at_last != entry['count']:
+                    self.longdesc_cache.remove(bug_id)
+                    longdescs[bug_id] = self.bug_get_longdesc(
+                        {'bug_id': bug_id})
+                    continue
+                new = new[at_last:]
+            entry = self.append_longdesc(bug_id, entry, new)
+            longdescs[bug_id] = (entry['text'] + "\n\n"
+                                 "------- Append additional comments "
+                                 "below -------")
+        return longdescs
+
+    # append_longdesc(bug_id, entry, records).  Append the longdescs
+    # records (in order, each a dictionary with keys login_name,
+    # realname, bug_when and thetext) to the cached long description
+    # (None if there isn't one yet), update the cache, and return the
+    # new entry.
+
+    def append_longdesc(self, bug_id, entry, records):
+        if entry == None:
+            parts = []
+            when = None
+            count = 0
+        elif records:
+            parts = [entry['text']]
+            when = entry['bug_when']
+            count = entry['count']
+        else:
+            return entry
+        for record in records:
             thetext = record['thetext']
             # replace blank lines with empty lines.  job000375.
             thetext = self.blank_line_re.sub('', thetext)
-            if first:
-                longdesc = thetext
-                first = 0
+            if when != None:
+                parts.append("\n\n------- %s <%s> at %s -------\n"
+                             % (record['realname'],
+                                record['login_name'],
+                                record['bug_when']))
+            parts.append(thetext)
+            if record['bug_when'] == when:
+                count = count + 1
             else:
-                longdesc = (longdesc +
-                            ("\n\n------- %s <%s> at %s -------\n" %
-                             (record['realname'],
-                              record['login_name'],
-                              record['bug_when']))
-                            + thetext)
-        longdesc = (longdesc + "\n\n"
-                    "------- Append additional comments below -------")
-        return longdesc
+                when = record['bug_when']
+                count = 1
+        entry = {'text': string.join(parts, ''),
+                 'bug_when': when,
+                 'count': count,
+                 }
+        if when != None:
+            self.longdesc_cache.put(bug_id, entry)
+        return entry
 
     def add_longdesc(self, bug_id, user, comment):
         longdesc = {}
@@ -1764,10 +2092,17 @@ class bugzilla:
             self.cache['products'] = products
         return self.cache['products']
 
+    # A dictionary mapping product id to product name.
+    def products_by_id(self):
+        if not self.cache.has_key('products_by_id'):
+            index = {}
+            for (name, p) in self.products().items():
+                index[p['id']] = name
+            self.cache['products_by_id'] = index
+        return self.cache['products_by_id']
+
     def product_name_from_id(self, product_id):
-        for (name, p) in self.products().items():
-            if p['id'] == product_id:
-                return name
+        return self.products_by_id().get(product_id)
 
     def product_id_from_name(self, product_name):
         products = self.products()
@@ -1786,6 +2121,15 @@ class bugzilla:
             self.cache['users'] = users
         return self.cache['users']
 
+    # A dictionary mapping e-mail address (login_name) to userid.
+    def users_by_email(self):
+        if not self.cache.has_key('users_by_email'):
+            index = {}
+            for (id, user) in self.users().items():
+                index[user['login_name']] = id
+            self.cache['users_by_email'] = index
+        return self.cache['users_by_email']
+
     def add_user(self, dict):
         # The quote_table will make sure that the password is encrypted
         # before being written to the database.
@@ -1803,6 +2147,8 @@ class bugzilla:
         userid = u['userid']
         if self.cache.has_key('users'):
             self.cache['users'][userid] = u
+        if self.cache.has_key('users_by_email'):
+            self.cache['users_by_email'][u['login_name']] = userid
         if not self.features.has_key('bitset groups'):
             self.add_user_groups(userid, groups)
         return userid
@@ -1825,10 +2171,7 @@ class bugzilla:
         return self.users()[user]['login_name']
 
     def userid_from_email(self, email):
-        for (id, user) in self.users().items():
-            if user['login_name'] == email:
-                return id
-        return None
+        return self.users_by_email().get(email)
 
     def real_name_from_userid(self, user):
         return self.users()[user]['realname']
@@ -1861,8 +2204,13 @@ class bugzilla:
 
     # 10.1. Table "p4dti_bugs"
 
+    # The p4dti_bugs record for a bug is cached if it was fetched by
+    # bugs_from_bug_ids.
+
     def bug_p4dti_bug(self, bug):
         bug_id = bug['bug_id']
+        if self.cache.has_key(('p4dti_bugs', bug_id)):
+            return self.cache[('p4dti_bugs', bug_id)]
         p4dti_bug = self.fetch_at_most_one_row_as_dictionary(
             ("select * from p4dti_bugs "
              "  where bug_id = %d" % bug_id),
@@ -1870,6 +2218,8 @@ class bugzilla:
         return p4dti_bug
 
     def add_p4dti_bug(self, dict, created):
+        if self.cache.has_key(('p4dti_bugs', dict['bug_id'])):
+            del self.cache[('p4dti_bugs', dict['bug_id'])]
         if created:
             # Empty "migrated" defaults to now(); see section 4.
             dict['migrated'] = ''
@@ -1877,6 +2227,8 @@ class bugzilla:
 
     def update_p4dti_bug(self, dict, bug_id):
         if dict:
+            if self.cache.has_key(('p4dti_bugs', bug_id)):
+                del self.cache[('p4dti_bugs', bug_id)]
             self.update_row_rid_sid('p4dti_bugs', dict,
                                     'bug_id = %d' % bug_id)
 
@@ -2080,6 +2432,29 @@ class bugzilla:
                                  'end < date_sub(now(), '
                                  'INTERVAL 1 HOUR)')
 
+        if self.change_queue:
+            self.end_change_queue()
+
+    # changed_since(date).  Return true if any bug has been touched,
+    # or any bug activity recorded, since the given date.  This is a
+    # cheap test (both columns are indexed, and we don't lock any
+    # tables) that allows the replicator to skip polls when nothing
+    # has happened.  A true result doesn't mean that changed_bugs_since
+    # will find any bugs (the changes might have been made by this
+    # replicator, or be to bugs replicated by another).
+
+    def changed_since(self, date):
+        date = self.changes_window_start(date)
+        for table, column in [('bugs', 'delta_ts'),
+                              ('bugs_activity', 'bug_when')]:
+            if self.select_rows("select bug_id from %s where %s >= %s "
+                                "limit 1"
+                                % (table, column,
+                                   self.quote_string(date)),
+                                "%s changed since '%s'" % (table, date)):
+                return 1
+        return 0
+
     def latest_complete_replication_no_checking(self):
         return self.select_one_row(
             "select max(start) from p4dti_replications where "
@@ -2099,6 +2474,236 @@ class bugzilla:
         return start
 
 
+    # 10.9. Table "p4dti_change_queue"
+    #
+    # If the bugzilla_change_queue configuration parameter is 1, the
+    # P4DTI installs MySQL triggers (change_queue_triggers) that add a
+    # row to the p4dti_change_queue table whenever a bug or comment is
+    # inserted or updated, or bug activity is recorded, except on a
+    # replicator's own connection (which sets the @p4dti_replicator
+    # variable).  Then we find the changed bugs by reading the rows we
+    # haven't yet seen, rather than by searching the bugs and
+    # bugs_activity tables for recent timestamps (changed_bugs_since),
+    # so the cost of a poll depends on the number of changes, not on
+    # the size of the tables.
+    #
+    # change_queue_position is the sequence number of the last row we
+    # have dealt with, or None if we don't know it (when the
+    # replicator starts).  If we don't know it, or if rows we haven't
+    # seen have been deleted, we find changed bugs by their timestamps
+    # as usual, and use the queue from the next poll.
+    #
+    # The triggers insert rows inside Bugzilla's own transactions, so
+    # rows may become visible out of sequence order: a row may commit
+    # after we have read rows with higher sequence numbers.  And if the
+    # queue isn't transactional, a row may be visible before the change
+    # to the bug has committed, so that we replicate the bug as it was.
+    # So each poll also reads again the rows queued in the
+    # transaction_margin seconds before the start of the last
+    # replication (see margin_before), whatever their sequence numbers.
+    # Bugs found again are cheap to replicate, because the replicator
+    # skips issues whose replicated fields haven't changed.
+    # change_queue_seen records the rows we read, so that
+    # changes_in_queue can spot late rows.
+    #
+    # Rows more than an hour old that we have dealt with are deleted
+    # at the end of each replication (as for p4dti_replications), but
+    # the last row is kept so that the sequence numbers keep
+    # increasing even if MySQL is restarted.
+
+    change_queue = 0
+    change_queue_position = None
+
+    # The position that the queue will reach when the current
+    # replication ends.
+    change_queue_end = None
+
+    # A map from the sequence number of each row we read in the last
+    # complete replication to 1; and the same for the current one.
+    change_queue_seen = {}
+    change_queue_reading = {}
+
+    # A list of triples (trigger name, event, table).
+    change_queue_triggers = [
+        ('p4dti_bugs_insert', 'insert', 'bugs'),
+        ('p4dti_bugs_update', 'update', 'bugs'),
+        ('p4dti_longdescs_insert', 'insert', 'longdescs'),
+        ('p4dti_longdescs_update', 'update', 'longdescs'),
+        ('p4dti_bugs_activity_insert', 'insert', 'bugs_activity'),
+        ]
+
+    # update_change_queue_triggers() installs the change queue
+    # triggers if bugzilla_change_queue is 1, and removes them
+    # otherwise.  MySQL only supports triggers from release 5.0.
+
+    def update_change_queue_triggers(self):
+        if not re.match(r'[5-9]\.', self.mysql_version or ''):
+            if self.change_queue:
+                # "Configuration parameter 'bugzilla_change_queue'
+                # requires MySQL 5.0 or later, but this is MySQL %s."
+                raise error, catalog.msg(147, self.mysql_version)
+            return
+        triggers = {}
+        for row in self.fetch_rows_as_list_of_dictionaries(
+            "show triggers", "triggers"):
+            triggers[row['Trigger']] = 1
+        for name, event, table in self.change_queue_triggers:
+            if self.change_queue and not triggers.has_key(name):
+                # "Installing MySQL trigger '%s' on table '%s' for the
+                # change queue."
+                self.log(145, (name, table))
+                self.execute(
+                    "create trigger %s after %s on %s for each row "
+                    "begin "
+                    "  if @p4dti_replicator is null then "
+                    "    insert into p4dti_change_queue (bug_id, queued) "
+                    "      values (NEW.bug_id, now()); "
+                    "  end if; "
+                    "end" % (name, event, table))
+            elif not self.change_queue and triggers.has_key(name):
+                # "Removing MySQL trigger '%s'."
+                self.log(146, name)
+                self.execute("drop trigger %s" % name)
+
+    # change_queue_ready() returns 1 if we can find the changed bugs
+    # from the change queue, 0 if we must use their timestamps.
+
+    def change_queue_ready(self):
+        if not self.change_queue or self.change_queue_position == None:
+            return 0
+        oldest = self.select_one_row(
+            "select min(seq) from p4dti_change_queue",
+            "oldest change in queue")[0]
+        if oldest != None and oldest > self.change_queue_position + 1:
+            # "Changes have been deleted from the change queue before
+            # the replicator saw them; finding changed bugs by their
+            # timestamps."
+            self.log(148)
+            self.change_queue_position = None
+            return 0
+        return 1
+
+    # start_change_queue() records the position that the queue will
+    # reach when the current replication ends.  If we're using the
+    # queue, that's the last row.  If we're finding changed bugs by
+    # timestamp, it's the last row added before the replication
+    # started (since changed_bugs_since omits changes made in the same
+    # second as the replication; see job000235).
+
+    def start_change_queue(self, ready):
+        if ready:
+            where = ""
+        else:
+            where = (" where queued < %s"
+                     % self.quote_string(self.replication))
+        end = self.select_one_row(
+            "select max(seq) from p4dti_change_queue" + where,
+            "end of change queue")[0]
+        if end == None and not ready:
+            # No rows before the replication started, so we've seen
+            # everything before the first row after it.
+            end = self.select_one_row(
+                "select min(seq) - 1 from p4dti_change_queue",
+                "start of change queue")[0]
+        if end == None:
+            end = self.change_queue_position or 0
+        self.change_queue_end = end
+
+    # change_queue_rows(date) returns a list of the rows in the change
+    # queue, as pairs (seq, bug_id), which are after
+    # change_queue_position or were queued after the start of the
+    # trailing window for the replication that started at date (see
+    # section 10.9), and which aren't after change_queue_end (if it's
+    # not None).
+
+    def change_queue_rows(self, date):
+        where = (" where (seq > %d or queued >= %s)"
+                 % (self.change_queue_position,
+                    self.quote_string(str(self.margin_before(date)))))
+        if self.change_queue_end != None:
+            where = where + " and seq <= %d" % self.change_queue_end
+        return self.fetch_rows_as_list_of_sequences(
+            "select seq, bug_id from p4dti_change_queue" + where,
+            "rows in change queue after %d" % self.change_queue_position)
+
+    # changed_bugs_in_queue(date) returns the bugs in the change queue
+    # which we haven't dealt with, or which are in the trailing window
+    # for the replication that started at date, and which are not
+    # being replicated by any other replicator.
+
+    def changed_bugs_in_queue(self, date):
+        bug_ids = {}
+        self.change_queue_reading = {}
+        for seq, bug_id in self.change_queue_rows(date):
+            self.change_queue_reading[seq] = 1
+            bug_ids[bug_id] = 1
+        bug_ids = bug_ids.keys()
+        if not bug_ids:
+            return []
+        bug_ids.sort()
+        bug_ids = self.fetch_rows_as_list_of_sequences(
+            ("select nb.bug_id from bugs nb "
+             "  left join p4dti_bugs np "            # what replication
+             "    on (nb.bug_id = np.bug_id) "
+             "  where nb.bug_id in (%s) "
+             "    and (np.rid is null "              # NOT replicated
+             "         or (np.rid = %s "             # or replicated by me.
+             "             and np.sid = %s)) "
+             "  order by nb.bug_id" %
+             (string.join(map(str, bug_ids), ', '),
+              self.quote_string(self.rid),
+              self.quote_string(self.sid))),
+            "bugs in change queue after %d" % self.change_queue_position)
+        return self.bugs_from_bug_ids(map(lambda b: b[0], bug_ids))
+
+    # changed_bugs(date) returns the changed bugs, using the change
+    # queue if we can, and otherwise changed_bugs_since(date).
+
+    def changed_bugs(self, date):
+        if not self.change_queue:
+            return self.changed_bugs_since(date)
+        ready = self.change_queue_ready()
+        self.start_change_queue(ready)
+        if ready:
+            return self.changed_bugs_in_queue(date)
+        else:
+            self.change_queue_reading = {}
+            return self.changed_bugs_since(date)
+
+    # changes_in_queue(date) returns 1 if there are changes in the
+    # queue that we haven't seen (including rows in the trailing window
+    # for the replication that started at date which weren't visible
+    # when we last read the queue), 0 if not, or None if we can't use
+    # the queue.
+
+    def changes_in_queue(self, date):
+        if not self.change_queue_ready():
+            return None
+        for seq, bug_id in self.change_queue_rows(date):
+            if not self.change_queue_seen.has_key(seq):
+                return 1
+        return 0
+
+    # end_change_queue() records that we have dealt with the rows up
+    # to change_queue_end, and deletes old rows.
+
+    def end_change_queue(self):
+        if self.change_queue_end == None:
+            return
+        self.change_queue_position = self.change_queue_end
+        self.change_queue_end = None
+        self.change_queue_seen = self.change_queue_reading
+        self.change_queue_reading = {}
+        last = self.select_one_row(
+            "select max(seq) from p4dti_change_queue",
+            "end of change queue")[0]
+        if last != None:
+            self.delete_rows('p4dti_change_queue',
+                             'seq <= %d and seq < %d and '
+                             'queued < date_sub(now(), INTERVAL 1 HOUR)'
+                             % (self.change_queue_position, last))
+
+
     # 11. BUG MAIL
 
     def bugmail_invocation(self, script_name):
@@ -2139,12 +2744,93 @@ class bugzilla:
 
 
     # 12. LOCKING
+    #
+    # There are two ways to stop Bugzilla users changing the database
+    # while the replicator is working on it.
+    #
+    # Normally, the replicator locks all the tables it uses for the
+    # whole of a poll (lock_tables and unlock_tables).  This is simple
+    # and works with any MySQL table type, but Bugzilla users can't
+    # change bugs while the replicator is waiting for Perforce.
+    #
+    # If the bugzilla_transactions configuration parameter is 1 (which
+    # needs InnoDB tables), lock_tables and unlock_tables don't lock
+    # anything.  Instead, each change to a bug is made in a short
+    # transaction (see section 12.1), and every other statement is
+    # committed as soon as it is executed.
+    #
+    # Without the locks, a Bugzilla transaction may take its timestamp
+    # (from NOW()) before a replication starts but commit after the
+    # replication has looked for changed bugs, so that the change has
+    # a timestamp before the start of the next replication's window.
+    # So in transactional mode each replication looks for changes from
+    # transaction_margin seconds before the start of the last one (see
+    # changes_window_start).  A Bugzilla transaction that takes longer
+    # than that to commit may still be missed.  Bugs found again in the
+    # overlap are cheap to replicate, because the replicator skips
+    # issues whose replicated fields haven't changed (see
+    # replicator.issue_digest).
+    #
+    # Either way, we log how long Bugzilla was locked for.
+
+    transactions = 0
+    transaction_margin = 60
+
+    # changes_window_start(date) returns the time from which to look
+    # for bugs changed since the replication that started at date.
+
+    def changes_window_start(self, date):
+        if not self.transactions:
+            return date
+        return self.margin_before(date)
+
+    # margin_before(date) returns the time transaction_margin seconds
+    # before date.
+
+    def margin_before(self, date):
+        return self.select_one_row(
+            "select date_sub(%s, interval %d second)"
+            % (self.quote_string(str(date)), self.transaction_margin),
+            "start of changes window")[0]
+
+    # The time at which lock_tables was called.
+    lock_start = None
+
+    # A list of the durations of the transactions in this poll.
+    transaction_times = []
+
+    # The time at which the current transaction started.
+    transaction_start = None
+
+    # check_transactional_tables() checks that the tables that the
+    # replicator changes support transactions.
+
+    transactional_engines = ['InnoDB', 'BDB']
+
+    def check_transactional_tables(self):
+        tables = self.table_names()
+        for (table, mode, _) in self.tables_to_lock:
+            if mode != 'write' or table not in tables:
+                continue
+            # Table names are our own constants, so no need to quote
+            # them, but underscores must be escaped in LIKE patterns.
+            pattern = string.replace(table, '_', '\\_')
+            status = self.fetch_one_row_as_dictionary(
+                "show table status like '%s'" % pattern,
+                "status of table %s" % table)
+            engine = status.get('Engine', status.get('Type'))
+            if engine not in self.transactional_engines:
+                # "Configuration parameter 'bugzilla_transactions'
+                # requires transactional tables, but table '%s' has
+                # type '%s'."
+                raise error, catalog.msg(149, (table, engine))
 
     tables_to_lock = [
         ('attachments', 'write', []),
         ('bug_group_map', 'write', []),
-        ('bugs', 'write', []),
-        ('bugs_activity', 'write', [('ba', 'read'),]),
+        ('bugs', 'write', [('nb', 'read'), ('tb', 'read'),
+                           ('cb', 'read')]),
+        ('bugs_activity', 'write', [('ba', 'read'), ('ta', 'read')]),
         ('cc', 'write', []),
         ('dependencies', 'write', []),
         ('duplicates', 'write', []),
@@ -2153,8 +2839,10 @@ class bugzilla:
         ('longdescs', 'write', []),
         ('votes', 'write', []),
 
-        ('p4dti_bugs', 'write', []),
+        ('p4dti_bugs', 'write', [('np', 'read'), ('tp', 'read'),
+                                 ('cp', 'read')]),
         ('p4dti_bugs_activity', 'write', [('pba', 'read'),]),
+        ('p4dti_change_queue', 'write', []),
         ('p4dti_changelists', 'write', []),
         ('p4dti_filespecs', 'write', []),
         ('p4dti_fixes', 'write', []),
@@ -2171,6 +2859,10 @@ class bugzilla:
         ]
 
     def lock_tables(self):
+        self.lock_start = time.time()
+        self.transaction_times = []
+        if self.transactions:
+            return
         tables = self.table_names()
         locks = []
         for (table, mode, aliases) in self.tables_to_lock:
@@ -2181,11 +2873,182 @@ class bugzilla:
         self.execute("lock tables %s;" % string.join(locks, ", "))
 
     def unlock_tables(self):
-        self.execute("unlock tables;")
+        if not self.transactions:
+            self.execute("unlock tables;")
+            locked = time.time() - self.lock_start
+            if self.metrics:
+                self.metrics.observe('bugzilla_lock_seconds', locked)
+            # "Bugzilla tables were locked for %.3f seconds."
+            self.log(150, locked)
+        elif self.transaction_times:
+            total = 0.0
+            for t in self.transaction_times:
+                total = total + t
+            # "Made %d Bugzilla transactions, taking %.3f seconds in
+            # total (the longest took %.3f seconds)."
+            self.log(151, (len(self.transaction_times), total,
+                           max(self.transaction_times)))
+
+
+    # 12.1. Transactions
+    #
+    # In transactional mode, a bug is changed as follows.  Start a
+    # transaction.  Lock the bug's row with lock_bug, which also
+    # checks whether the bug has changed since we read it (by
+    # comparing delta_ts).  If it has, roll back the transaction and
+    # raise dt_interface.conflict, so that the replicator tries again
+    # in the next poll (see dt_bugzilla.bugzilla_bug.update).  Make the
+    # changes.  Commit the transaction (or roll it back if there's an
+    # error).
+    #
+    # When we lock the tables instead, these methods do nothing (the
+    # bug can't have changed).
+
+    def start_transaction(self):
+        if self.transactions:
+            self.transaction_start = time.time()
+            self.execute("start transaction;")
+
+    def end_transaction(self, sql):
+        if self.transactions:
+            self.execute(sql)
+            locked = time.time() - self.transaction_start
+            self.transaction_times.append(locked)
+            if self.metrics:
+                self.metrics.observe('bugzilla_lock_seconds', locked)
+
+    def commit_transaction(self):
+        self.end_transaction("commit;")
+
+    def rollback_transaction(self):
+        self.end_transaction("rollback;")
+
+    # lock_bug(bug) locks the bug's row until the end of the
+    # transaction, and returns 1 if the bug has been changed since we
+    # read it, 0 if not.
+
+    def lock_bug(self, bug):
+        if not self.transactions:
+            return 0
+        bug_id = bug['bug_id']
+        delta_ts = self.select_one_row(
+            "select delta_ts from bugs where bug_id = %d for update;"
+            % bug_id, "delta_ts for bug %d" % bug_id)[0]
+        return delta_ts != bug['delta_ts']
+
+    # clear_caches() empties the cache at the start of each poll,
+    # except for reference data (users, products, and so on) that is
+    # still valid.
+    #
+    # reference_tables maps the name of a cache entry (the first
+    # element, if the key is a tuple) that holds reference data to the
+    # list of tables that the data comes from.  Entries not listed
+    # here, such as bugs, are always cleared.
+    #
+    # We decide whether a table has changed since the last poll from
+    # its Update_time in "show table status".  Update_time only records
+    # the second, so a table that was updated in the same second as the
+    # last check is assumed to have changed.  If MySQL doesn't know
+    # when the table was last updated (InnoDB tables, for example), we
+    # compare the table's checksum (from "checksum table") with its
+    # checksum at the last check instead.  The reference tables are
+    # small, so this is much cheaper than reloading their data.
+
+    reference_tables = {
+        'components': ['components', 'products'],
+        'components_by_name': ['components', 'products'],
+        'custom_fields': ['fielddefs'],
+        'fielddefs': ['fielddefs'],
+        'group_control_map': ['group_control_map', 'groups', 'products'],
+        'groups': ['groups'],
+        'groups_by_bit': ['groups'],
+        'product_creator_groups': ['group_control_map', 'groups',
+                                   'products'],
+        'product_editor_groups': ['group_control_map', 'groups',
+                                  'products'],
+        'products': ['products'],
+        'products_by_id': ['products'],
+        'user_groups': ['groups', 'profiles', 'user_group_map'],
+        'users': ['profiles'],
+        'users_by_email': ['profiles'],
+        'versions': ['products', 'versions'],
+        }
+
+    # Map from table name to its Update_time at the last check.
+    table_update_times = {}
+
+    # Map from table name to its checksum at the last check, for tables
+    # without an Update_time.
+    table_checksums = {}
+
+    # The time of the last check.
+    table_update_check = None
 
     def clear_caches(self):
         self.clear_bugmail_commands()
-        self.cache = {}
+        changed = self.changed_tables()
+        cache = {}
+        for key, value in self.cache.items():
+            if isinstance(key, types.TupleType):
+                name = key[0]
+            else:
+                name = key
+            tables = self.reference_tables.get(name)
+            if tables and not filter(changed.has_key, tables):
+                cache[key] = value
+        self.cache = cache
+
+    # changed_tables() returns a dictionary whose keys are the names of
+    # the tables in reference_tables that may have changed since the
+    # last time it was called.
+
+    def changed_tables(self):
+        now = self.now()
+        last_check = self.table_update_check
+        names = {}
+        for tables in self.reference_tables.values():
+            for table in tables:
+                names[table] = 1
+        names = names.keys()
+        names.sort()
+        # "show table status where" needs MySQL 5.0.
+        if re.match(r'[5-9]\.', self.mysql_version or ''):
+            where = (" where Name in (%s)"
+                     % string.join(map(self.quote_string, names), ', '))
+        else:
+            where = ""
+        update_times = {}
+        for status in self.fetch_rows_as_list_of_dictionaries(
+            "show table status" + where, "table status"):
+            update_times[status['Name']] = status.get('Update_time')
+        unknown = filter(lambda t, u = update_times: u.get(t) == None,
+                         names)
+        checksums = {}
+        if unknown:
+            # Table names are our own constants, so no need to quote
+            # them.
+            for row in self.fetch_rows_as_list_of_sequences(
+                "checksum table " + string.join(unknown, ', '),
+                "table checksums"):
+                # The Table column is qualified by the database name.
+                table = string.split(row[0], '.')[-1]
+                checksums[table] = row[1]
+        changed = {}
+        for table in names:
+            update_time = update_times.get(table)
+            if update_time == None:
+                checksum = checksums.get(table)
+                if (checksum == None
+                    or checksum != self.table_checksums.get(table)):
+                    changed[table] = 1
+            elif (last_check == None
+                  or update_time != self.table_update_times.get(table)
+                  or update_time >= last_check):
+                changed[table] = 1
+        self.table_update_times = update_times
+        self.table_checksums = checksums
+        self.table_update_check = now
+        return changed
 
     def invoke_deferred_commands(self):
         self.invoke_bugmail_commands()
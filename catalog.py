@@ -116,6 +116,26 @@ p4dti_en_catalog = {
           "Bugzilla table '%s' has character set '%s'."),
     141: (message.INFO,
           "Bugzilla column '%s' has character set '%s'."),
+    142: (message.DEBUG,
+          "Query plan for changed bugs: table '%s', access type '%s', key '%s', rows %s."),
+    143: (message.WARNING,
+          "The query for changed bugs scans all %s rows of table '%s'; polling may be slow.  Is an index missing?"),
+    144: (message.INFO,
+          "Adding index '%s' on columns %s of table '%s'."),
+    145: (message.INFO,
+          "Installing MySQL trigger '%s' on table '%s' for the change queue."),
+    146: (message.INFO,
+          "Removing MySQL trigger '%s'."),
+    147: (message.CRIT,
+          "Configuration parameter 'bugzilla_change_queue' requires MySQL 5.0 or later, but this is MySQL %s."),
+    148: (message.INFO,
+          "Changes have been deleted from the change queue before the replicator saw them; finding changed bugs by their timestamps."),
+    149: (message.CRIT,
+          "Configuration parameter 'bugzilla_transactions' requires transactional tables, but table '%s' has type '%s'."),
+    150: (message.INFO,
+          "Bugzilla tables were locked for %.3f seconds."),
+    151: (message.INFO,
+          "Made %d Bugzilla transactions, taking %.3f seconds in total (the longest took %.3f seconds)."),
 
 
     # 2.2. Messages from check_config.py (200-299)
@@ -133,6 +153,7 @@ p4dti_en_catalog = {
     210: (message.CRIT, "Configuration parameter '%s' (value '%s') must contain exactly one %%d format specifier, any number of doubled percents, but no other format specifiers."),
     211: (message.CRIT, "Configuration parameter '%s' (value '%s') must contain exactly one %%s format specifier, any number of doubled percents, but no other format specifiers."),
     212: (message.CRIT, "Configuration parameter '%s' must be a list of pairs of strings."),
+    213: (message.CRIT, "Configuration parameter '%s' must be a positive integer."),
 
 
     # 2.3. Messages from configure_bugzilla.py (300-399)
@@ -237,6 +258,8 @@ p4dti_en_catalog = {
     554: (message.NOTICE, "Perforce replicator user <%s> added to Bugzilla as user %d."),
     555: (message.ERR, "User %d must be in group '%s' to edit bug %d."),
     556: (message.ERR, "User %d must be in group '%s' to edit bug %d in product '%s'."),
+    557: (message.WARNING, "Bug %d was changed in Bugzilla while the replicator was working on it."),
+    558: (message.DEBUG, "Synchronizing users: %d Perforce users and %d Bugzilla users have changed."),
 
     # 2.6. Messages from dt_teamtrack.py (600-699)
     # That module has been removed, so all these messages are now NOT_USED.
@@ -325,6 +348,9 @@ p4dti_en_catalog = {
     734: (message.INFO, "Perforce message '%s'.  Switching Unicode mode %s to retry."),
     735: (message.NOT_USED,  "Perforce message '%s'.  Reverting to Unicode mode %s."),
     736: (message.ERR,  "Perforce message '%s'.  Is P4CHARSET set with a non-Unicode server? Reverting to Unicode mode %s."),
+    737: (message.DEBUG, "Perforce batch arguments: %s."),
+    738: (message.INFO, "The Perforce client can't run '%s' commands in batch mode, so the P4DTI will run them one at a time."),
+    739: (message.DEBUG, "Perforce returned %d results."),
 
 
 
@@ -456,6 +482,22 @@ p4dti_en_catalog = {
     926: (message.INFO, "Job changer"),
     927: (message.WARNING, "Can't use Perforce client %s."),
     928: (message.WARNING, "Attempting to make working Perforce client %s."),
+    929: (message.INFO, "Replicating %d issues and jobs using %d workers."),
+    930: (message.DEBUG, "Fetched changes in %.3f seconds (defect tracker %.3f seconds, Perforce %.3f seconds)."),
+    931: (message.INFO, "Listening for wakeup messages on socket '%s'."),
+    932: (message.WARNING, "Can't listen for wakeup messages on socket '%s': %s.  Polling every %d seconds instead."),
+    933: (message.DEBUG, "Woken up by %d wakeup messages."),
+    934: (message.DEBUG, "Nothing has changed since the last poll: skipping poll."),
+    935: (message.WARNING, "Couldn't write replicator statistics to '%s': %s."),
+    936: (message.INFO, "Wrote profile of poll %d to '%s'."),
+    937: (message.WARNING, "Couldn't write profile of poll %d to '%s': %s."),
+    938: (message.INFO, "Profile of poll %d, by cumulative time: %s"),
+    939: (message.DEBUG, "Job cache: %d hits and %d misses; %d jobs cached."),
+    940: (message.DEBUG, "Issue '%s' hasn't changed since it was last replicated."),
+    941: (message.WARNING, "Deferring replication of job '%s' to issue '%s' to the next poll: %s"),
+    942: (message.WARNING, "Can't summarize profile of poll %d: the pstats module is not available."),
+    943: (message.DEBUG, "Woken up by changes in the defect tracker."),
+    944: (message.ERR, "'%s' exists and is not a socket."),
 
     # 2.9. Messages from init.py, check.py, check_jobs.py, run.py,
     # refresh.py, mysqldb_support.py, service.py, portable.py,
@@ -508,6 +550,18 @@ factory = message.catalog_factory(p4dti_en_catalog, "P4DTI")
 def msg(id, args = ()):
     return factory.new(id, args)
 
+# priority(id) returns the priority of message id, so that callers can
+# ask a logger whether the message will be logged before going to the
+# trouble of building it.  deferred_msg(id, args_function) returns a
+# message whose arguments are only computed (by calling args_function)
+# if the message text is needed; see message.deferred_message.
+
+def priority(id):
+    return factory.message_priority(id)
+
+def deferred_msg(id, args_function):
+    return factory.new_deferred(id, args_function)
+
 
 # A. REFERENCES
 #
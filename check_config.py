@@ -126,7 +126,7 @@ def check_host(config, name):
     check_string(config, name)
 
 
-# 2.6. Check that parameter is an integer
+# 2.6. Check that parameter is an integer (or a positive integer)
 
 def check_int(config, name):
     param = getattr(config, name)
@@ -134,6 +134,12 @@ def check_int(config, name):
         # "Configuration parameter '%s' must be an integer."
         raise error, catalog.msg(204, name)
 
+def check_positive_int(config, name):
+    check_int(config, name)
+    if getattr(config, name) < 1:
+        # "Configuration parameter '%s' must be a positive integer."
+        raise error, catalog.msg(213, name)
+
 
 # 2.7. Check that parameter is a list
 
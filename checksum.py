@@ -41,7 +41,9 @@ files = [
     'extend_jobspec.py',
     'init.py',
     'logger.py',
+    'lru.py',
     'message.py',
+    'metrics.py',
     'migrate.py',
     'migrate_users.py',
     'mysqldb_support.py',
@@ -54,6 +56,7 @@ files = [
     'service.py',
     'stacktrace.py',
     'translator.py',
+    'wakeup_trigger.py',
     ]
 
 # Python 1.5.2 doesn't have md5.hexdigest(), so we do it ourselves:
@@ -119,6 +119,24 @@ elif dt_name == "Bugzilla":
     # "/home/httpd/html/bugzilla"
     bugzilla_directory = None
 
+    # Set this to 1 to have the replicator install MySQL triggers that
+    # record changed bugs in a queue table (p4dti_change_queue), so
+    # that each poll reads the queue instead of searching the bugs
+    # and bugs_activity tables for recent changes.  This makes polling
+    # much cheaper on a large Bugzilla database.  Between polls, the
+    # replicator checks the queue every couple of seconds, and polls
+    # straight away when a bug changes.  Requires MySQL 5.0 or later,
+    # and a MySQL user with permission to create triggers.  Setting it
+    # back to 0 removes the triggers.
+    bugzilla_change_queue = 0
+
+    # Set this to 1 to stop the replicator locking the Bugzilla tables
+    # for the whole of each poll.  Instead it changes each bug in a
+    # short transaction, so Bugzilla users aren't held up while the
+    # replicator waits for Perforce.  Requires the Bugzilla tables to
+    # be InnoDB tables.
+    bugzilla_transactions = 0
+
 
 # 4. OTHER CONFIGURATION PARAMETERS
 #
@@ -154,6 +172,13 @@ log_file = "p4dti.log"
 # message.INFO, message.DEBUG.
 log_level = message.INFO
 
+# Set this to 1 to have the replicator write to the log file in
+# batches from a background thread, instead of writing and flushing the
+# file after each message.  This makes logging much cheaper when
+# log_level is message.DEBUG.  Messages are still written within a
+# second or so, and errors are written straight away.
+buffer_log_file = 0
+
 # The path to the Perforce client executable that the replicator uses.
 p4_client_executable = "p4"
 
@@ -185,6 +210,56 @@ use_windows_event_log = 0
 # otherwise.
 use_system_log = 1
 
+# The number of worker threads the replicator uses to replicate
+# changed issues and jobs in each poll.  With more than one worker,
+# the replicator waits for several Perforce commands at once (work on
+# any one job is never split between workers, and all defect tracker
+# operations still happen one at a time).  Set this to 1 to replicate
+# one issue at a time.
+replication_workers = 1
+
+# The name of a Unix domain socket on which the replicator listens for
+# wakeup messages, or None.  When a message arrives, the replicator
+# polls straight away instead of waiting for the end of the poll
+# period, so changes are replicated within a second or so.  Install
+# wakeup_trigger.py as a Perforce trigger to send the messages; see
+# the comments in that script.  The trigger must be able to write to
+# the socket (see wakeup_socket_mode).  The poll period still applies
+# when there are no wakeup messages.  Not supported on Windows.  (To
+# have changes in Bugzilla wake the replicator, set
+# bugzilla_change_queue.)
+wakeup_socket = None
+
+# The permissions of the wakeup socket.  Anyone who can write to the
+# socket can make the replicator poll.  The default, 0660, lets the
+# user the replicator runs as and members of its group write to it, so
+# run the Perforce server as a member of that group.
+wakeup_socket_mode = 0660
+
+# The name of a file to which the replicator writes statistics about its
+# performance after each poll, or None.  The statistics include the time
+# taken by each phase of a poll, the number of issues and jobs
+# replicated, the time taken by Perforce commands and SQL statements,
+# how long the defect tracker was locked, the current poll period, and
+# the number of Perforce changes waiting to be replicated.  The file is
+# in the Prometheus text format, so if you use Prometheus you can point
+# the node exporter's textfile collector at it (the file name must then
+# end in ".prom").  For example, metrics_file =
+# "/var/lib/node_exporter/p4dti.prom"
+metrics_file = None
+
+# The number of polls to profile when the replicator starts.  The
+# profile of each of these polls is written to a file named like
+# p4dti-poll-1-20040101-120000.pstats in the same directory as the log
+# file, and a summary of it goes to the log.  Use the Python pstats
+# module to examine the files.  Under Unix and Linux you can also have
+# the replicator profile its next poll by sending it the signal
+# SIGUSR1.  A profiled poll runs on a single thread (whatever
+# replication_workers is), so that the profile covers all of it.
+# Profiling makes polls slower, so leave this as 0 unless you're
+# investigating a performance problem.
+profile_polls = 0
+
 
 # A. REFERENCES
 #
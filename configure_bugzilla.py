@@ -518,6 +518,8 @@ def make_p4_field_spec(bz_field,
 def configuration(config):
     # Check Bugzilla specific configuration parameters.
     check_config.check_string_or_none(config, 'bugzilla_directory')
+    check_config.check_bool(config, 'bugzilla_change_queue')
+    check_config.check_bool(config, 'bugzilla_transactions')
     check_config.check_host(config, 'dbms_host')
     check_config.check_int(config, 'dbms_port')
     check_config.check_string(config, 'dbms_database')
@@ -546,9 +548,13 @@ def configuration(config):
     if config.use_stdout_log:
         loggers.append(apply(logger.file_logger, (), log_params))
     # 2. to the file named by the log_file configuration parameter (if
-    # not None);
+    # not None), buffered if buffer_log_file is true;
     if config.log_file != None:
-        loggers.append(apply(logger.file_logger,
+        if config.buffer_log_file:
+            log_file_class = logger.buffered_file_logger
+        else:
+            log_file_class = logger.file_logger
+        loggers.append(apply(log_file_class,
                              (open(config.log_file, "a"),),
                              log_params))
     # 3. to the Windows event log (if use_windows_event_log is true).
@@ -586,13 +592,20 @@ def configuration(config):
 
     user_name_length = get_user_name_length(config)
 
+    # The user translators share one directory of users, so that the
+    # users are fetched and matched only once.
+    user_directory = dt_bugzilla.user_directory(config.replicator_address,
+                                                config.p4_user)
+
     # strict user translator doesn't allow unknown users
     strict_user_translator = dt_bugzilla.user_translator(
-        config.replicator_address, config.p4_user, allow_unknown = 0)
+        config.replicator_address, config.p4_user, allow_unknown = 0,
+        directory = user_directory)
 
     # lax user translator does allow unknown users
     lax_user_translator = dt_bugzilla.user_translator(
-        config.replicator_address, config.p4_user, allow_unknown = 1)
+        config.replicator_address, config.p4_user, allow_unknown = 1,
+        directory = user_directory)
 
     # p4_fields maps Bugzilla field name to the jobspec data (number,
     # name, type, length, dispositon, preset, values, help text,
@@ -750,6 +763,9 @@ def configuration(config):
         map(lambda item: (item[0], item[1][1], item[1][8]),
             filter(lambda item: item[1][8] != None, p4_fields.items()))
 
+    # Fetch bugs' long descriptions only if they are replicated.
+    config.bugzilla.load_longdesc = fields_bz_to_p4.has_key('longdesc')
+
     return config
 
 
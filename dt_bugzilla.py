@@ -89,6 +89,11 @@ class bugzilla_bug(dt_interface.defect_tracker_issue):
         assert isinstance(key, types.StringType)
         if self.bug.has_key(key):
             return self.bug[key]
+        elif key == 'longdesc':
+            # The long description is fetched with the bug only if it
+            # is replicated; see section 9.8 of bugzilla.py.
+            self.bug[key] = self.dt.bugzilla.bug_get_longdesc(self.bug)
+            return self.bug[key]
         else:
             return self.p4dti_bug[key]
 
@@ -97,7 +102,8 @@ class bugzilla_bug(dt_interface.defect_tracker_issue):
                      'p4dti':self.p4dti_bug})
 
     def has_key(self, key):
-        return self.bug.has_key(key) or self.p4dti_bug.has_key(key)
+        return (self.bug.has_key(key) or key == 'longdesc'
+                or self.p4dti_bug.has_key(key))
 
     def add_filespec(self, filespec):
         filespec_record = {}
@@ -156,6 +162,25 @@ class bugzilla_bug(dt_interface.defect_tracker_issue):
     def setup_for_replication(self, jobname):
         self.make_p4dti_bug(jobname, created=0)
 
+    # replicated_digest() returns the digest of the bug that the
+    # replicator recorded when it last replicated the bug, or None.
+    # set_replicated_digest(digest) records a new one.  Recording a
+    # digest changes only the p4dti_bugs record, so it doesn't make the
+    # bug look changed to the next poll.
+
+    def replicated_digest(self):
+        if self.p4dti_bug == None:
+            return None
+        return self.p4dti_bug.get('digest')
+
+    def set_replicated_digest(self, digest):
+        if (self.p4dti_bug == None
+            or self.p4dti_bug.get('digest') == digest):
+            return
+        self.dt.bugzilla.update_p4dti_bug({'digest': digest},
+                                          self.bug['bug_id'])
+        self.p4dti_bug['digest'] = digest
+
     # Check Bugzilla permissions.
     # 
     # In Bugzilla, permissions are mostly checked in
@@ -418,9 +443,8 @@ class bugzilla_bug(dt_interface.defect_tracker_issue):
                 raise error, catalog.msg(504, key)
             if key in self.dt.config.append_only_fields:
                 new = changes[key]
-                old = self.bug[key]
-                if (len(new) < len(old)
-                    or new[:len(old)] != old):
+                old = self[key]
+                if not new.startswith(old):
                     # "Can only append to Bugzilla field '%s'."
                     raise error, catalog.msg(505, key)
             if (key in ['reporter', 'assigned_to'] and
@@ -436,6 +460,9 @@ class bugzilla_bug(dt_interface.defect_tracker_issue):
 
         for key, value in changes.items():
             assert isinstance(key, types.StringType)
+            if key == 'longdesc':
+                # Make sure we have the long description to append to.
+                self[key]
             if self.bug.has_key(key):
                 changes_bug[key] = value
             elif self.p4dti_bug.has_key(key):
@@ -444,24 +471,37 @@ class bugzilla_bug(dt_interface.defect_tracker_issue):
                 # "Updating non-existent Bugzilla field '%s'."
                 raise error, catalog.msg(506, key)
 
-        self.restrict_fields(changes_bug)
-        self.enforce_invariants(changes_bug)
-        self.check_permissions(user, changes_bug)
-
-        self.dt.bugzilla.update_bug(changes_bug, self.bug, user)
-
-        # Add processmail script to pending queue.
-        self.dt.bugzilla.bugmail(self.bug['bug_id'], user)
-
-        # Now the bug is updated in the database, update our copy.
-        for key, value in changes_bug.items():
-            self.bug[key] = value
-
-        self.dt.bugzilla.update_p4dti_bug(changes_p4dti_bug,
-                                          self.bug['bug_id'])
-        # Now the p4dti_bug is updated in the database, update our copy.
-        for key, value in changes_p4dti_bug.items():
-            self.p4dti_bug[key] = value
+        bugzilla = self.dt.bugzilla
+        bugzilla.start_transaction()
+        try:
+            if bugzilla.lock_bug(self.bug):
+                # "Bug %d was changed in Bugzilla while the replicator
+                # was working on it."
+                raise dt_interface.conflict, \
+                      catalog.msg(557, self.bug['bug_id'])
+            self.restrict_fields(changes_bug)
+            self.enforce_invariants(changes_bug)
+            self.check_permissions(user, changes_bug)
+
+            bugzilla.update_bug(changes_bug, self.bug, user)
+
+            # Add processmail script to pending queue.
+            bugzilla.bugmail(self.bug['bug_id'], user)
+
+            # Now the bug is updated in the database, update our copy.
+            for key, value in changes_bug.items():
+                self.bug[key] = value
+
+            bugzilla.update_p4dti_bug(changes_p4dti_bug,
+                                      self.bug['bug_id'])
+            # Now the p4dti_bug is updated in the database, update our
+            # copy.
+            for key, value in changes_p4dti_bug.items():
+                self.p4dti_bug[key] = value
+        except:
+            bugzilla.rollback_transaction()
+            raise
+        bugzilla.commit_transaction()
 
     # Delete this bug.
     def delete(self):
@@ -594,6 +634,12 @@ class dt_bugzilla(dt_interface.defect_tracker):
         bugs = self.bugzilla.all_bugs_since(self.config.start_date)
         return map(lambda bug,dt=self: bugzilla_bug(bug,dt), bugs)
 
+    # set_metrics(metrics).  Record database statistics in the metrics
+    # object (see metrics.py).
+
+    def set_metrics(self, metrics):
+        self.bugzilla.metrics = metrics
+
     def poll_start(self):
         self.bugzilla.lock_tables()
         self.cached_users = 0
@@ -606,7 +652,7 @@ class dt_bugzilla(dt_interface.defect_tracker):
     def changed_entities(self):
         replication = self.bugzilla.new_replication()
         last = self.bugzilla.latest_complete_replication()
-        bugs = self.bugzilla.changed_bugs_since(last)
+        bugs = self.bugzilla.changed_bugs(last)
         return (map(lambda bug,dt=self: bugzilla_bug(bug,dt), bugs),
                 {}, # changed changelists
                 replication)
@@ -614,6 +660,28 @@ class dt_bugzilla(dt_interface.defect_tracker):
     def mark_changes_done(self, replication):
         self.bugzilla.end_replication()
 
+    # changes_pending().  Return true if there may be bugs to replicate
+    # (see replicator.changes_pending).
+
+    def changes_pending(self):
+        last = self.bugzilla.latest_complete_replication()
+        pending = self.bugzilla.changes_in_queue(last)
+        if pending != None:
+            return pending
+        return self.bugzilla.changed_since(last)
+
+    # wakeup_pending().  Return 1 if there are changes in the change
+    # queue that we haven't seen, 0 if not, or None if we aren't using
+    # the change queue (see replicator.wait_for_wakeup).  This is how
+    # Bugzilla wakes the replicator: the change queue triggers record
+    # every change to a bug.
+
+    def wakeup_pending(self):
+        if not self.bugzilla.change_queue:
+            return None
+        last = self.bugzilla.latest_complete_replication()
+        return self.bugzilla.changes_in_queue(last)
+
     def init(self):
         # ensure that bugzilla.replication is valid even outside a
         # replication cycle, so that all_issues() works.  See
@@ -1249,45 +1317,26 @@ class int_translator(translator.translator):
 # To distinguish between these two cases, we have a switch
 # 'allow_unknown'.  If allow_unknown is 1, we use the default
 # translation.  If allow_unknown is 0, we report an error.
-
-class user_translator(translator.user_translator):
-    # A map from Bugzilla user ids to Perforce user names
-    user_bz_to_p4 = {}
-
-    # A map from Perforce user names to Bugzilla user ids
-    user_p4_to_bz = {}
-
-    # A map from Bugzilla user ids to (downcased) email addresses
-    bz_id_to_email = None
-
-    # A map from (downcased) email addresses to Bugzilla user ids
-    bz_email_to_id = None
-
-    # A map from (downcased) email addresses to Perforce user names
-    p4_email_to_user = None
-
-    # A map from Perforce user names to (downcased) email addresses
-    p4_user_to_email = None
-
-    # A map from Perforce user names to Perforce full names.
-    p4_user_to_fullname = None
-
-    # A map from Perforce user name to email address for users with
-    # duplicate email addresses in Perforce.
-    p4_duplicates = None
-
-    # A map from Bugzilla user id to email address for users with
-    # duplicate (downcased) email addresses in Bugzilla.
-    bz_duplicates = None
-
-    # A map from Perforce user name to email address for Perforce
-    # users that can't be matched with users in Bugzilla.
-    p4_unmatched = None
-
-    # A map from Bugzilla user real name to email address for Bugzilla
-    # users that can't be matched with users in Perforce.
-    bz_unmatched = None
-
+#
+# The user directory holds the maps between Bugzilla users and Perforce
+# users that the user translators need.  There is one user directory,
+# shared by all the user translators (configure_bugzilla.py makes a
+# strict one and a lax one), and it is kept up to date incrementally:
+# each time it is synchronized (at most once a poll, when a user needs
+# translating), it fetches the Perforce users and compares them with
+# the ones it has (by e-mail address, full name, and the time the
+# user record was updated), and it checks whether the Bugzilla
+# profiles table has changed (see bugzilla.clear_caches) and if so
+# compares the Bugzilla users.  Only the users whose e-mail addresses
+# are affected by the differences are matched again, and only they are
+# logged.
+#
+# Users are matched by e-mail address (converted to lower case).  If
+# several Perforce users or several Bugzilla users have the same
+# address, the first in sorted order is matched and the others are
+# unmatched duplicates.
+
+class user_directory:
     # The Bugzilla P4DTI user email address (config.replicator_address)
     bugzilla_user = None
 
@@ -1297,56 +1346,275 @@ class user_translator(translator.user_translator):
     # The Perforce P4DTI user name (config.p4_user)
     p4_user = None
 
-    # A switch controlling whether this translator will translate
-    # Perforce users without corresponding Bugzilla users into
-    # the Bugzilla P4DTI user id.
-    allow_unknown = 0
-
-    tables_populated = 0
-
-    def __init__(self, bugzilla_user, p4_user,
-                 allow_unknown = 0):
+    def __init__(self, bugzilla_user, p4_user):
         self.bugzilla_user = string.lower(bugzilla_user)
         self.p4_user = p4_user
-        self.allow_unknown = allow_unknown
+        self.clear()
+
+    def clear(self):
+        # A map from Perforce user names to triples (e-mail address,
+        # full name, update time) as reported by "p4 users".
+        self.p4_users = {}
+
+        # A map from (downcased) email addresses to sorted lists of
+        # Perforce user names, and to sorted lists of Bugzilla user
+        # ids.
+        self.p4_users_by_email = {}
+        self.bz_ids_by_email = {}
+
+        # The Bugzilla users map (see bugzilla.users) and its size when
+        # we last compared it.  It's the same object until the profiles
+        # table changes.
+        self.bz_users = None
+        self.bz_users_count = 0
+
+        # A map from Bugzilla user ids to Perforce user names
+        self.user_bz_to_p4 = {}
 
-    # Deduce and record the mapping between Bugzilla userid and
-    # Perforce username.
-    def init_users(self, bz, p4):
+        # A map from Perforce user names to Bugzilla user ids
+        self.user_p4_to_bz = {}
 
-        if self.tables_populated and bz.cached_users:
-            return
+        # A map from Bugzilla user ids to (downcased) email addresses
+        self.bz_id_to_email = {}
 
-        # Clear the maps.
-        self.user_bz_to_p4 = {}
-        self.user_p4_to_bz = {}
+        # A map from (downcased) email addresses to Bugzilla user ids
         self.bz_email_to_id = {}
-        self.bz_id_to_email = {}
+
+        # A map from (downcased) email addresses to Perforce user names
         self.p4_email_to_user = {}
+
+        # A map from Perforce user names to (downcased) email addresses
         self.p4_user_to_email = {}
+
+        # A map from Perforce user names to Perforce full names.
+        self.p4_user_to_fullname = {}
+
+        # A map from Perforce user name to email address for users with
+        # duplicate email addresses in Perforce.
         self.p4_duplicates = {}
+
+        # A map from Bugzilla user id to email address for users with
+        # duplicate (downcased) email addresses in Bugzilla.
         self.bz_duplicates = {}
+
+        # A map from Perforce user name to email address for Perforce
+        # users that can't be matched with users in Bugzilla.
         self.p4_unmatched = {}
+
+        # A map from Bugzilla user id to email address for Bugzilla
+        # users that can't be matched with users in Perforce.
         self.bz_unmatched = {}
-        self.p4_user_to_fullname = {}
 
-        # Populate the Perforce-side maps.
-        p4_users = p4.p4.run("users")
-        for u in p4_users:
-            email = string.lower(u['Email'])
-            user = u['User']
-            self.p4_user_to_fullname[user] = u['FullName']
-            self.p4_user_to_email[user] = email
-            if self.p4_email_to_user.has_key(email):
-                matching_user = self.p4_email_to_user[email]
+    # sync(bz, p4).  Bring the directory up to date with the users in
+    # Perforce and Bugzilla.  If the users are misconfigured, raise an
+    # error and start again from scratch next time.
+
+    def sync(self, bz, p4):
+        try:
+            self.sync_users(bz, p4)
+        except:
+            self.clear()
+            raise
+        bz.cached_users = 1
+
+    def sync_users(self, bz, p4):
+        # E-mail addresses whose users need matching again.
+        emails = {}
+
+        # Compare the Perforce users.
+        p4_users = {}
+        for u in p4.p4.run("users"):
+            p4_users[u['User']] = (string.lower(u['Email']),
+                                   u['FullName'], u.get('Update'))
+        p4_changed = 0
+        for user, record in p4_users.items():
+            old = self.p4_users.get(user)
+            if old != record:
+                if old:
+                    self.remove_p4_user(user, emails)
+                self.add_p4_user(user, record, emails)
+                p4_changed = p4_changed + 1
+        for user in self.p4_users.keys():
+            if not p4_users.has_key(user):
+                self.remove_p4_user(user, emails)
+                p4_changed = p4_changed + 1
+
+        # Compare the Bugzilla users, if the profiles table might have
+        # changed.
+        bz_changed = 0
+        bz_users = bz.bugzilla.users()
+        if (bz_users is not self.bz_users
+            or len(bz_users) != self.bz_users_count):
+            bz_emails = {}
+            for (id, email) in bz.bugzilla.user_id_and_email_list():
+                bz_emails[id] = string.lower(email)
+            for id, email in bz_emails.items():
+                old = self.bz_id_to_email.get(id)
+                if old != email:
+                    if old != None:
+                        self.remove_bz_user(id, emails)
+                    self.add_bz_user(id, email, emails)
+                    bz_changed = bz_changed + 1
+            for id in self.bz_id_to_email.keys():
+                if not bz_emails.has_key(id):
+                    self.remove_bz_user(id, emails)
+                    bz_changed = bz_changed + 1
+            self.bz_users = bz_users
+            self.bz_users_count = len(bz_users)
+
+        if not emails:
+            return
+        # "Synchronizing users: %d Perforce users and %d Bugzilla users
+        # have changed."
+        bz.log(558, (p4_changed, bz_changed))
+
+        # Forget the matches for the affected users, then match them
+        # again.
+        for email in emails.keys():
+            for user in emails[email][0]:
+                self.unmatch_p4_user(user)
+            for id in emails[email][1]:
+                self.unmatch_bz_user(id)
+        emails = emails.keys()
+        emails.sort()
+        for email in emails:
+            self.match_email(bz, email)
+        self.check_replicator_users()
+
+        # always translate 0 to 'None' and back again
+        self.user_p4_to_bz['None'] = 0
+        self.user_bz_to_p4[0] = 'None'
+
+    # The following methods add and remove users from the base maps,
+    # and record in the emails argument (a map from e-mail address to a
+    # pair of maps of affected Perforce users and Bugzilla user ids) the
+    # users whose matches need to be forgotten.
+
+    def affect(self, emails, email):
+        if not emails.has_key(email):
+            emails[email] = ({}, {})
+            for user in self.p4_users_by_email.get(email, []):
+                emails[email][0][user] = 1
+            for id in self.bz_ids_by_email.get(email, []):
+                emails[email][1][id] = 1
+        return emails[email]
+
+    def add_p4_user(self, user, record, emails):
+        email = record[0]
+        self.affect(emails, email)[0][user] = 1
+        self.p4_users[user] = record
+        self.p4_user_to_email[user] = email
+        self.p4_user_to_fullname[user] = record[1]
+        users = self.p4_users_by_email.setdefault(email, [])
+        users.append(user)
+        users.sort()
+
+    def remove_p4_user(self, user, emails):
+        email = self.p4_users[user][0]
+        self.affect(emails, email)[0][user] = 1
+        del self.p4_users[user]
+        del self.p4_user_to_email[user]
+        del self.p4_user_to_fullname[user]
+        self.p4_users_by_email[email].remove(user)
+        if not self.p4_users_by_email[email]:
+            del self.p4_users_by_email[email]
+
+    def add_bz_user(self, id, email, emails):
+        self.affect(emails, email)[1][id] = 1
+        self.bz_id_to_email[id] = email
+        ids = self.bz_ids_by_email.setdefault(email, [])
+        ids.append(id)
+        ids.sort()
+
+    def remove_bz_user(self, id, emails):
+        email = self.bz_id_to_email[id]
+        self.affect(emails, email)[1][id] = 1
+        del self.bz_id_to_email[id]
+        self.bz_ids_by_email[email].remove(id)
+        if not self.bz_ids_by_email[email]:
+            del self.bz_ids_by_email[email]
+
+    def unmatch_p4_user(self, user):
+        id = self.user_p4_to_bz.get(user)
+        if id != None:
+            del self.user_p4_to_bz[user]
+            if self.user_bz_to_p4.get(id) == user:
+                del self.user_bz_to_p4[id]
+        for map in [self.p4_duplicates, self.p4_unmatched]:
+            if map.has_key(user):
+                del map[user]
+
+    def unmatch_bz_user(self, id):
+        user = self.user_bz_to_p4.get(id)
+        if user != None:
+            del self.user_bz_to_p4[id]
+            if self.user_p4_to_bz.get(user) == id:
+                del self.user_p4_to_bz[user]
+        for map in [self.bz_duplicates, self.bz_unmatched]:
+            if map.has_key(id):
+                del map[id]
+
+    # match_email(bz, email).  Match the Perforce users and Bugzilla
+    # users with the given e-mail address.
+
+    def match_email(self, bz, email):
+        users = self.p4_users_by_email.get(email, [])
+        ids = self.bz_ids_by_email.get(email, [])
+        real_name = bz.bugzilla.real_name_from_userid
+
+        if users:
+            self.p4_email_to_user[email] = users[0]
+            for user in users[1:]:
                 # "Perforce users '%s' and '%s' both have email address
                 # '%s' (when converted to lower case)."
-                bz.log(541, (user, matching_user, email))
-                self.p4_duplicates[matching_user] = email
-                self.p4_duplicates[user] = email
-            else:
-                self.p4_email_to_user[email] = user
+                bz.log(541, (user, users[0], email))
+            if len(users) > 1:
+                for user in users:
+                    self.p4_duplicates[user] = email
+        elif self.p4_email_to_user.has_key(email):
+            del self.p4_email_to_user[email]
+
+        if ids:
+            self.bz_email_to_id[email] = ids[0]
+            for id in ids[1:]:
+                # "Bugzilla users '%s' and '%s' both have email address
+                # '%s' (when converted to lower case)."
+                bz.log(544, (real_name(id), real_name(ids[0]), email))
+            if len(ids) > 1:
+                for id in ids:
+                    self.bz_duplicates[id] = email
+        elif self.bz_email_to_id.has_key(email):
+            del self.bz_email_to_id[email]
+
+        if users and ids:
+            self.user_bz_to_p4[ids[0]] = users[0]
+            self.user_p4_to_bz[users[0]] = ids[0]
+            # "Bugzilla user %d matched to Perforce user '%s' by
+            # e-mail address '%s'."
+            bz.log(547, (ids[0], users[0], email))
+            for id in ids[1:]:
+                self.bz_unmatched[id] = email
+                # "Bugzilla user '%s' (e-mail address '%s') not
+                # matched to any Perforce user, because Perforce
+                # user '%s' already matched to Bugzilla user %d."
+                bz.log(546, (real_name(id), email, users[0], ids[0]))
+            users = users[1:]
+        else:
+            for id in ids:
+                self.bz_unmatched[id] = email
+                # "Bugzilla user '%s' (e-mail address '%s') not matched
+                # to any Perforce user."
+                bz.log(548, (real_name(id), email))
+        for user in users:
+            self.p4_unmatched[user] = email
+            # "Perforce user '%s' (e-mail address '%s') not matched
+            # to any Bugzilla user."
+            bz.log(549, (user, email))
+
+    # check_replicator_users().  Check that the Bugzilla P4DTI user and
+    # the Perforce P4DTI user exist, are unique, and correspond.
 
+    def check_replicator_users(self):
         # Check the Perforce P4DTI user exists:
         if not self.p4_user_to_email.has_key(self.p4_user):
             # "Perforce P4DTI user '%s' is not a known Perforce user."
@@ -1356,10 +1624,8 @@ class user_translator(translator.user_translator):
 
         # Check that the Perforce P4DTI user has a unique email address:
         if self.p4_duplicates.has_key(self.p4_user):
-            duplicate_users = []
-            for (user, email) in self.p4_duplicates.items():
-                if email == p4_email and user != self.p4_user:
-                    duplicate_users.append(user)
+            duplicate_users = self.p4_users_by_email[p4_email][:]
+            duplicate_users.remove(self.p4_user)
             # "Perforce P4DTI user '%s' has the same e-mail address
             # '%s' as these other Perforce users: %s."
             raise error, catalog.msg(543,
@@ -1367,30 +1633,8 @@ class user_translator(translator.user_translator):
                                       p4_email,
                                       duplicate_users))
 
-        # Make a list of all the user ids matching the Bugzilla P4DTI user.
-        bugzilla_ids = []
-
-        # Populate the Bugzilla-side maps.
-        bz_users = bz.bugzilla.user_id_and_email_list()
-        for (id, email) in bz_users:
-            email = string.lower(email)
-            self.bz_id_to_email[id] = email
-            # Collect ids matching the Bugzilla P4DTI user
-            if email == self.bugzilla_user:
-                bugzilla_ids.append(id)
-            if self.bz_email_to_id.has_key(email):
-                matching_id = self.bz_email_to_id[email]
-                bz_real_name = bz.bugzilla.real_name_from_userid(id)
-                matching_real_name = bz.bugzilla.real_name_from_userid(matching_id)
-                # "Bugzilla users '%s' and '%s' both have email address
-                # '%s' (when converted to lower case)."
-                bz.log(544, (bz_real_name, matching_real_name, email))
-                self.bz_duplicates[bz_real_name] = email
-                self.bz_duplicates[matching_real_name] = email
-            else:
-                self.bz_email_to_id[email] = id
-
         # Check that the Bugzilla P4DTI user exists:
+        bugzilla_ids = self.bz_ids_by_email.get(self.bugzilla_user, [])
         if len(bugzilla_ids) == 0:
             # "Bugzilla P4DTI user '%s' is not a known Bugzilla user."
             raise error, catalog.msg(513, self.bugzilla_user)
@@ -1404,50 +1648,6 @@ class user_translator(translator.user_translator):
         # There can be only one.
         self.bugzilla_id = bugzilla_ids[0]
 
-        # The Perforce-specific and Bugzilla-specific maps are now
-        # complete.  Note that the p4_user_to_email map and the
-        # bz_id_to_email map may have duplicate values (in which case
-        # the keys in the inverse maps are the first-seen
-        # corresponding keys).
-
-        # Populate the translation maps.
-        # We could do this at the same time as one of the previous phases,
-        # but IMO it's cleaner to separate it out like this.
-
-        for (id, email) in self.bz_id_to_email.items():
-            if self.p4_email_to_user.has_key(email):
-                p4_user = self.p4_email_to_user[email]
-                # Already matched?
-                if self.user_p4_to_bz.has_key(p4_user):
-                    matching_id = self.user_p4_to_bz[p4_user]
-                    bz_real_name = bz.bugzilla.real_name_from_userid(id)
-                    self.bz_unmatched[bz_real_name] = email
-                    # "Bugzilla user '%s' (e-mail address '%s') not
-                    # matched to any Perforce user, because Perforce
-                    # user '%s' already matched to Bugzilla user %d."
-                    bz.log(546,
-                           (bz_real_name, email, p4_user, matching_id))
-                else:
-                    self.user_bz_to_p4[id] = p4_user
-                    self.user_p4_to_bz[p4_user] = id
-                    # "Bugzilla user %d matched to Perforce user '%s' by
-                    # e-mail address '%s'."
-                    bz.log(547, (id, p4_user, email))
-            else:
-                bz_real_name = bz.bugzilla.real_name_from_userid(id)
-                self.bz_unmatched[bz_real_name] = email
-                # "Bugzilla user '%s' (e-mail address '%s') not matched
-                # to any Perforce user."
-                bz.log(548, (bz_real_name, email))
-
-        # Identify unmatched Perforce users.
-        for (user, email) in self.p4_user_to_email.items():
-            if not self.user_p4_to_bz.has_key(user):
-                self.p4_unmatched[user] = email
-                # "Perforce user '%s' (e-mail address '%s') not matched
-                # to any Bugzilla user."
-                bz.log(549, (user, email))
-
         # Ensure that Bugzilla P4DTI user and Perforce P4DTI user
         # correspond.
         if self.user_bz_to_p4.has_key(self.bugzilla_id):
@@ -1482,14 +1682,58 @@ class user_translator(translator.user_translator):
                                                self.p4_user,
                                                p4_email))
 
-        # always translate 0 to 'None' and back again
-        self.user_p4_to_bz['None'] = 0
-        self.user_bz_to_p4[0] = 'None'
-        self.tables_populated = 1
-        bz.cached_users = 1
+    # real_name_map(bz, map).  Return a copy of a map from Bugzilla
+    # user id to e-mail address, keyed by the users' real names.
+
+    def real_name_map(self, bz, map):
+        result = {}
+        for id, email in map.items():
+            result[bz.bugzilla.real_name_from_userid(id)] = email
+        return result
+
+
+class user_translator(translator.user_translator):
+    # The user directory (shared with other user translators).
+    directory = None
+
+    # The Bugzilla P4DTI user email address (config.replicator_address)
+    bugzilla_user = None
+
+    # The Perforce P4DTI user name (config.p4_user)
+    p4_user = None
+
+    # A switch controlling whether this translator will translate
+    # Perforce users without corresponding Bugzilla users into
+    # the Bugzilla P4DTI user id.
+    allow_unknown = 0
+
+    def __init__(self, bugzilla_user, p4_user,
+                 allow_unknown = 0, directory = None):
+        self.bugzilla_user = string.lower(bugzilla_user)
+        self.p4_user = p4_user
+        self.allow_unknown = allow_unknown
+        if directory == None:
+            directory = user_directory(bugzilla_user, p4_user)
+        self.directory = directory
+
+    # The Bugzilla P4DTI user id.  The directory finds it when it is
+    # synchronized, so this is only valid after a translation.
+
+    def __getattr__(self, name):
+        if name == 'bugzilla_id':
+            return self.directory.bugzilla_id
+        raise AttributeError, name
+
+    # Deduce and record the mapping between Bugzilla userid and
+    # Perforce username.
+    def init_users(self, bz, p4):
+        if bz.cached_users:
+            return
+        self.directory.sync(bz, p4)
 
     def unmatched_users(self, bz, p4):
         self.init_users(bz, p4)
+        d = self.directory
         # "A user field containing one of these users will be translated
         # to the user's e-mail address in the corresponding Perforce job
         # field."
@@ -1505,36 +1749,37 @@ class user_translator(translator.user_translator):
         # converted to lower case).  They may have been matched with
         # the wrong Perforce user."
         duplicate_bz_user_msg = catalog.msg(552)
-        return (self.bz_unmatched, self.p4_unmatched,
+        return (d.real_name_map(bz, d.bz_unmatched), d.p4_unmatched.copy(),
                 bz_user_msg, p4_user_msg,
-                self.bz_duplicates, self.p4_duplicates,
+                d.real_name_map(bz, d.bz_duplicates), d.p4_duplicates.copy(),
                 duplicate_bz_user_msg, duplicate_p4_user_msg)
 
     keyword = translator.keyword_translator()
 
     def translate_1_to_0(self, p4_user, bz, p4, issue=None, job=None):
-        if not self.user_p4_to_bz.has_key(p4_user):
+        d = self.directory
+        if not d.user_p4_to_bz.has_key(p4_user):
             self.init_users(bz, p4)
-        if self.user_p4_to_bz.has_key(p4_user):
-            return self.user_p4_to_bz[p4_user]
+        if d.user_p4_to_bz.has_key(p4_user):
+            return d.user_p4_to_bz[p4_user]
         else:
             bz_email = self.keyword.translate_1_to_0(p4_user)
-            if self.bz_email_to_id.has_key(bz_email):
-                return self.bz_email_to_id[bz_email]
+            if d.bz_email_to_id.has_key(bz_email):
+                return d.bz_email_to_id[bz_email]
             elif self.allow_unknown:
-                return self.bugzilla_id
+                return d.bugzilla_id
             else:
                 # "There is no Bugzilla user corresponding to Perforce
                 # user '%s'."
                 raise error, catalog.msg(514, p4_user)
 
     def translate_0_to_1(self, bz_user, bz, p4, issue=None, job=None):
-        if not bz.cached_users:
-            self.init_users(bz, p4)
-        if self.user_bz_to_p4.has_key(bz_user):
-            return self.user_bz_to_p4[bz_user]
+        self.init_users(bz, p4)
+        d = self.directory
+        if d.user_bz_to_p4.has_key(bz_user):
+            return d.user_bz_to_p4[bz_user]
         else:
-            bz_email = self.bz_id_to_email[bz_user]
+            bz_email = d.bz_id_to_email[bz_user]
             return self.keyword.translate_0_to_1(bz_email)
 
 
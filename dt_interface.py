@@ -74,6 +74,18 @@ class defect_tracker_filespec:
     pass
 
 
+# 6. CONFLICT EXCEPTION
+#
+# A defect tracker issue's update() method raises conflict if someone
+# else changed the issue after the replicator read it, and the update
+# was therefore not made.  The replicator leaves the job alone and
+# tries again in the next poll, treating both the issue and the job as
+# changed, so that the conflict resolution policy decides what to do.
+
+class conflict(Exception):
+    pass
+
+
 # A. REFERENCES
 #
 # [GDR 2000-10-16] "Perforce Defect Tracking Integration Integrator's
@@ -54,6 +54,9 @@ error = "P4DTI Initialization error"
 # won't break.  See job000347.
 
 default_parameters = {
+    'bugzilla_change_queue': 0,
+    'bugzilla_transactions': 0,
+    'buffer_log_file': 0,
     'configure_name': config.dt_name,
     'field_names': [],
     'job_url': None,
@@ -61,17 +64,22 @@ default_parameters = {
     'log_max_message_length': 10000,
     'migrate_p': lambda job: 0,
     'migrated_user_groups': [],
+    'metrics_file': None,
     'migrated_user_password': 'password',
     'omitted_fields': [],
     'p4_config_file': '',
     'prepare_issue': lambda dict, job: None,
+    'profile_polls': 0,
     'replicate_job_p': lambda job: 0,
+    'replication_workers': 1,
     'translate_jobspec': lambda job: job,
     'use_deleted_selections': 1,
     'use_perforce_jobnames': 0,
     'use_stdout_log': 1,
     'use_windows_event_log': 0,
     'use_system_log': 1,
+    'wakeup_socket': None,
+    'wakeup_socket_mode': 0660,
     }
 for k, v in default_parameters.items():
     if not hasattr(config, k):
@@ -87,12 +95,14 @@ if config.administrator_address != None:
     check_config.check_email(config, 'administrator_address')
 check_config.check_changelist_url(config, 'changelist_url')
 check_config.check_string_or_none(config, 'closed_state')
+check_config.check_bool(config, 'buffer_log_file')
 check_config.check_string(config, 'configure_name')
 check_config.check_string_or_none(config, 'log_file')
 check_config.check_job_url(config, 'job_url')
 check_config.check_bool(config, 'keep_jobspec')
 check_config.check_int(config, 'log_level')
 check_config.check_int(config, 'log_max_message_length')
+check_config.check_string_or_none(config, 'metrics_file')
 check_config.check_function(config, 'migrate_p')
 check_config.check_string(config, 'p4_client_executable')
 check_config.check_string(config, 'p4_port')
@@ -101,8 +111,10 @@ check_config.check_string(config, 'p4_password')
 check_config.check_string(config, 'p4_server_description')
 check_config.check_int(config, 'poll_period')
 check_config.check_function(config, 'prepare_issue')
+check_config.check_int(config, 'profile_polls')
 check_config.check_function(config, 'replicate_job_p')
 check_config.check_function(config, 'replicate_p')
+check_config.check_positive_int(config, 'replication_workers')
 check_config.check_email(config, 'replicator_address')
 check_config.check_identifier(config, 'rid')
 check_config.check_identifier(config, 'sid')
@@ -117,6 +129,8 @@ if os.name == 'nt':
 check_config.check_bool(config, 'use_stdout_log')
 if os.name == 'posix':
     check_config.check_bool(config, 'use_system_log')
+check_config.check_string_or_none(config, 'wakeup_socket')
+check_config.check_int(config, 'wakeup_socket_mode')
 
 
 # 3. CALL THE CONFIGURATION GENERATOR; MAKE A DEFECT TRACKER INTERFACE
@@ -30,10 +30,14 @@
 #
 # This document is not confidential.
 
+import atexit
 import catalog
 import message
 import os
+import Queue
+import string
 import sys
+import threading
 import time
 import types
 
@@ -70,10 +74,17 @@ class logger:
     #
     # Truncate message to max_length to avoid very large log messages
     # causing the Windows event log or Linux system log to crash.
+    #
+    # The text argument to this and the following methods, if not None,
+    # is str(msg), already computed by the caller.  The multi_logger
+    # (section 5) uses it so that a message written to several logs is
+    # only converted to a string once.
 
-    def stringify_message(self, msg):
+    def stringify_message(self, msg, text = None):
         assert isinstance(msg, message.message)
-        return str(msg)[0:self.max_length]
+        if text == None:
+            text = str(msg)
+        return text[0:self.max_length]
 
 
     # 2.2. Format a message with date
@@ -87,11 +98,11 @@ class logger:
     # logging methods record the date (in particular, file_logger
     # doesn't).
 
-    def format_with_date(self, msg):
+    def format_with_date(self, msg, text = None):
         assert isinstance(msg, message.message)
         date = time.strftime('%Y-%m-%d %H:%M:%S UTC',
                              time.gmtime(time.time()))
-        return "%s  %s" % (date, self.stringify_message(msg))
+        return "%s  %s" % (date, self.stringify_message(msg, text))
 
 
     # 2.3. Maybe log a message
@@ -99,12 +110,12 @@ class logger:
     # maybe_log(msg).  Write the message to the log (using the write()
     # method), but only if its priority is higher than self.priority.
 
-    def maybe_log(self, msg):
+    def maybe_log(self, msg, text = None):
         assert isinstance(msg, message.message)
         # Higher priorities have lower numbers, hence the sense of
         # this test.
         if msg.priority <= self.priority:
-            self.write(msg)
+            self.write(msg, text)
 
 
     # 2.4. Write a message to the log
@@ -113,7 +124,7 @@ class logger:
     # implementation in the logger class (it's an abstract class).
     # Subclasses should provide the appopriate mechanism.
 
-    def write(self, msg):
+    def write(self, msg, text = None):
         assert isinstance(msg, message.message)
         # logger is an abstract class; no implementation of write().
         assert 0
@@ -126,10 +137,10 @@ class logger:
     # this method in a subclass unless you support identical error
     # handling.  Override the maybe_log method instead.
 
-    def log(self, msg):
+    def log(self, msg, text = None):
         assert isinstance(msg, message.message)
         try:
-            self.maybe_log(msg)
+            self.maybe_log(msg, text)
         except:
             type, value = sys.exc_info()[:2]
             self.advise_failed('%s: %s' % (type, value))
@@ -182,6 +193,16 @@ class logger:
         return catalog.msg(1018, self)
 
 
+    # 2.9. Will a message be logged?
+    #
+    # logs(priority).  Return true if a message with this priority
+    # would be written to the log.  Callers use this to avoid building
+    # messages that would be thrown away (see section 2.3).
+
+    def logs(self, priority):
+        return priority <= self.priority
+
+
 # 3. FILE LOGGER CLASS
 #
 # This subclass of logger appends messages to a file stream, or to the
@@ -200,10 +221,11 @@ class file_logger(logger):
         logger.__init__(self, priority, max_length)
         self.file = file
 
-    def write(self, msg):
+    def write(self, msg, text = None):
         assert isinstance(msg, message.message)
-        self.file.write(self.format_with_date(msg))
-        self.file.write('\n')
+        # Write the line in one go so that messages logged by
+        # different threads aren't interleaved.
+        self.file.write(self.format_with_date(msg, text) + '\n')
         self.file.flush()
 
     def failure_context(self):
@@ -217,6 +239,147 @@ class file_logger(logger):
             return catalog.msg(1018, destination)
 
 
+# 3.1. Buffered file logger class
+#
+# This subclass of file_logger hands each formatted line to a
+# background writer thread through a bounded queue, so that logging
+# doesn't wait for the file.  The writer thread writes lines in
+# batches, and flushes the file when it has flush_size characters
+# waiting, when the oldest waiting line is flush_period seconds old,
+# and when the logger is closed (which happens automatically when the
+# program exits).
+#
+# A message with priority ERR or higher is always flushed to the file
+# before write() returns, so that the log shows what went wrong even if
+# the program then crashes.  If the queue is full, write() waits for
+# the writer thread to make room.
+#
+# write() never waits more than write_timeout seconds for the writer
+# thread.  If the writer thread has stopped (or is stuck), or the
+# logger has been closed, write() writes the line to the file itself,
+# so that a dead writer thread can't hang the program or lose an
+# error message.  (If the writer thread was merely slow, the line may
+# then appear twice.)
+#
+# An error in the writer thread is raised by the next call to write()
+# so that it is handled by the usual log failure mechanism (sections
+# 2.6 and 2.7).
+
+class buffered_file_logger(file_logger):
+    # Flush after this many seconds, or when this many characters are
+    # waiting to be written.
+    flush_period = 1.0
+    flush_size = 65536
+
+    # Maximum number of lines waiting in the queue.
+    queue_size = 10000
+
+    # Maximum number of seconds write() waits for the writer thread.
+    write_timeout = 10
+
+    def __init__(self, file = sys.stdout, priority = message.INFO,
+                 max_length = 10000):
+        file_logger.__init__(self, file, priority, max_length)
+        self.queue = Queue.Queue(self.queue_size)
+        self.writer_error = None
+        self.closed = 0
+        self.writer = threading.Thread(target = self.run_writer)
+        self.writer.setDaemon(1)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def write(self, msg, text = None):
+        assert isinstance(msg, message.message)
+        self.raise_writer_error()
+        if self.closed or not self.writer.isAlive():
+            file_logger.write(self, msg, text)
+            return
+        line = self.format_with_date(msg, text) + '\n'
+        if msg.priority <= message.ERR:
+            flushed = threading.Event()
+        else:
+            flushed = None
+        try:
+            self.queue.put((line, flushed), 1, self.write_timeout)
+        except Queue.Full:
+            file_logger.write(self, msg, text)
+            return
+        if flushed:
+            flushed.wait(self.write_timeout)
+            if not flushed.isSet():
+                file_logger.write(self, msg, text)
+            self.raise_writer_error()
+
+    def raise_writer_error(self):
+        if self.writer_error:
+            (type, value) = self.writer_error
+            self.writer_error = None
+            raise type, value
+
+    # close() flushes the lines waiting in the queue and stops the
+    # writer thread.
+
+    def close(self):
+        if not self.closed:
+            self.closed = 1
+            if not self.writer.isAlive():
+                return
+            flushed = threading.Event()
+            try:
+                self.queue.put((None, flushed), 1, self.write_timeout)
+            except Queue.Full:
+                return
+            flushed.wait(self.write_timeout)
+
+    # run_writer() is the body of the writer thread.  Lines accumulate
+    # in pending until it is time to write them.  Events in waiting
+    # are set after the next flush.
+
+    def run_writer(self):
+        pending = []
+        pending_size = 0
+        waiting = []
+        deadline = None
+        stop = 0
+        while not stop:
+            try:
+                if deadline == None:
+                    item = self.queue.get()
+                else:
+                    timeout = deadline - time.time()
+                    if timeout > 0:
+                        item = self.queue.get(1, timeout)
+                    else:
+                        item = self.queue.get_nowait()
+            except Queue.Empty:
+                item = None
+            if item:
+                (line, flushed) = item
+                if line == None:
+                    stop = 1
+                else:
+                    if not pending:
+                        deadline = time.time() + self.flush_period
+                    pending.append(line)
+                    pending_size = pending_size + len(line)
+                if flushed:
+                    waiting.append(flushed)
+            if (waiting or stop or pending_size >= self.flush_size
+                or (deadline != None and time.time() >= deadline)):
+                try:
+                    if pending:
+                        self.file.write(string.join(pending, ''))
+                    self.file.flush()
+                except:
+                    self.writer_error = sys.exc_info()[:2]
+                pending = []
+                pending_size = 0
+                deadline = None
+                for flushed in waiting:
+                    flushed.set()
+                waiting = []
+
+
 # 4. SYSTEM LOGGER CLASS
 #
 # This subclass of logger logs messages to the system log on Unix (using
@@ -240,9 +403,9 @@ class sys_logger(logger):
     # method because we use syslog's logmask feature instead of
     # checking the priority ourselves.
 
-    def maybe_log(self, msg):
+    def maybe_log(self, msg, text = None):
         assert isinstance(msg, message.message)
-        self.syslog(msg.priority, self.stringify_message(msg))
+        self.syslog(msg.priority, self.stringify_message(msg, text))
 
     def failure_context(self):
         # "An attempt to write a log message to the system log failed."
@@ -255,6 +418,9 @@ class sys_logger(logger):
 # other loggers.  This is so that the administrator can arrange for
 # messages to go to several places in the integration configuration [RB
 # 2000-08-10, 5.1].
+#
+# The message is converted to a string once (if any of the loggers will
+# log it) and the string is shared by all the loggers.
 
 class multi_logger(logger):
     loggers = []
@@ -267,10 +433,18 @@ class multi_logger(logger):
         logger.__init__(self, priority, max_length)
         self.loggers = loggers
 
-    def maybe_log(self, msg):
+    def maybe_log(self, msg, text = None):
         assert isinstance(msg, message.message)
+        if text == None and self.logs(msg.priority):
+            text = str(msg)
+        for l in self.loggers:
+            l.log(msg, text)
+
+    def logs(self, priority):
         for l in self.loggers:
-            l.log(msg)
+            if l.logs(priority):
+                return 1
+        return 0
 
     def set_log_failed_hook(self, hook):
         assert type(hook) in [types.FunctionType, types.MethodType]
@@ -312,12 +486,12 @@ class win32_event_logger(logger):
             message.DEBUG:   win32evtlog.EVENTLOG_INFORMATION_TYPE,
             }
 
-    def write(self, msg):
+    def write(self, msg, text = None):
         assert isinstance(msg, message.message)
         import win32evtlogutil
         win32evtlogutil.ReportEvent(self.application, 0, 0,
                                     self.event_type[msg.priority],
-                                    [self.stringify_message(msg)])
+                                    [self.stringify_message(msg, text)])
 
     def failure_context(self):
         # "An attempt to write a log message to the NT event log
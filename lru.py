@@ -0,0 +1,127 @@
+#             Perforce Defect Tracking Integration Project
+#              <http://www.ravenbrook.com/project/p4dti/>
+#
+#               LRU.PY -- LEAST-RECENTLY-USED CACHE
+#
+#
+# 1. INTRODUCTION
+#
+# This module defines a cache that holds at most a fixed number of
+# entries.  When the cache is full, the entries that have been used
+# least recently are discarded.
+#
+# Rather than keeping the entries in order of use (which costs time on
+# every lookup), each entry records when it was last used.  When the
+# cache grows past its size, it discards the least recently used tenth
+# of its entries in one go, so the cost of sorting is spread over many
+# insertions.
+#
+# The intended readership of this document is project developers.
+#
+# This document is not confidential.
+
+
+# 2. THE LRU_CACHE CLASS
+
+class lru_cache:
+    def __init__(self, size):
+        assert size > 0
+        self.size = size
+        # Map from key to a list [time of last use, value].
+        self.entries = {}
+        self.clock = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def has_key(self, key):
+        return self.entries.has_key(key)
+
+    # get(key, default).  Return the value for key, or default if
+    # there isn't one.  Counts as a use of the entry, and as a hit or
+    # a miss.
+
+    def get(self, key, default = None):
+        entry = self.entries.get(key)
+        if entry == None:
+            self.misses = self.misses + 1
+            return default
+        self.hits = self.hits + 1
+        self.clock = self.clock + 1
+        entry[0] = self.clock
+        return entry[1]
+
+    # peek(key, default).  Like get, but doesn't count as a use, a hit
+    # or a miss.
+
+    def peek(self, key, default = None):
+        entry = self.entries.get(key)
+        if entry == None:
+            return default
+        return entry[1]
+
+    # put(key, value).  Store value for key, discarding old entries if
+    # the cache is full.
+
+    def put(self, key, value):
+        self.clock = self.clock + 1
+        self.entries[key] = [self.clock, value]
+        if len(self.entries) > self.size:
+            self.discard(len(self.entries) - self.size
+                         + max(1, self.size / 10))
+
+    # remove(key).  Remove the entry for key, if there is one.
+
+    def remove(self, key):
+        if self.entries.has_key(key):
+            del self.entries[key]
+
+    # values().  Return a list of the values in the cache.  Doesn't
+    # count as a use.
+
+    def values(self):
+        return map(lambda entry: entry[1], self.entries.values())
+
+    def clear(self):
+        self.entries = {}
+
+    # discard(n).  Discard the n least recently used entries.
+
+    def discard(self, n):
+        uses = map(lambda item: (item[1][0], item[0]), self.entries.items())
+        uses.sort()
+        for last_use, key in uses[:n]:
+            del self.entries[key]
+
+
+# A. COPYRIGHT AND LICENSE
+#
+# This file is copyright (c) 2001 Perforce Software, Inc.  All rights
+# reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1.  Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#
+# 2.  Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in
+#     the documentation and/or other materials provided with the
+#     distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDERS AND CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+# OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+# USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+# DAMAGE.
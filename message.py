@@ -253,6 +253,68 @@ class catalog_factory(factory):
             return factory.new(self, 0, "No message with id '%s' "
                                "(args = %s)." % (id,args), ERR)
 
+    # message_priority(id).  Return the priority of the message with
+    # this id, without building the message.
+    def message_priority(self, id):
+        if self.catalog.has_key(id):
+            return self.catalog[id][0]
+        else:
+            return ERR
+
+    # new_deferred(id, args_function).  Return a deferred message (see
+    # section 6) whose arguments will be got by calling args_function
+    # (with no arguments) if and when the text is needed.
+    def new_deferred(self, id, args_function):
+        if self.catalog.has_key(id):
+            (priority, format) = self.catalog[id]
+            return deferred_message(id, format, args_function,
+                                    priority, self.product)
+        else:
+            return self.new(id, args_function())
+
+
+# 6. DEFERRED MESSAGE CLASS
+#
+# A deferred message doesn't build its text until it is converted to a
+# string.  This is for debugging messages whose arguments are expensive
+# to compute (such as the repr() of a whole result set) but which are
+# usually discarded because the log level is too low.  The arguments
+# are computed at most once, so a message written to several logs is
+# only formatted once.
+#
+# Use str() or the render() method to get the text; the text attribute
+# is None until the message has been rendered.
+
+class deferred_message(message):
+    format = None
+    args_function = None
+
+    def __init__(self, id, format, args_function, priority, product):
+        message.__init__(self, id, '', priority, product)
+        self.text = None
+        self.format = format
+        self.args_function = args_function
+
+    def render(self):
+        if self.text == None:
+            args = self.args_function()
+            try:
+                text = self.format % args
+            except TypeError:
+                text = ("Message %s has format string '%s' but "
+                        "arguments %s." % (self.id, self.format, args))
+                self.id = 0
+                self.priority = ERR
+            if isinstance(text, unicode):
+                text = text.encode('utf8')
+            self.text = text
+            self.args_function = None
+        return self.text
+
+    def __str__(self):
+        self.render()
+        return message.__str__(self)
+
 
 # A. REFERENCES
 #
@@ -0,0 +1,262 @@
+#             Perforce Defect Tracking Integration Project
+#              <http://www.ravenbrook.com/project/p4dti/>
+#
+#           METRICS.PY -- REPLICATOR PERFORMANCE STATISTICS
+#
+#
+# 1. INTRODUCTION
+#
+# This module collects statistics about the replicator's performance
+# (how long polls take, how many Perforce commands and SQL statements
+# it runs and how long they take, and so on) and writes them to a file
+# in the Prometheus text format [Prometheus], so that they can be
+# collected by the textfile collector of the Prometheus node exporter,
+# or simply read by the administrator.
+#
+# The replicator makes a metrics object and writes it to the file
+# named by the metrics_file configuration parameter after each poll.
+# See section 4.5 of replicator.py.
+#
+# There are three kinds of statistic:
+#
+#  1. A counter counts events (for example, polls) since the replicator
+# started.
+#
+#  2. A gauge records a value (for example, the current poll period).
+#
+#  3. A histogram records a distribution of durations (for example,
+# the time taken by Perforce commands), as counts of observations that
+# were no bigger than each of a series of bucket boundaries, together
+# with the total count and sum of the observations.
+#
+# Each statistic may have labels, given as a tuple of pairs (name,
+# value), to record the statistic separately for each value of the
+# labels: for example, the time taken by Perforce commands is recorded
+# separately for each command.
+#
+# The methods may be called from several threads at once.
+#
+# The intended readership of this document is project developers.
+#
+# This document is not confidential.
+
+import os
+import string
+import threading
+
+
+# 2. DESCRIPTIONS OF THE STATISTICS
+#
+# A map from the name of each statistic to a pair (type, help text).
+# The names get the prefix "p4dti_" when they are written out.
+
+descriptions = {
+    'bugzilla_lock_seconds': ('histogram', "Time for which Bugzilla "
+                              "tables or rows were locked."),
+    'job_cache_requests_total': ('counter', "Number of lookups in the "
+                                 "replicator's job cache, by result."),
+    'p4_command_seconds': ('histogram', "Time taken by Perforce "
+                           "commands, by command."),
+    'poll_changelists': ('gauge', "Number of changelists replicated "
+                         "in the last poll."),
+    'poll_issues': ('gauge', "Number of changed issues replicated "
+                    "in the last poll."),
+    'poll_jobs': ('gauge', "Number of jobs changed only in Perforce "
+                  "replicated in the last poll."),
+    'poll_period_seconds': ('gauge', "Time until the next poll, "
+                            "including any backoff after failures."),
+    'poll_phase_seconds': ('gauge', "Time taken by each phase of the "
+                           "last poll."),
+    'poll_seconds': ('histogram', "Time taken by polls."),
+    'poll_unchanged_issues': ('gauge', "Number of changed issues "
+                              "skipped in the last poll because their "
+                              "replicated fields hadn't changed."),
+    'polls_total': ('counter', "Number of polls, by result."),
+    'sql_statement_seconds': ('histogram', "Time taken by SQL "
+                              "statements, by kind of statement."),
+    'unreplicated_log_entries': ('gauge', "Number of entries in the "
+                                 "Perforce logger that the replicator "
+                                 "has not yet consumed."),
+    }
+
+# Histogram bucket boundaries, in seconds.
+
+buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+           10.0, 30.0, 60.0]
+
+
+# 3. THE METRICS CLASS
+
+class metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Map from (name, labels) to value (for counters and gauges)
+        # or to a list [bucket counts, count, sum] (for histograms).
+        self.values = {}
+
+    # count(name, labels, amount).  Add amount to a counter.
+
+    def count(self, name, labels = (), amount = 1):
+        self.lock.acquire()
+        try:
+            key = (name, labels)
+            self.values[key] = self.values.get(key, 0) + amount
+        finally:
+            self.lock.release()
+
+    # set(name, value, labels).  Set a gauge.
+
+    def set(self, name, value, labels = ()):
+        self.lock.acquire()
+        try:
+            self.values[(name, labels)] = value
+        finally:
+            self.lock.release()
+
+    # unset(name, labels).  Remove a gauge, so that it is absent from
+    # the statistics rather than reporting a stale value.
+
+    def unset(self, name, labels = ()):
+        self.lock.acquire()
+        try:
+            if self.values.has_key((name, labels)):
+                del self.values[(name, labels)]
+        finally:
+            self.lock.release()
+
+    # observe(name, value, labels).  Record an observation in a
+    # histogram.
+
+    def observe(self, name, value, labels = ()):
+        self.lock.acquire()
+        try:
+            key = (name, labels)
+            if not self.values.has_key(key):
+                self.values[key] = [[0] * len(buckets), 0, 0.0]
+            h = self.values[key]
+            for i in range(len(buckets)):
+                if value <= buckets[i]:
+                    h[0][i] = h[0][i] + 1
+            h[1] = h[1] + 1
+            h[2] = h[2] + value
+        finally:
+            self.lock.release()
+
+
+    # 3.1. Format the statistics
+    #
+    # format() returns the statistics as a string in the Prometheus
+    # text format [Prometheus].
+
+    def format(self):
+        self.lock.acquire()
+        try:
+            items = self.values.items()
+            items.sort()
+            lines = []
+            last_name = None
+            for (name, labels), value in items:
+                full_name = 'p4dti_' + name
+                type, help = descriptions[name]
+                if name != last_name:
+                    lines.append('# HELP %s %s' % (full_name, help))
+                    lines.append('# TYPE %s %s' % (full_name, type))
+                    last_name = name
+                if type == 'histogram':
+                    bucket_counts, count, sum = value
+                    for i in range(len(buckets)):
+                        lines.append('%s_bucket%s %d' % (
+                            full_name,
+                            format_labels(labels
+                                          + (('le', repr(buckets[i])),)),
+                            bucket_counts[i]))
+                    lines.append('%s_bucket%s %d' % (
+                        full_name, format_labels(labels + (('le', '+Inf'),)),
+                        count))
+                    lines.append('%s_sum%s %s'
+                                 % (full_name, format_labels(labels),
+                                    repr(sum)))
+                    lines.append('%s_count%s %d'
+                                 % (full_name, format_labels(labels),
+                                    count))
+                else:
+                    lines.append('%s%s %s' % (full_name,
+                                              format_labels(labels),
+                                              value))
+            return string.join(lines, '\n') + '\n'
+        finally:
+            self.lock.release()
+
+
+    # 3.2. Write the statistics to a file
+    #
+    # write(path).  Write the statistics to the file.  Write them to a
+    # temporary file first and then rename it, so that a reader never
+    # sees a half-written file.
+
+    def write(self, path):
+        temporary = path + '.tmp'
+        f = open(temporary, 'w')
+        try:
+            f.write(self.format())
+        finally:
+            f.close()
+        if os.name == 'nt' and os.path.exists(path):
+            # Windows can't rename over an existing file.
+            os.remove(path)
+        os.rename(temporary, path)
+
+
+# 4. FORMAT LABELS
+#
+# format_labels(labels).  Format a tuple of pairs (name, value) as
+# Prometheus labels.
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    items = []
+    for name, value in labels:
+        value = str(value)
+        value = string.replace(value, '\\', '\\\\')
+        value = string.replace(value, '"', '\\"')
+        value = string.replace(value, '\n', '\\n')
+        items.append('%s="%s"' % (name, value))
+    return '{%s}' % string.join(items, ',')
+
+
+# A. REFERENCES
+#
+# [Prometheus] "Exposition formats"; Prometheus;
+# <https://prometheus.io/docs/instrumenting/exposition_formats/>.
+#
+#
+# B. COPYRIGHT AND LICENSE
+#
+# This file is copyright (c) 2001 Perforce Software, Inc.  All rights
+# reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1.  Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#
+# 2.  Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in
+#     the documentation and/or other materials provided with the
+#     distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDERS AND CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+# OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+# USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+# DAMAGE.
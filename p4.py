@@ -57,7 +57,7 @@ import marshal
 import os
 import re
 import string
-import tempfile
+import time
 import types
 import portable
 import locale
@@ -79,6 +79,16 @@ class p4:
     unicode = False
     encoding = 'utf-8'
 
+    # If io_lock is not None, it is a lock that is held by the thread
+    # running a Perforce command.  We release it while we wait for the
+    # Perforce client, so that other threads can run in the meantime.
+    # See replicator.replicate_in_parallel.
+    io_lock = None
+
+    # Metrics object in which to record the time taken by Perforce
+    # commands, or None (see metrics.py).
+    metrics = None
+
 
     # 2.1. Create an instance
     #
@@ -130,21 +140,65 @@ class p4:
         if self.logger:
             msg = catalog.msg(id, args)
             self.logger.log(msg)
+
+    # log_deferred(id, args_function) is like log(), but the message
+    # arguments are only computed (by calling args_function) if the
+    # message is going to be logged.
+
+    def log_deferred(self, id, args_function):
+        if self.logger and self.logger.logs(catalog.priority(id)):
+            self.logger.log(catalog.deferred_msg(id, args_function))
+
+    # record_command(arguments, start) records the time taken by a
+    # Perforce command that started at time start, if there is a
+    # metrics object.
+
+    def record_command(self, arguments, start):
+        if self.metrics:
+            words = string.split(arguments)
+            if words:
+                command = words[0]
+            else:
+                command = ''
+            self.metrics.observe('p4_command_seconds', time.time() - start,
+                                 (('command', command),))
 	
-    # 2.3. Dump a marshalled object (marshalling version 0) to a file.
+    # 2.3. Marshal an object (marshalling version 0) to a string.
     # 
     # This utility function is required because Python 2.4 breaks
     # binary compatibility of marshalled objects.  p4 -G expects
     # marshalled objects of format 0 (i.e. Python < 2.4).
 
-    def marshal_dump_0(self, obj, file):
+    def marshal_dumps_0(self, obj):
         if marshal.__dict__.has_key('version'):
-            marshal.dump(obj, file, 0)
+            return marshal.dumps(obj, 0)
         else:
-            marshal.dump(obj, file)
+            return marshal.dumps(obj)
 
     # 2.4. Run a Perforce command
     #
+    # command_words(arguments) returns the list of words of the command
+    # which runs the Perforce client with the -G option, our connection
+    # parameters, and the given command-line arguments.  The command is
+    # run without a shell (see portable.popen_binary), so the words
+    # don't need quoting, even if the Perforce executable contains
+    # spaces (job000049).
+
+    def command_words(self, arguments):
+        command_words = [self.client_executable, '-G']
+        if self.port:
+            command_words.extend(['-p', self.port])
+        if self.user:
+            command_words.extend(['-u', self.user])
+        if self.password and not self.config_file:
+            command_words.extend(['-P', self.password])
+        if self.client:
+            command_words.extend(['-c', self.client])
+        if self.unicode:
+            command_words.extend(['-C', 'utf8'])
+        command_words.extend(string.split(arguments.encode('utf8')))
+        return command_words
+
     # run(arguments, input): Run the Perforce client with the given
     # command-line arguments, passing the dictionary 'input' to the
     # client's standard input.
@@ -162,83 +216,77 @@ class p4:
         assert isinstance(arguments, basestring)
         assert input is None or isinstance(input, types.DictType)
 
-        # Build a command line suitable for use with CMD.EXE on Windows
-        # NT, or /bin/sh on POSIX.  Make sure to quote the Perforce
-        # command if it contains spaces.  See job000049.
-        if ' ' in self.client_executable:
-            command_words = ['"%s"' % self.client_executable]
-        else:
-            command_words = [self.client_executable]
-        command_words.append('-G')
-        if self.port:
-            command_words.extend(['-p', self.port])
-        if self.user:
-            command_words.extend(['-u', self.user])
-        if self.password and not self.config_file:
-            command_words.extend(['-P', self.password])
-        if self.client:
-            command_words.extend(['-c', self.client])
-        if self.unicode:
-            command_words.extend(['-C', 'utf8'])
-        command_words.append(arguments.encode('utf8'))
+        command_words = self.command_words(arguments)
 
-        # Pass the input dictionary (if any) to Perforce.
-        temp_filename = None
+        # Pass the input dictionary (if any) to Perforce, through the
+        # client's standard input.
+        input_data = None
         if input:
             input = self.encode_dict(input)
-            tempfile.template = 'p4dti_data'
-            temp_filename = tempfile.mktemp()
-            # Python marshalled dictionaries are binary, so use mode
-            # 'wb'.
-            temp_file = open(temp_filename, 'wb')
-            self.marshal_dump_0(input, temp_file)
-            temp_file.close()
-            command_words.extend(['<', temp_filename])
+            input_data = self.marshal_dumps_0(input)
             # "Perforce input: '%s'."
-            self.log(700, input)
-        command = string.join(command_words, ' ')
+            self.log_deferred(700, lambda: input)
         # "Perforce command: '%s'."
-        self.log(701, command)
+        self.log_deferred(701, lambda: string.join(command_words, ' '))
 
-        stream = portable.popen_read_binary(command)
-        # Read the results of the Perforce command.
-        results = []
+        lock = self.io_lock
+        if lock:
+            lock.release()
+        start = time.time()
         try:
-            while 1:
-                results.append(marshal.load(stream))
-        except EOFError:
-            if temp_filename:
-                os.remove(temp_filename)
-
-        for r in results:
-            if isinstance(r,dict):
-                for (k,v) in r.items():
-                    if isinstance(v, str):
-                        r[k] = v.decode(self.encoding, 'replace')
-
-        # Check the exit status of the Perforce command, rather than
-        # simply returning empty output when the command didn't run for
-        # some reason (such as the Perforce server being down).  This
-        # code was inserted to resolve job job000158.  RB 2000-12-14
-        exit_status = stream.close()
+            pipe = portable.popen_binary(command_words, input_data)
+            stream = pipe.stream
+            # Read the results of the Perforce command.
+            results = []
+            try:
+                while 1:
+                    results.append(marshal.load(stream))
+            except EOFError:
+                pass
+
+            # Check the exit status of the Perforce command, rather
+            # than simply returning empty output when the command
+            # didn't run for some reason (such as the Perforce server
+            # being down).  This code was inserted to resolve job
+            # job000158.  RB 2000-12-14
+            exit_status = pipe.close()
+        finally:
+            if lock:
+                lock.acquire()
+        self.record_command(arguments, start)
+
+        self.decode_results(results)
         if exit_status != None:
             # "Perforce status: '%s'."
-            self.log(702, exit_status)
+            self.log_deferred(702, lambda: exit_status)
         # "Perforce results: '%s'."
-        self.log(703, results)
-
-        # Check for errors from Perforce (either errors returned in the
-        # data, or errors signalled by the exit status, or both) and
-        # raise a Python exception.
-        #
-        # Perforce signals an error by the presence of a 'code' key in
-        # the dictionary output.  (This isn't a totally reliable way to
-        # spot an error in a Perforce command, because jobs can have
-        # 'code' fields too.  See job000003.  However, the P4DTI makes
-        # sure that its jobs don't have such a field.)
-        if (len(results) == 1 and results[0].has_key('code')
-            and results[0]['code'] == 'error'):
-            msg = results[0]['data'].strip()
+        self.log_deferred(703, lambda: results)
+
+        if len(results) == 1:
+            retry = self.check_error(results[0], exit_status, repeat)
+            if retry:
+                return self.run(arguments, input, repeat = True)
+        else:
+            self.check_error(None, exit_status, repeat)
+        return results
+
+    # check_error(result, exit_status, repeat): Check for errors from
+    # Perforce (either errors returned in the data, or errors signalled
+    # by the exit status, or both) and raise a Python exception.  The
+    # result argument is the only result of the command, or None if
+    # there wasn't exactly one result.  Return True if the command
+    # should be repeated with the Unicode mode switched.
+    #
+    # Perforce signals an error by the presence of a 'code' key in the
+    # dictionary output.  (This isn't a totally reliable way to spot an
+    # error in a Perforce command, because jobs can have 'code' fields
+    # too.  See job000003.  However, the P4DTI makes sure that its jobs
+    # don't have such a field.)
+
+    def check_error(self, result, exit_status, repeat):
+        if (result != None and result.has_key('code')
+            and result['code'] == 'error'):
+            msg = result['data'].strip()
             if exit_status:
                 if msg.find('Unicode') != -1:
                     self.unicode = not(self.unicode)
@@ -247,7 +295,7 @@ class p4:
                         # "Perforce message '%s'.  Switching Unicode
                         # mode %s to retry."
                         self.log(734, (msg, unicode_switch))
-                        return self.run(arguments, input, repeat = True)
+                        return True
                     else:
                         # "Perforce message '%s'.  Is P4CHARSET set with a
                         # non-Unicode server? Reverting to Unicode mode %s."
@@ -263,8 +311,77 @@ class p4:
             # server might be down; the server address might be
             # incorrect; or your Perforce license might have expired."
             raise error, catalog.msg(707, exit_status)
-        else:
-            return results
+        return False
+
+    # run_iter(arguments): Run the Perforce client with the given
+    # command-line arguments, like run(), but return a generator which
+    # yields the dictionaries output by the Perforce command one at a
+    # time as they are read.  This keeps memory use down for commands
+    # like "jobs" which may have very large output.
+    #
+    # Errors are detected when the end of the output is reached.  An
+    # error in the command's output looks like a single result, so we
+    # hold back the first result until we know whether there is a
+    # second.  The results aren't logged (the output is too big); only
+    # their number is.
+    #
+    # If the caller stops iterating before the end, the pipe is closed
+    # and the client waited for when the generator is closed or
+    # garbage-collected.
+
+    def run_iter(self, arguments, repeat = False):
+        assert isinstance(arguments, basestring)
+        command_words = self.command_words(arguments)
+        # "Perforce command: '%s'."
+        self.log_deferred(701, lambda: string.join(command_words, ' '))
+
+        start = time.time()
+        pipe = portable.popen_binary(command_words)
+        stream = pipe.stream
+        first = None
+        n = 0
+        closed = False
+        try:
+            try:
+                while 1:
+                    result = marshal.load(stream)
+                    self.decode_results([result])
+                    n = n + 1
+                    if n == 1:
+                        first = result
+                        continue
+                    elif n == 2:
+                        yield first
+                        first = None
+                    yield result
+            except EOFError:
+                pass
+            exit_status = pipe.close()
+            closed = True
+        finally:
+            if not closed:
+                pipe.close()
+        self.record_command(arguments, start)
+        if exit_status != None:
+            # "Perforce status: '%s'."
+            self.log_deferred(702, lambda: exit_status)
+        # "Perforce returned %d results."
+        self.log(739, n)
+        if self.check_error(first, exit_status, repeat):
+            for result in self.run_iter(arguments, repeat = True):
+                yield result
+        elif first != None:
+            yield first
+
+    # Decode the string values in a list of results from Perforce
+    # according to our chosen encoding.
+
+    def decode_results(self, results):
+        for r in results:
+            if isinstance(r,dict):
+                for (k,v) in r.items():
+                    if isinstance(v, str):
+                        r[k] = v.decode(self.encoding, 'replace')
 
     # Modify a dictionary which has some Unicode elements, such that
     # they are all encoded according to our chosen encoding
@@ -423,17 +540,215 @@ class p4:
             command = '"%s"' % command
         command = command + ' ' + arguments
         # "Perforce command: '%s'."
-        self.log(701, command)
+        self.log_deferred(701, lambda: command)
+        start = time.time()
         stream = os.popen(command ,'r')
         result = stream.read()
         exit_status = stream.close()
+        self.record_command(arguments, start)
         if exit_status:
             # "Perforce status: '%s'."
-            self.log(702, exit_status)
+            self.log_deferred(702, lambda: exit_status)
         # "Perforce results: '%s'."
-        self.log(703, result)
+        self.log_deferred(703, lambda: result)
         return (command, result, exit_status)
 
+    # 2.7. Run a Perforce command on many arguments
+    #
+    # run_batch(command, arguments): Run the Perforce command once for
+    # each of the arguments, for example run_batch('job -o',
+    # ['job000001', 'job000002']).  All the commands are run by a
+    # single Perforce client process, using "p4 -x - -b 1", which reads
+    # the arguments from its standard input one per line and runs the
+    # command once for each of them.  This saves starting a new client
+    # for every command, which is expensive when a poll touches
+    # hundreds of jobs.
+    #
+    # The command must produce exactly one dictionary (a form or an
+    # error) for each argument; "job -o" and "change -o" are like this.
+    #
+    # Return a list with one element for each argument, in the same
+    # order.  Each element is a pair (results, message), where results
+    # is the list of dictionaries output by that command, and message
+    # is None if the command succeeded, or the message that run() would
+    # have raised as a p4.error if the command failed.
+    #
+    # If the Perforce client can't run the command in batch mode (or
+    # its output can't be matched up with the arguments), run the
+    # commands one at a time.  If the client doesn't seem to support
+    # batch mode at all, don't try it again.  A client that doesn't
+    # understand -x or -b may just print a usage message to its
+    # standard error and fail, which looks like a connection problem;
+    # so if a batch fails without any output, but the first command
+    # then succeeds on its own, we don't try batch mode again either.
+
+    batch = True
+
+    def run_batch(self, command, arguments):
+        assert isinstance(command, basestring)
+        assert isinstance(arguments, types.ListType)
+        if not arguments:
+            return []
+        silent_failure = False
+        if self.batch:
+            results, silent_failure = self.run_batch_1(command, arguments)
+            if results != None:
+                return results
+        results = []
+        for argument in arguments:
+            try:
+                results.append((self.run('%s %s' % (command, argument)),
+                                None))
+            except error, message:
+                results.append(([], message))
+            if silent_failure:
+                if results[0][1] == None:
+                    self.batch_unsupported(command)
+                silent_failure = False
+        return results
+
+    # run_batch_1(command, arguments, repeat): Run the commands in batch
+    # mode, as described above.  Return a pair (results, silent_failure)
+    # where results is None if batch mode didn't work this time, and
+    # silent_failure is true if the client failed without any output.
+
+    def run_batch_1(self, command, arguments, repeat = False):
+        records, exit_status, unmarshalled = self.batch_records(command,
+                                                                arguments)
+        if len(records) != len(arguments):
+            # If all we got was errors, then something went wrong with
+            # the connection (for example, the server is down) and
+            # run() will report it.  Otherwise the client can't do
+            # what we asked.
+            if (not unmarshalled
+                or filter(lambda r: r.get('code') != 'error', records)):
+                self.batch_unsupported(command)
+            return None, (not records and exit_status != None)
+
+        # Check each result for errors from Perforce, as run() does.
+        results = []
+        failures = 0
+        for r in records:
+            if r.has_key('code') and r['code'] == 'error':
+                msg = r['data'].strip()
+                if (exit_status and msg.find('Unicode') != -1
+                    and not repeat):
+                    self.unicode = not(self.unicode)
+                    unicode_switch = (self.unicode and 'on') or 'off'
+                    # "Perforce message '%s'.  Switching Unicode mode
+                    # %s to retry."
+                    self.log(734, (msg, unicode_switch))
+                    return self.run_batch_1(command, arguments,
+                                            repeat = True)
+                # "%s"
+                results.append(([], catalog.msg(708, msg)))
+                failures = failures + 1
+            else:
+                results.append(([r], None))
+        if exit_status and not failures:
+            # "The Perforce client exited with error code %d.  The
+            # server might be down; the server address might be
+            # incorrect; or your Perforce license might have expired."
+            raise error, catalog.msg(707, exit_status)
+        return results, False
+
+    # batch_records(command, arguments): Run the command in batch mode
+    # on the arguments.  Return a triple (records, exit_status,
+    # unmarshalled) where records is the list of dictionaries output
+    # by the client, exit_status is its exit status, and unmarshalled
+    # is false if the output wasn't all marshalled dictionaries.
+
+    def batch_records(self, command, arguments):
+        command_words = self.command_words('-x - -b 1 ' + command)
+        input_data = string.join(map(lambda a: a.encode('utf8') + '\n',
+                                     arguments), '')
+        # "Perforce command: '%s'."
+        self.log_deferred(701, lambda: string.join(command_words, ' '))
+        # "Perforce batch arguments: %s."
+        self.log(737, (arguments,))
+
+        lock = self.io_lock
+        if lock:
+            lock.release()
+        start = time.time()
+        try:
+            pipe = portable.popen_binary(command_words, input_data)
+            stream = pipe.stream
+            records = []
+            unmarshalled = True
+            try:
+                while 1:
+                    records.append(marshal.load(stream))
+            except EOFError:
+                pass
+            except ValueError:
+                # The client's output wasn't marshalled data; probably
+                # it doesn't understand -x or -b and printed a usage
+                # message.
+                unmarshalled = False
+            exit_status = pipe.close()
+        finally:
+            if lock:
+                lock.acquire()
+        self.record_command(command, start)
+        self.decode_results(records)
+        if exit_status != None:
+            # "Perforce status: '%s'."
+            self.log_deferred(702, lambda: exit_status)
+        # "Perforce results: '%s'."
+        self.log_deferred(703, lambda: records)
+        return records, exit_status, unmarshalled
+
+    # batch_unsupported(command): Note that the Perforce client doesn't
+    # support batch mode, so that we don't try it again.
+
+    def batch_unsupported(self, command):
+        # "The Perforce client can't run '%s' commands in batch mode,
+        # so the P4DTI will run them one at a time."
+        self.log(738, command)
+        self.batch = False
+
+    # 2.8. Run a Perforce command on many arguments, collecting output
+    #
+    # run_batch_all(command, arguments): Like run_batch, but for
+    # commands which produce any number of dictionaries for each
+    # argument, such as "fixes -j".  Return a single list of all the
+    # dictionaries output by all the commands.  (So the dictionaries
+    # themselves must say which argument they belong to: fixes have a
+    # 'Job' field, for example.)
+    #
+    # If any of the commands fails, run them again one at a time using
+    # run(), so that Unicode mode switching and error reporting work as
+    # usual.
+
+    def run_batch_all(self, command, arguments):
+        assert isinstance(command, basestring)
+        assert isinstance(arguments, types.ListType)
+        if not arguments:
+            return []
+        if self.batch:
+            records, exit_status, unmarshalled = self.batch_records(
+                command, arguments)
+            if not unmarshalled:
+                self.batch_unsupported(command)
+            elif (not exit_status
+                  and not filter(lambda r: r.get('code') == 'error',
+                                 records)):
+                return records
+            elif exit_status and not records:
+                # Perhaps the client doesn't understand -x or -b (see
+                # run_batch): if the first command succeeds on its own,
+                # don't try batch mode again.
+                results = self.run('%s %s' % (command, arguments[0]))
+                self.batch_unsupported(command)
+                for argument in arguments[1:]:
+                    results.extend(self.run('%s %s' % (command, argument)))
+                return results
+        results = []
+        for argument in arguments:
+            results.extend(self.run('%s %s' % (command, argument)))
+        return results
+
     # 3. HANDLING JOBSPECS
     #
     # Jobspecs passed to or from Perforce ("p4 -G jobspec -i"
@@ -19,6 +19,13 @@
 
 import os
 import catalog
+import string
+import tempfile
+
+try:
+    import subprocess
+except ImportError:
+    subprocess = None
 
 # 2. popen_read_binary()
 # 
@@ -36,7 +43,102 @@ def popen_read_binary(command):
         raise error, catalog.msg(1021, os.name)
     return os.popen(command, mode)
 
-# 3. protect_file()
+# 3. popen_binary()
+#
+# popen_binary(words, input) runs the command given by the list of
+# words, passing the string 'input' (if it is not None) to the
+# command's standard input.  It returns a pipe object whose 'stream'
+# member is a file from which the command's output can be read in
+# binary.  The pipe's close() method waits for the command to finish
+# and returns its exit status, or None if the command succeeded (like
+# the close() method of a file returned by os.popen).
+#
+# Where the subprocess module is available (Python 2.4 and later) the
+# command is run directly, without a shell.  If there is no input, the
+# command's output is read from a pipe as it is produced.  If there is
+# input, it is written to a pipe, and the command's output goes to a
+# temporary file, which the caller reads when the command has
+# finished.  A command like "p4 -x - -b 1" may write output before it
+# has read all its input, so if we read its output from a pipe while
+# writing its input, both pipes might fill up.  And we can't read the
+# output in one thread while another writes the input, because
+# marshal.load holds the global interpreter lock while it waits for
+# the pipe, so the writing thread would never run.
+
+class subprocess_pipe:
+    def __init__(self, words, input):
+        self.status = None
+        if input == None:
+            self.process = subprocess.Popen(words,
+                                            stdin = subprocess.PIPE,
+                                            stdout = subprocess.PIPE)
+            self.process.stdin.close()
+            self.stream = self.process.stdout
+            return
+        self.stream = tempfile.TemporaryFile()
+        try:
+            self.process = subprocess.Popen(words,
+                                            stdin = subprocess.PIPE,
+                                            stdout = self.stream)
+            try:
+                try:
+                    self.process.stdin.write(input)
+                finally:
+                    self.process.stdin.close()
+            except (IOError, OSError):
+                # The command exited without reading all its input
+                # (EPIPE); its exit status reports the failure.
+                pass
+            self.status = self.process.wait()
+            self.stream.seek(0)
+        except:
+            self.stream.close()
+            raise
+
+    def close(self):
+        self.stream.close()
+        if self.status == None:
+            self.status = self.process.wait()
+        if self.status == 0:
+            return None
+        else:
+            return self.status
+
+class shell_pipe:
+    def __init__(self, words, input):
+        # Quote words containing spaces (see job000049) or characters
+        # which are special to the shell, like those in a "p4 jobs -e"
+        # query.
+        def quote(word):
+            for c in ' |&<>()^;':
+                if c in word:
+                    return '"%s"' % word
+            return word
+        command = string.join(map(quote, words), ' ')
+        self.temp_filename = None
+        if input != None:
+            tempfile.template = 'p4dti_data'
+            self.temp_filename = tempfile.mktemp()
+            temp_file = open(self.temp_filename, 'wb')
+            temp_file.write(input)
+            temp_file.close()
+            command = command + ' < ' + self.temp_filename
+        self.stream = popen_read_binary(command)
+
+    def close(self):
+        status = self.stream.close()
+        if self.temp_filename:
+            os.remove(self.temp_filename)
+        return status
+
+def popen_binary(words, input = None):
+    if subprocess:
+        return subprocess_pipe(words, input)
+    else:
+        return shell_pipe(words, input)
+
+
+# 4. protect_file()
 #
 # Make the named file readable and writable only by the current user
 # (who is also the creator and owner of the file).  Surprisingly hard
@@ -32,16 +32,36 @@
 
 import catalog
 import dt_interface
+import errno
+import lru
 import message
+import metrics
+import os
 import p4
 import re
+import select
+import signal
+import atexit
 import smtplib
+import socket
+import stat
 import string
+import StringIO
 import sys
+import threading
 import time
 import stacktrace
 import types
 
+try:
+    import cProfile as profile
+except ImportError:
+    import profile
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
 
 # 2. CURSOR WRAPPER FOR LISTS
 #
@@ -126,6 +146,11 @@ class replicator:
     # The replicator's counter on the Perforce server.
     counter = None
 
+    # Replications deferred to the next poll because the issue changed
+    # while we were replicating the job to it: a map from jobname to
+    # issue id.  See defer.
+    deferred = None
+
     # Error object for fatal errors raised by the replicator.
     error = 'P4DTI Replicator error'
 
@@ -133,6 +158,11 @@ class replicator:
     # See [GDR 2000-10-16, 3.5] for names of features.
     feature = {}
 
+    # Performance statistics (see metrics.py), written to the file
+    # named by the metrics_file configuration parameter after each
+    # poll.
+    metrics = None
+
 
     # 4.2. Initialization
 
@@ -140,6 +170,7 @@ class replicator:
         assert isinstance(dt, dt_interface.defect_tracker)
         assert isinstance(p4_interface, p4.p4)
         self.job_updates = {}
+        self.deferred = {}
         self.dt = dt
         self.config = config
         self.rid = config.rid
@@ -159,6 +190,17 @@ class replicator:
         self.dt_p4 = dt_perforce(p4_interface, config)
         self.p4 = p4_interface
 
+        self.polls_to_profile = self.config.profile_polls
+        self.job_cache = lru.lru_cache(self.job_cache_size)
+
+        # Collect statistics from Perforce and the defect tracker only
+        # if someone is going to read them.
+        self.metrics = metrics.metrics()
+        if self.config.metrics_file != None:
+            self.p4.metrics = self.metrics
+            if hasattr(self.dt, 'set_metrics'):
+                self.dt.set_metrics(self.metrics)
+
         # Replicator ids must match.
         if self.rid != self.dt.rid:
             # "The replicator's RID ('%s') doesn't match the defect
@@ -235,12 +277,19 @@ class replicator:
             and not self.p4.jobspec_has_p4dti_fields(
             self.p4.get_jobspec(),
             warn = 0)
-            and self.p4.run('jobs')):
+            and self.jobs_exist()):
             # "You must delete your Perforce jobs before running the
             # P4DTI for the first time.  See section 5.2.3 of the
             # Administrator's Guide."
             raise self.error, catalog.msg(914)
 
+    # jobs_exist().  Return true if there are any jobs in Perforce.
+
+    def jobs_exist(self):
+        for job in self.p4.run_iter('jobs -m 1'):
+            return 1
+        return 0
+
     # update_and_check_jobspec().  If keep_jobspec is set, check the
     # current jobspec against the one we want to install.  Otherwise,
     # just go ahead and install the jobspec.  Advanced configurations
@@ -295,10 +344,12 @@ class replicator:
     # Perforce.  In time they can be moved to the dt_perforce class
     # (section 3).
 
-    # all_jobs().  Return a list of all jobs.
+    # all_jobs().  Return an iterator over all jobs.  Jobs are read from
+    # Perforce as they are needed, so that the whole jobs table isn't
+    # held in memory.
 
     def all_jobs(self):
-        return self.p4.run('jobs')
+        return self.p4.run_iter('jobs')
 
     # changed_entities().  Return a 3-tuple consisting of (a) changed
     # jobs, (b) changed changelists, and (c) the last log entry that
@@ -312,8 +363,9 @@ class replicator:
         # Get all entries from the log since the last time we updated
         # the counter.
         log_entries = self.p4.run('logger -t %s' % self.counter)
-        jobs = {}
-        changelists = []
+        jobnames = []
+        change_numbers = []
+        seen = {}
         last_log_entry = None # The last entry number in the log.
         for e in log_entries:
             last_log_entry = int(e['sequence'])
@@ -329,13 +381,13 @@ class replicator:
                     # "Perforce has a job called 'new', which is
                     # illegal and will stop the P4DTI from working."
                     raise self.error, catalog.msg(896)
-                elif not jobs.has_key(jobname):
-                    job = self.job(jobname)
-                    p4dti_rid = job.get('P4DTI-rid', 'None')
-                    if (p4dti_rid == self.rid
-                        or (p4dti_rid == 'None'
-                            and self.config.replicate_job_p(job))):
-                        jobs[jobname] = job
+                else:
+                    # Someone else changed the job, so our copy is out
+                    # of date.
+                    self.job_cache.remove(string.lower(jobname))
+                    if not seen.has_key(('job', jobname)):
+                        seen[('job', jobname)] = 1
+                        jobnames.append(jobname)
             elif e['key'] == 'change':
                 # Collect new and updated changelists here.  A
                 # changelist can change (using p4 change -f) without any
@@ -343,16 +395,37 @@ class replicator:
                 # changelists as well as replicating the fixes of
                 # changed jobs.
                 change_number = e['attr']
-                try:
-                    changelist = self.p4.run('change -o %s'
-                                             % change_number)[0]
-                    changelists.append(changelist)
-                except p4.error:
-                    # The changelist might not exist any more: it might
-                    # have been a pending changelist that's been
-                    # renumbered.  So don't replicate it.  Should it be
-                    # deleted from the defect tracker?  GDR 2000-11-02.
-                    pass
+                if not seen.has_key(('change', change_number)):
+                    seen[('change', change_number)] = 1
+                    change_numbers.append(change_number)
+
+        # Submitting or renumbering a changelist can change the fixes
+        # of jobs it fixes without a logger entry for the jobs, so
+        # forget all the fixes we know about.  Submitting can also
+        # change the status of the jobs it fixes, so forget those jobs.
+        if change_numbers:
+            self.forget_cached_fixes()
+            self.fetch_changelists(change_numbers)
+            self.forget_changelist_jobs(change_numbers)
+
+        # Fetch all the jobs in batches.
+        jobs = {}
+        for jobname, job in self.query_jobs(jobnames).items():
+            self.cache_job(job)
+            p4dti_rid = job.get('P4DTI-rid', 'None')
+            if (p4dti_rid == self.rid
+                or (p4dti_rid == 'None'
+                    and self.config.replicate_job_p(job))):
+                jobs[jobname] = job
+        changelists = []
+        for change_number in change_numbers:
+            # If the changelist is missing, it might not exist any more:
+            # it might have been a pending changelist that's been
+            # renumbered.  So don't replicate it.  Should it be deleted
+            # from the defect tracker?  GDR 2000-11-02.
+            changelist = self.changelist_cache.get(int(change_number))
+            if changelist:
+                changelists.append(changelist)
         self.job_updates = {}
         return jobs, changelists, last_log_entry
 
@@ -376,12 +449,215 @@ class replicator:
         self.p4.run('logger -t %s -c %s'
                     % (self.counter, last_log_entry))
 
+    # Map from change number to changelist (as returned by "p4 change
+    # -o") for the changelists fetched in this poll.  Used by
+    # changed_entities and replicate_fixes_p4_to_dt so that each
+    # changelist is fetched from Perforce at most once per poll.
+    # Cleared by clear_poll_caches at the start and end of each poll.
+    changelist_cache = {}
+
+    # Map from Perforce job name (in lower case, since job names are
+    # compared case-insensitively; see job000313) to the list of fixes
+    # for that job, for the jobs whose fixes have been fetched in this
+    # poll.  Used by job_fixes.  Cleared by clear_poll_caches at the
+    # start and end of each poll.
+    fixes_index = {}
+
+    def clear_poll_caches(self):
+        self.changelist_cache = {}
+        self.fixes_index = {}
+
+    # fetch_changelists(change_numbers).  Fetch the changelists with the
+    # given numbers which aren't already in the cache, all at once, and
+    # add them to the cache.  Changelists which can't be fetched are
+    # left out of the cache.
+
+    def fetch_changelists(self, change_numbers):
+        wanted = []
+        for change_number in change_numbers:
+            change_number = int(change_number)
+            if (not self.changelist_cache.has_key(change_number)
+                and change_number not in wanted):
+                wanted.append(change_number)
+        batch = self.p4.run_batch('change -o', map(str, wanted))
+        for change_number, (results, message) in map(None, wanted, batch):
+            if not message:
+                self.changelist_cache[change_number] = results[0]
+
+    # changelist(change_number).  Return the changelist with the given
+    # number, from the cache if possible.  Raise p4.error if it can't
+    # be fetched.
+
+    def changelist(self, change_number):
+        change_number = int(change_number)
+        if not self.changelist_cache.has_key(change_number):
+            changelist = self.p4.run('change -o %d' % change_number)[0]
+            self.changelist_cache[change_number] = changelist
+        return self.changelist_cache[change_number]
+
+    # The job cache.  This is a least-recently-used cache (see lru.py)
+    # of the jobs we've fetched from Perforce or written to Perforce,
+    # kept from one poll to the next, so that we don't have to fetch a
+    # job again when its issue changes.  The keys are job names in
+    # lower case; the values are dictionaries with keys 'job' (a copy
+    # of the job) and 'fixes' (the list of fixes for the job, or None
+    # if we don't know them).
+    #
+    # Every change to a job makes an entry in the Perforce logger.
+    # changed_entities accounts for the entries made by our own writes
+    # (see job_updates); any other entry for a job means someone else
+    # changed it, and the job is removed from the cache.  When we write
+    # a job, we cache it as Perforce saved it (see update_job).  The
+    # jobs that a changelist fixes are removed when the changelist
+    # changes (since submitting a changelist can change the status of
+    # its jobs), and the fixes of all jobs are forgotten (since
+    # submitting can renumber the fixes).
+    #
+    # Callers get copies of the cached jobs, because they update the
+    # jobs they are given.
+
+    job_cache = None
+
+    # The maximum number of jobs in the job cache.
+    job_cache_size = 1000
+
+    # cache_job(job).  Store a copy of the job in the job cache,
+    # keeping any fixes we already know.
+
+    def cache_job(self, job):
+        key = string.lower(job['Job'])
+        fixes = self.cached_fixes(key)
+        self.job_cache.put(key, {'job': job.copy(), 'fixes': fixes})
+
+    # cached_job(jobname).  Return a copy of the job from the job cache,
+    # or None if it's not there.
+
+    def cached_job(self, jobname):
+        entry = self.job_cache.get(string.lower(jobname))
+        if entry == None:
+            return None
+        return entry['job'].copy()
+
+    # forget_cached_fixes().  Forget the fixes of all the jobs in the
+    # job cache.
+
+    def forget_cached_fixes(self):
+        for entry in self.job_cache.values():
+            entry['fixes'] = None
+
+    # forget_changelist_jobs(change_numbers).  Remove the jobs fixed by
+    # the given changelists from the job cache.  If we couldn't fetch a
+    # changelist, we don't know which jobs it fixes, so we empty the
+    # cache.
+
+    def forget_changelist_jobs(self, change_numbers):
+        for change_number in change_numbers:
+            changelist = self.changelist_cache.get(int(change_number))
+            if not changelist:
+                self.job_cache.clear()
+                return
+            for key, value in changelist.items():
+                if key[:4] == 'Jobs':
+                    self.job_cache.remove(string.lower(value))
+
+    # log_job_cache_statistics().  Log the hit rate of the job cache for
+    # this poll, and start counting again.
+
+    def log_job_cache_statistics(self):
+        cache = self.job_cache
+        if cache.hits or cache.misses:
+            # "Job cache: %d hits and %d misses; %d jobs cached."
+            self.log(939, (cache.hits, cache.misses, len(cache)))
+            self.metrics.count('job_cache_requests_total',
+                               (('result', 'hit'),), cache.hits)
+            self.metrics.count('job_cache_requests_total',
+                               (('result', 'miss'),), cache.misses)
+        cache.hits = 0
+        cache.misses = 0
+
     # job(jobname).  Return the Perforce job with the given name if it
     # exists, or an empty job specification (otherwise).
 
     def job(self, jobname):
         assert isinstance(jobname, basestring)
-        jobs = self.p4.run('job -o %s' % jobname)
+        job = self.cached_job(jobname)
+        if job == None:
+            job = self.check_job(jobname,
+                                 self.p4.run('job -o %s' % jobname))
+            self.cache_job(job)
+        return job
+
+    # fetch_jobs(jobnames).  Return a list of the Perforce jobs with the
+    # given names (in the same order).  Jobs that aren't in the job
+    # cache are fetched with a single Perforce client.
+
+    def fetch_jobs(self, jobnames):
+        assert isinstance(jobnames, types.ListType)
+        jobs = map(self.cached_job, jobnames)
+        wanted = []
+        for jobname, job in map(None, jobnames, jobs):
+            if job == None:
+                wanted.append(jobname)
+        batch = self.p4.run_batch('job -o', wanted)
+        fetched = {}
+        for jobname, (results, message) in map(None, wanted, batch):
+            if message:
+                raise p4.error, message
+            job = self.check_job(jobname, results)
+            self.cache_job(job)
+            fetched[jobname] = job
+        for i in range(len(jobnames)):
+            if jobs[i] == None:
+                jobs[i] = fetched[jobnames[i]]
+        return jobs
+
+    # query_jobs(jobnames).  Return a map from jobname to job for the
+    # named jobs.  The jobs are fetched with "p4 jobs -e" queries that
+    # ask for up to jobs_query_size jobs at once, so the number of
+    # Perforce commands doesn't grow with the number of jobs.
+    #
+    # A query like "Job=foo" matches by word and ignores case, so we
+    # check the names of the jobs we get back.  Jobnames containing
+    # characters that have a meaning in a job query are fetched
+    # individually instead, and so are any jobs that the queries don't
+    # return (Perforce's rules for matching words in queries are
+    # subtle), so that no changed job is missed.
+
+    jobs_query_size = 50
+
+    simple_jobname_re = re.compile('^[A-Za-z0-9_]+$')
+
+    def query_jobs(self, jobnames):
+        assert isinstance(jobnames, types.ListType)
+        jobs = {}
+        simple = []
+        others = []
+        for jobname in jobnames:
+            if self.simple_jobname_re.match(jobname):
+                simple.append(jobname)
+            else:
+                others.append(jobname)
+        for i in range(0, len(simple), self.jobs_query_size):
+            names = simple[i:i + self.jobs_query_size]
+            wanted = {}
+            for jobname in names:
+                wanted[string.lower(jobname)] = jobname
+            query = string.join(map(lambda n: 'Job=' + n, names), '|')
+            for job in self.p4.run('jobs -e %s' % query):
+                jobname = wanted.get(string.lower(job.get('Job', '')))
+                if jobname:
+                    jobs[jobname] = job
+            for jobname in names:
+                if not jobs.has_key(jobname):
+                    others.append(jobname)
+        for jobname, job in map(None, others, self.fetch_jobs(others)):
+            jobs[jobname] = job
+        return jobs
+
+    # check_job(jobname, jobs).  Check that the output of "p4 job -o
+    # jobname" is a single job with the right name, and return it.
+
+    def check_job(self, jobname, jobs):
         if len(jobs) != 1 or not jobs[0].has_key('Job'):
             # "Expected a job but found %s."
             raise self.error, catalog.msg(837, str(jobs))
@@ -415,7 +691,73 @@ class replicator:
 
     def job_fixes(self, job):
         assert isinstance(job, types.DictType)
-        return self.p4.run('fixes -j %s' % job['Job'])
+        key = string.lower(job['Job'])
+        if not self.fixes_index.has_key(key):
+            fixes = self.cached_fixes(key)
+            if fixes == None:
+                fixes = self.p4.run('fixes -j %s' % job['Job'])
+                self.cache_fixes(key, fixes)
+            self.fixes_index[key] = fixes
+        return self.fixes_index[key]
+
+    # cached_fixes(key).  Return the fixes for the job from the job
+    # cache, or None if they're not there.  cache_fixes(key, fixes).
+    # Store the fixes in the job cache, if the job is there.  The key
+    # is the job name in lower case.
+
+    def cached_fixes(self, key):
+        entry = self.job_cache.peek(key)
+        if entry == None:
+            return None
+        return entry['fixes']
+
+    def cache_fixes(self, key, fixes):
+        entry = self.job_cache.peek(key)
+        if entry != None:
+            entry['fixes'] = fixes
+
+    # index_fixes(jobnames).  Fetch the fixes for all the named jobs
+    # that aren't in the fixes index, in batches of fixes_chunk_size
+    # jobs, and add them to the index.  A job is added to the index
+    # only when its batch has succeeded, so that a failure doesn't
+    # leave jobs in the index with no fixes.
+
+    fixes_chunk_size = 500
+
+    def index_fixes(self, jobnames):
+        if not self.feature['fixes'] and self.p4.supports('fix_update'):
+            return
+        wanted = []
+        for jobname in jobnames:
+            key = string.lower(jobname)
+            if jobname == 'new' or self.fixes_index.has_key(key):
+                continue
+            fixes = self.cached_fixes(key)
+            if fixes != None:
+                self.fixes_index[key] = fixes
+            else:
+                wanted.append(jobname)
+        for i in range(0, len(wanted), self.fixes_chunk_size):
+            chunk = wanted[i:i + self.fixes_chunk_size]
+            index = {}
+            for jobname in chunk:
+                index[string.lower(jobname)] = []
+            for fix in self.p4.run_batch_all('fixes -j', chunk):
+                key = string.lower(fix['Job'])
+                if index.has_key(key):
+                    index[key].append(fix)
+            for key, fixes in index.items():
+                self.fixes_index[key] = fixes
+                self.cache_fixes(key, fixes)
+
+    # forget_fixes(job).  Remove the job from the fixes index, because
+    # we've changed its fixes.
+
+    def forget_fixes(self, job):
+        key = string.lower(job['Job'])
+        if self.fixes_index.has_key(key):
+            del self.fixes_index[key]
+        self.cache_fixes(key, None)
 
     # job_format(job).  Format a job so that people can read it.  Also,
     # indent the first line of the job so that it can be included in the
@@ -541,6 +883,10 @@ class replicator:
     # the given changes.  Also update the "job" dictionary to reflect
     # these changes, and also any changes made by Perforce, such as
     # picking up the new jobname (if job['Job'] is 'new').
+    #
+    # When Perforce saves the job, it may change fields itself (such as
+    # the date, and the fields it sets "always"), so we fetch the job
+    # as saved and put that in the job cache.
 
     update_job_re = re.compile('^Job ([^ ]+) (.*)')
 
@@ -553,6 +899,9 @@ class replicator:
             command = 'job -i -f'
         else:
             command = 'job -i'
+        # Until we know what happened, our copy of the job in the job
+        # cache is no good.
+        self.job_cache.remove(string.lower(job['Job']))
         results = self.p4.run(command, job)
 
         # Check that the results of the 'job -i' command are as
@@ -575,6 +924,11 @@ class replicator:
                                                     results[0]['data']))
             if match.group(2) == 'saved.':
                 self.record_job_update(job)
+                saved = self.check_job(job['Job'],
+                                       self.p4.run('job -o %s' % job['Job']))
+                job.clear()
+                job.update(saved)
+            self.cache_job(job)
         else:
             # "Unexpected output from Perforce command 'job -i': %s."
             raise self.error, catalog.msg(898, results)
@@ -618,8 +972,10 @@ class replicator:
             issues_cursor = list_cursor(issues_cursor)
         issue_id_to_job = {}
         jobs = {}
-        for j in self.p4.run('jobs -e P4DTI-rid=%s' % self.rid):
+        for j in self.p4.run_iter('jobs -e P4DTI-rid=%s' % self.rid):
             jobs[j['Job']] = j
+        self.clear_poll_caches()
+        self.index_fixes(jobs.keys())
 
         while 1:
             issue = issues_cursor.fetchone()
@@ -687,6 +1043,8 @@ class replicator:
                 self.log(882, (job['Job'], job_issue_id))
                 n = n + 1
 
+        self.clear_poll_caches()
+
         # Report on success/failure.
         if len(issue_id_to_job) == 1:
             # "Consistency check completed.  1 issue checked."
@@ -794,7 +1152,11 @@ class replicator:
             # "Defect tracker '%s' does not support migration of
             # Perforce jobs."
             raise self.error, catalog.msg(905, self.config.dt_name)
-        jobs = self.all_jobs()
+        # Read all the jobs before we change any of them: while a "p4
+        # jobs" command is running, the server may hold a lock on the
+        # jobs table that our own writes would wait for.
+        jobs = list(self.all_jobs())
+        self.clear_poll_caches()
         try:
             self.dt.new_issues_start()
             for job in jobs:
@@ -831,6 +1193,7 @@ class replicator:
                     self.replicate_filespecs_p4_to_dt(issue, job)
                     self.replicate_fixes_p4_to_dt(issue, job)
         finally:
+            self.clear_poll_caches()
             self.dt.new_issues_end()
 
         # "Migration completed."
@@ -858,9 +1221,13 @@ class replicator:
 
     def carefully_poll_databases(self):
         try:
-            self.poll_databases()
-            # Reset poll period when the poll was successful.
-            self.poll_period = self.config.poll_period
+            try:
+                self.maybe_profile_poll()
+                # Reset poll period when the poll was successful.
+                self.poll_period = self.config.poll_period
+            except:
+                self.metrics.count('polls_total', (('result', 'failed'),))
+                raise
         except AssertionError:
             # Assertions indicate severe bugs in the replicator.  It
             # might cause serious data corruption if we continue.
@@ -883,6 +1250,7 @@ class replicator:
             # exponentially so as not to mail bomb the admin.  See
             # job000215 and job000135.
             self.poll_period = self.poll_period * 2
+        self.write_metrics()
 
     # prepare_to_run(). Invoked once when run() is called, to preform
     # startup tasks.
@@ -892,6 +1260,8 @@ class replicator:
         self.update_and_check_jobspec()
         self.start_logger()
         self.poll_period = self.config.poll_period
+        self.open_wakeup_socket()
+        self.catch_profile_signal()
         self.mail_startup_message()
 
     # run().  Repeatedly (handling exceptions) poll and replicate
@@ -901,7 +1271,313 @@ class replicator:
         self.prepare_to_run()
         while 1:
             self.carefully_poll_databases()
+            self.wait_for_wakeup()
+
+    # The wakeup socket.  If the wakeup_socket configuration parameter
+    # is not None, the replicator listens on a Unix domain datagram
+    # socket with that name.  A Perforce trigger (see
+    # wakeup_trigger.py) can send a message to the socket when
+    # something changes, and the replicator polls straight away instead
+    # of waiting for the end of the poll period.  The poll period still
+    # applies when there are no messages.
+    #
+    # The socket gets the permissions given by the wakeup_socket_mode
+    # configuration parameter, so that only the users who need to can
+    # wake the replicator.  It's removed when the replicator exits.
+    #
+    # The defect tracker can wake the replicator too, if it has a
+    # wakeup_pending method (see dt_bugzilla.wakeup_pending): while
+    # waiting, the replicator asks it every dt_wakeup_period seconds
+    # whether anything has changed.
+
+    wakeup_socket = None
+
+    # The status of the socket file (from os.stat) when we created it.
+    wakeup_socket_stat = None
+
+    # When a wakeup message arrives, wait this many seconds before
+    # polling, so that a burst of messages (for example, from a
+    # changelist that fixes several jobs) results in a single poll.
+    wakeup_debounce = 0.5
+
+    # open_wakeup_socket().  Start listening on the wakeup socket, if
+    # there is one.  If we can't (for example, on an operating system
+    # without Unix domain sockets), log a warning and carry on polling
+    # every poll period.
+
+    def open_wakeup_socket(self):
+        path = self.config.wakeup_socket
+        if path == None:
+            return
+        mode = self.config.wakeup_socket_mode
+        try:
+            # Remove the socket left behind by a replicator that didn't
+            # exit cleanly, but don't remove anything else.
+            if os.path.exists(path):
+                if not stat.S_ISSOCK(os.stat(path)[stat.ST_MODE]):
+                    # "'%s' exists and is not a socket."
+                    raise socket.error, catalog.msg(944, path)
+                os.remove(path)
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            # Create the socket with no more permissions than it
+            # should have, and then give it exactly those.
+            umask = os.umask(0777 & ~mode)
+            try:
+                s.bind(path)
+            finally:
+                os.umask(umask)
+            os.chmod(path, mode)
+            s.setblocking(0)
+        except (AttributeError, os.error, socket.error), e:
+            # "Can't listen for wakeup messages on socket '%s': %s.
+            # Polling every %d seconds instead."
+            self.log(932, (path, str(e), self.config.poll_period))
+            return
+        self.wakeup_socket = s
+        self.wakeup_socket_stat = os.stat(path)
+        atexit.register(self.close_wakeup_socket)
+        self.catch_terminate_signal()
+        # "Listening for wakeup messages on socket '%s'."
+        self.log(931, path)
+
+    # close_wakeup_socket().  Stop listening on the wakeup socket and
+    # remove it, unless another replicator has replaced it with its
+    # own.
+
+    def close_wakeup_socket(self):
+        if self.wakeup_socket == None:
+            return
+        path = self.config.wakeup_socket
+        try:
+            self.wakeup_socket.close()
+            st = os.stat(path)
+            if (st[stat.ST_INO] == self.wakeup_socket_stat[stat.ST_INO]
+                and st[stat.ST_DEV] == self.wakeup_socket_stat[stat.ST_DEV]):
+                os.remove(path)
+        except (os.error, socket.error):
+            pass
+        self.wakeup_socket = None
+
+    # catch_terminate_signal().  Remove the wakeup socket when we get
+    # the signal SIGTERM (which is how the startup script stops the
+    # replicator), and then terminate as before.  If someone else is
+    # handling the signal, leave it to them.
+
+    def catch_terminate_signal(self):
+        if (not hasattr(signal, 'SIGTERM')
+            or signal.getsignal(signal.SIGTERM) != signal.SIG_DFL):
+            return
+        def handler(signum, frame, self = self):
+            self.close_wakeup_socket()
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+        try:
+            signal.signal(signal.SIGTERM, handler)
+        except ValueError:
+            # Not in the main thread, so we can't catch signals.
+            pass
+
+    # read_wakeup_messages().  Read and discard all the messages
+    # waiting on the wakeup socket; return the number of messages.
+
+    def read_wakeup_messages(self):
+        count = 0
+        while 1:
+            try:
+                self.wakeup_socket.recv(512)
+            except socket.error:
+                return count
+            count = count + 1
+
+    # Number of seconds between asking the defect tracker whether it
+    # has changes, while waiting for the next poll.
+    dt_wakeup_period = 2
+
+    # dt_wakeup_pending().  Return 1 if the defect tracker says it has
+    # changes (see wakeup_pending in the defect tracker interface), 0
+    # if it says not, or None if it can't tell.  If asking fails, poll
+    # anyway: the poll will report the problem.
+
+    def dt_wakeup_pending(self):
+        if not hasattr(self.dt, 'wakeup_pending'):
+            return None
+        try:
+            return self.dt.wakeup_pending()
+        except KeyboardInterrupt:
+            raise
+        except:
+            return 1
+
+    # wait_for_wakeup().  Wait until it's time for the next poll: that
+    # is, until the poll period has elapsed, a message arrives on the
+    # wakeup socket, or the defect tracker says it has changes.
+    #
+    # After a failed poll, the poll period is backed off (see
+    # carefully_poll_databases) and we ignore wakeups until the end of
+    # the period, so that a stream of changes doesn't cause a stream of
+    # failures to be reported.
+
+    def wait_for_wakeup(self):
+        if self.poll_period != self.config.poll_period:
+            watch_dt = None
+        else:
+            watch_dt = self.dt_wakeup_pending()
+        if ((self.wakeup_socket == None and watch_dt == None)
+            or self.poll_period != self.config.poll_period):
             time.sleep(self.poll_period)
+            if self.wakeup_socket != None:
+                # We're about to poll, so any messages that arrived
+                # meanwhile have been dealt with.
+                self.read_wakeup_messages()
+            return
+        deadline = time.time() + self.poll_period
+        while 1:
+            if watch_dt:
+                # "Woken up by changes in the defect tracker."
+                self.log(943)
+                return
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                return
+            if watch_dt != None:
+                timeout = min(timeout, self.dt_wakeup_period)
+            if self.wakeup_socket == None:
+                time.sleep(timeout)
+                ready = []
+            else:
+                try:
+                    ready, _, _ = select.select([self.wakeup_socket],
+                                                [], [], timeout)
+                except select.error, e:
+                    # Interrupted by a signal (see catch_profile_signal).
+                    if e[0] != errno.EINTR:
+                        raise
+                    ready = []
+            if ready:
+                time.sleep(self.wakeup_debounce)
+                # "Woken up by %d wakeup messages."
+                self.log(933, self.read_wakeup_messages())
+                return
+            if watch_dt != None:
+                watch_dt = self.dt_wakeup_pending()
+
+    # Profiling polls.  The replicator profiles the first
+    # profile_polls polls (see the configuration parameter), and the
+    # next poll after it gets the signal SIGUSR1 (on operating systems
+    # that have it).  The profile of each poll is written to a pstats
+    # file in the same directory as the log file (see the pstats
+    # module in the Python library for how to read it), and a summary
+    # is written to the log.  When no poll is being profiled the only
+    # cost is checking polls_to_profile.
+
+    # Number of polls made (for naming the profile files).
+    poll_count = 0
+
+    # Number of polls still to profile.
+    polls_to_profile = 0
+
+    # True while a poll is being profiled.  The profiler only sees the
+    # thread that runs it, so while profiling we do everything on that
+    # thread (see fetch_changes and replicate_many).
+    profiling = 0
+
+    # Number of functions to list in the profile summary.
+    profile_summary_length = 20
+
+    # catch_profile_signal().  Profile the next poll when we get the
+    # signal SIGUSR1.
+
+    def catch_profile_signal(self):
+        if not hasattr(signal, 'SIGUSR1'):
+            return
+        def handler(signum, frame, self = self):
+            self.polls_to_profile = self.polls_to_profile + 1
+        try:
+            signal.signal(signal.SIGUSR1, handler)
+        except ValueError:
+            # Not in the main thread, so we can't catch signals.
+            return
+        # Restart system calls that the signal interrupts, so that
+        # reading from or writing to a pipe to Perforce doesn't fail
+        # with EINTR when the signal arrives in the middle of a poll.
+        if hasattr(signal, 'siginterrupt'):
+            signal.siginterrupt(signal.SIGUSR1, False)
+
+    # maybe_profile_poll().  Poll the databases, profiling the poll if
+    # we've been asked to.
+
+    def maybe_profile_poll(self):
+        self.poll_count = self.poll_count + 1
+        if self.polls_to_profile <= 0:
+            self.poll_databases()
+            return
+        self.polls_to_profile = self.polls_to_profile - 1
+        profiler = profile.Profile()
+        self.profiling = 1
+        try:
+            profiler.runcall(self.poll_databases)
+        finally:
+            self.profiling = 0
+            self.write_profile(profiler)
+
+    # write_profile(profiler).  Write the profile of the current poll
+    # to a pstats file and a summary to the log.
+
+    def write_profile(self, profiler):
+        if self.config.log_file != None:
+            directory = os.path.dirname(os.path.abspath(
+                self.config.log_file))
+        else:
+            directory = os.getcwd()
+        path = os.path.join(directory, 'p4dti-poll-%d-%s.pstats'
+                            % (self.poll_count,
+                               time.strftime('%Y%m%d-%H%M%S',
+                                             time.localtime(time.time()))))
+        try:
+            profiler.dump_stats(path)
+        except (IOError, os.error), e:
+            # "Couldn't write profile of poll %d to '%s': %s."
+            self.log(937, (self.poll_count, path, str(e)))
+        else:
+            # "Wrote profile of poll %d to '%s'."
+            self.log(936, (self.poll_count, path))
+        # The pstats module is only needed here, and some Python
+        # distributions package it separately.
+        try:
+            import pstats
+        except ImportError:
+            # "Can't summarize profile of poll %d: the pstats module
+            # is not available."
+            self.log(942, self.poll_count)
+            return
+        summary = StringIO.StringIO()
+        stats = pstats.Stats(profiler, stream = summary)
+        stats.sort_stats('cumulative')
+        stats.print_stats(self.profile_summary_length)
+        # "Profile of poll %d, by cumulative time: %s"
+        self.log(938, (self.poll_count, summary.getvalue()))
+
+    # write_metrics().  Write the performance statistics to the file
+    # named by the metrics_file configuration parameter, if it's not
+    # None.  If we can't, log a warning (but only once until we
+    # succeed again, so as not to fill the log) and carry on.
+
+    metrics_failed = 0
+
+    def write_metrics(self):
+        path = self.config.metrics_file
+        if path == None:
+            return
+        self.metrics.set('poll_period_seconds', self.poll_period)
+        try:
+            self.metrics.write(path)
+        except (IOError, os.error), e:
+            if not self.metrics_failed:
+                # "Couldn't write replicator statistics to '%s': %s."
+                self.log(935, (path, str(e)))
+                self.metrics_failed = 1
+            return
+        self.metrics_failed = 0
 
 
     # 4.6. E-mail
@@ -1196,39 +1872,145 @@ class replicator:
     # entities.
 
     def poll_databases(self):
+        start = time.time()
+        if not self.changes_pending():
+            # "Nothing has changed since the last poll: skipping poll."
+            self.log(934)
+            self.metrics.count('polls_total', (('result', 'skipped'),))
+            return
         # "Poll starting."
         self.log(911)
+        t = self.record_poll_phase('check', start)
+        self.clear_poll_caches()
         if hasattr(self.dt, 'poll_start'):
             self.dt.poll_start()
         try:
-            # Get the changed issues (ignore changed changelists if any
-            # since we only replicate changelists from Perforce to the
-            # defect tracker).
-            changed_issues, _, dt_marker = self.dt.changed_entities()
-            # Support old changed_entities specification [GDR
-            # 2000-10-16, 13.1].
-            if not hasattr(changed_issues, 'fetchone'):
-                changed_issues = list_cursor(changed_issues)
-            changed_jobs, changelists, p4_marker = self.changed_entities()
+            (changed_issues, dt_marker,
+             changed_jobs, changelists, p4_marker) = self.fetch_changes()
+            t = self.record_poll_phase('fetch', t)
 
             # Replicate the issues and the jobs.
             self.replicate_many(changed_issues, changed_jobs)
+            t = self.record_poll_phase('replicate', t)
 
             # Replicate the affected changelists.
             if self.feature['fixes']:
                 for c in changelists:
                     self.replicate_changelist_p4_to_dt(c)
+                self.metrics.set('poll_changelists', len(changelists))
+            t = self.record_poll_phase('changelists', t)
 
             # Tell the defect tracker and Perforce that we've finished
             # replicating these changes.
             self.dt.mark_changes_done(dt_marker)
             self.mark_changes_done(p4_marker)
         finally:
+            self.clear_poll_caches()
             if hasattr(self.dt, 'poll_end'):
                 self.dt.poll_end()
+        self.record_poll_phase('finish', t)
+        self.log_job_cache_statistics()
+        self.metrics.observe('poll_seconds', time.time() - start)
+        self.metrics.count('polls_total', (('result', 'completed'),))
         # "Poll finished."
         self.log(912)
 
+    # record_poll_phase(phase, start).  Record the time taken by a
+    # phase of the poll that started at time start.  Return the time
+    # now (the start of the next phase).
+
+    def record_poll_phase(self, phase, start):
+        now = time.time()
+        self.metrics.set('poll_phase_seconds', now - start,
+                         (('phase', phase),))
+        return now
+
+    # changes_pending().  Return true if there may be changes to
+    # replicate, false if we're sure there aren't.  This is much
+    # cheaper than a poll, which (for Bugzilla) locks many tables and
+    # runs several expensive queries, so we check this first.
+    #
+    # There are changes in Perforce if the logger counter differs from
+    # the replicator's counter (they are the same when the replicator
+    # has consumed all the log entries).  The defect tracker may
+    # provide a changes_pending() method to say whether there are
+    # changes in the defect tracker; if it doesn't, we always poll.
+    #
+    # We read the counters on every poll (even when we are going to
+    # poll anyway) so that the unreplicated_log_entries gauge is never
+    # stale.  If the server can't report counter values, we remove the
+    # gauge rather than leave an old value in the statistics.
+
+    def changes_pending(self):
+        if not self.p4.supports('counter_value'):
+            self.metrics.unset('unreplicated_log_entries')
+            return 1
+        counters = {}
+        for c in self.p4.run('counters'):
+            counters[string.lower(c.get('counter', ''))] = c.get('value')
+        logger_counter = counters.get('logger', '0')
+        replicator_counter = counters.get(string.lower(self.counter), '0')
+        self.metrics.set('unreplicated_log_entries',
+                         int(logger_counter) - int(replicator_counter))
+        if (self.deferred
+            or not hasattr(self.dt, 'changes_pending')
+            or logger_counter != replicator_counter):
+            return 1
+        return self.dt.changes_pending()
+
+    # fetch_changes().  Get the changed issues from the defect tracker
+    # and the changed jobs and changelists from Perforce.  Return a
+    # tuple (changed issues, defect tracker marker, changed jobs,
+    # changelists, Perforce marker).
+    #
+    # The two fetches don't depend on each other, so we fetch from
+    # Perforce in a separate thread while we fetch from the defect
+    # tracker in this one.  The defect tracker interface is only used
+    # by this thread, and the Perforce interface is only used by the
+    # other thread until it has finished.
+
+    def fetch_changes(self):
+        result = {}
+        def fetch_p4(self = self, result = result):
+            start = time.time()
+            try:
+                result['p4'] = self.changed_entities()
+            except:
+                result['failure'] = sys.exc_info()
+            result['p4_time'] = time.time() - start
+
+        start = time.time()
+        if self.profiling:
+            # Fetch from Perforce first, on this thread.
+            fetch_p4()
+            thread = None
+        else:
+            thread = threading.Thread(target = fetch_p4)
+            thread.start()
+        dt_start = time.time()
+        try:
+            # Get the changed issues (ignore changed changelists if any
+            # since we only replicate changelists from Perforce to the
+            # defect tracker).
+            changed_issues, _, dt_marker = self.dt.changed_entities()
+            # Support old changed_entities specification [GDR
+            # 2000-10-16, 13.1].
+            if not hasattr(changed_issues, 'fetchone'):
+                changed_issues = list_cursor(changed_issues)
+            dt_time = time.time() - dt_start
+        finally:
+            if thread:
+                thread.join()
+        if result.has_key('failure'):
+            exc_type, exc_value, exc_traceback = result['failure']
+            raise exc_type, exc_value, exc_traceback
+        changed_jobs, changelists, p4_marker = result['p4']
+        # "Fetched changes in %.3f seconds (defect tracker %.3f
+        # seconds, Perforce %.3f seconds)."
+        self.log(930, (time.time() - start, dt_time, result['p4_time']))
+        return (changed_issues, dt_marker,
+                changed_jobs, changelists, p4_marker)
+
     # replicate_all_dt_to_p4().  Go through all the issues in the defect
     # tracker, set them up for replication if necessary, and replicate
     # them to Perforce.
@@ -1296,7 +2078,25 @@ class replicator:
     def replicate_many(self, issues_cursor, jobs):
         assert hasattr(issues_cursor, 'fetchone')
         assert isinstance(jobs, types.DictType)
+        deferred = self.deferred
+        self.deferred = {}
+        try:
+            self.replicate_many_1(issues_cursor, jobs, deferred)
+        except:
+            # Keep the deferred replications for the next poll.
+            for jobname, issue_id in deferred.items():
+                self.deferred.setdefault(jobname, issue_id)
+            raise
 
+    def replicate_many_1(self, issues_cursor, jobs, deferred):
+        # Pair up the issues with their jobs, noting which jobs we
+        # need to fetch from Perforce.  Skip issues that have changed
+        # only in the defect tracker, if they haven't changed in any
+        # way that matters since we last replicated them (see
+        # issue_digest).
+        pairs = []
+        fetch = []
+        unchanged = 0
         while 1:
             issue = issues_cursor.fetchone()
             if issue == None:
@@ -1311,27 +2111,154 @@ class replicator:
 
             jobname = self.issue_jobname(issue)
             if jobs.has_key(jobname):
-                job = jobs[jobname]
-                self.replicate(issue, job, 'both')
+                # If the issue's replicated fields haven't changed
+                # since we last replicated it (for example, because
+                # the issue was found again in the overlap between
+                # polls; see bugzilla.changes_window_start), then only
+                # the job has really changed, and there's no conflict.
+                if (not deferred.has_key(jobname)
+                    and self.issue_unchanged(issue)):
+                    changed = 'p4'
+                else:
+                    changed = 'both'
+                pairs.append((issue, jobs[jobname], changed))
                 del jobs[jobname]
+            elif deferred.has_key(jobname):
+                pairs.append((issue, jobname, 'both'))
+                fetch.append(jobname)
+            elif self.issue_unchanged(issue):
+                # "Issue '%s' hasn't changed since it was last
+                # replicated."
+                self.log(940, issue.readable_name())
+                unchanged = unchanged + 1
             else:
-                job = self.job(jobname)
-                self.replicate(issue, job, 'dt')
-
-        # Now go through the remaining changed jobs.
+                pairs.append((issue, jobname, 'dt'))
+                fetch.append(jobname)
+            if deferred.has_key(jobname):
+                del deferred[jobname]
+
+        # The remaining deferred replications count as changes to both
+        # the issue and the job, even if neither has changed since.
+        for jobname, issue_id in deferred.items():
+            issue = self.dt.issue(issue_id)
+            if not issue:
+                # "Asked for issue '%s' but got an error instead."
+                raise self.error, catalog.msg(888, issue_id)
+            if jobs.has_key(jobname):
+                pairs.append((issue, jobs[jobname], 'both'))
+                del jobs[jobname]
+            else:
+                pairs.append((issue, jobname, 'both'))
+                fetch.append(jobname)
+
+        self.metrics.set('poll_issues', len(pairs))
+        self.metrics.set('poll_unchanged_issues', unchanged)
+        self.metrics.set('poll_jobs', len(jobs))
+
+        # Fetch the jobs that haven't changed in Perforce (for which
+        # the pairs have only a jobname), all at once, and then the
+        # fixes for all the jobs.
+        fetched = self.fetch_jobs(fetch)
+        self.index_fixes(map(lambda p: p[1]['Job'],
+                             filter(lambda p: isinstance(p[1],
+                                                         types.DictType),
+                                    pairs))
+                         + map(lambda j: j['Job'], fetched)
+                         + map(lambda j: j['Job'], jobs.values()))
+        # Make a list of work to do: triples (jobname, function,
+        # arguments).  The issues come first, and then the remaining
+        # changed jobs.
+        work = []
+        for issue, job, changed in pairs:
+            if not isinstance(job, types.DictType):
+                job = fetched[0]
+                del fetched[0]
+            work.append((job['Job'], self.replicate, (issue, job, changed)))
         for job in jobs.values():
             assert isinstance(job, types.DictType)
-            issue_id = job.get('P4DTI-issue-id', 'None')
-            if issue_id != 'None':
-                issue = self.dt.issue(issue_id)
-                if not issue:
-                    # "Asked for issue '%s' but got an error instead."
-                    raise self.error, catalog.msg(888, issue_id)
-                self.replicate(issue, job, 'p4')
-            else:
-                # Job is new in Perforce, so create new issue in the
-                # defect tracker.
-                self.replicate_new_issue_p4_to_dt(job)
+            work.append((job['Job'], self.replicate_changed_job, (job,)))
+
+        if (self.config.replication_workers > 1 and len(work) > 1
+            and not self.profiling):
+            self.replicate_in_parallel(work)
+        else:
+            for jobname, function, args in work:
+                apply(function, args)
+
+    # replicate_changed_job(job).  Replicate a job that has changed in
+    # Perforce, but whose issue hasn't changed in the defect tracker.
+
+    def replicate_changed_job(self, job):
+        issue_id = job.get('P4DTI-issue-id', 'None')
+        if issue_id != 'None':
+            issue = self.dt.issue(issue_id)
+            if not issue:
+                # "Asked for issue '%s' but got an error instead."
+                raise self.error, catalog.msg(888, issue_id)
+            self.replicate(issue, job, 'p4')
+        else:
+            # Job is new in Perforce, so create new issue in the
+            # defect tracker.
+            self.replicate_new_issue_p4_to_dt(job)
+
+    # replicate_in_parallel(work).  Do the work (a list of triples
+    # (jobname, function, arguments) as built by replicate_many) using
+    # config.replication_workers threads.
+    #
+    # The work is divided between the threads by jobname, so that two
+    # threads never work on the same job at once; each thread does its
+    # share in order.  The threads take turns to hold a lock, which
+    # is released only while a thread waits for a Perforce command to
+    # finish (see p4.io_lock).  So all the defect tracker operations
+    # (which share a single database connection and its table locks),
+    # all the logging, and all the updates to the replicator's own
+    # state (such as job_updates) happen one at a time, just as they
+    # do when there is only one worker; only the waits for Perforce
+    # overlap.
+    #
+    # If any of the work fails, the threads stop taking new work, and
+    # the first exception is raised again once they have all finished.
+
+    def replicate_in_parallel(self, work):
+        n_workers = min(self.config.replication_workers, len(work))
+        shares = []
+        for i in range(n_workers):
+            shares.append([])
+        for item in work:
+            shares[hash(string.lower(item[0])) % n_workers].append(item)
+        shares = filter(None, shares)
+        # "Replicating %d issues and jobs using %d workers."
+        self.log(929, (len(work), len(shares)))
+
+        lock = threading.Lock()
+        failures = []
+        def worker(share, lock = lock, failures = failures):
+            lock.acquire()
+            try:
+                for jobname, function, args in share:
+                    if failures:
+                        break
+                    try:
+                        apply(function, args)
+                    except:
+                        failures.append(sys.exc_info())
+            finally:
+                lock.release()
+
+        threads = []
+        self.p4.io_lock = lock
+        try:
+            for share in shares:
+                t = threading.Thread(target = worker, args = (share,))
+                t.start()
+                threads.append(t)
+            for t in threads:
+                t.join()
+        finally:
+            self.p4.io_lock = None
+        if failures:
+            exc_type, exc_value, exc_traceback = failures[0]
+            raise exc_type, exc_value, exc_traceback
 
     # Replicate newly-created job over to defect tracker
     def replicate_new_issue_p4_to_dt(self, job):
@@ -1410,6 +2337,10 @@ class replicator:
     #  4. Revert the job from the issue (if we tried to replicate the
     # job to the issue but it failed, probably due to lack of privileges
     # or invalid data).
+    #
+    #  5. Defer the replication to the next poll (if we tried to
+    # replicate the job to the issue but the issue changed in the
+    # meantime; see defer).
 
     def replicate(self, issue, job, changed, force = False):
         assert isinstance(issue, dt_interface.defect_tracker_issue)
@@ -1439,6 +2370,7 @@ class replicator:
                 issue.setup_for_replication(job['Job'])
                 # "Set up issue '%s' to replicate to job '%s'."
                 self.log(803, (issue.id(), job['Job']))
+            self.record_issue_digest(issue)
 
         # Only the Perforce job has changed.
         elif changed == 'p4':
@@ -1446,8 +2378,13 @@ class replicator:
             self.log(805, (jobname, issuename))
             try:
                 self.replicate_issue_p4_to_dt(issue, job)
+            except dt_interface.conflict:
+                self.defer(issue, job)
             except:
                 self.revert_issue_dt_to_p4(issue, job)
+                self.forget_issue_digest(issue)
+            else:
+                self.record_issue_digest(issue)
 
         # Both have changed.  Apply the conflict resolution policy.
         else:
@@ -1464,6 +2401,7 @@ class replicator:
                 # the issue."
                 reason = [ catalog.msg(841, (issuename, jobname)) ]
                 self.overwrite_issue_dt_to_p4(issue, job, reason, 0)
+                self.record_issue_digest(issue)
             elif decision == 'p4':
                 # "Defect tracker issue '%s' and Perforce job '%s'
                 # have both changed since the last time the replicator
@@ -1471,10 +2409,79 @@ class replicator:
                 # resolution policy decided to overwrite the issue
                 # with the job."
                 reason = [ catalog.msg(842, (issuename, jobname)) ]
-                self.overwrite_issue_p4_to_dt(issue, job, reason, 0)
+                try:
+                    self.overwrite_issue_p4_to_dt(issue, job, reason, 0)
+                except dt_interface.conflict:
+                    self.defer(issue, job)
+                else:
+                    self.record_issue_digest(issue)
             else:
                 # "Conflict resolution policy decided: no action."
                 self.log(807)
+                # The issue and job now differ, so the next change to
+                # the issue must be replicated even if it puts the
+                # issue back as it was.
+                self.forget_issue_digest(issue)
+
+    # defer(issue, job).  The issue changed in the defect tracker
+    # while we were replicating the job to it, so the defect tracker
+    # refused the update (see dt_interface.conflict).  Leave the job
+    # alone, and replicate the pair again in the next poll as if both
+    # had changed, so that the conflict resolution policy decides which
+    # change wins.
+
+    def defer(self, issue, job):
+        # "Deferring replication of job '%s' to issue '%s' to the next
+        # poll: %s"
+        self.log(941, (job['Job'], issue.readable_name(),
+                       sys.exc_info()[1]))
+        self.deferred[job['Job']] = issue.id()
+
+    # issue_digest(issue).  Return a digest (as a string of hex digits)
+    # of the replicated fields of the issue, together with the names of
+    # the fields and the replicator id, so that changing the field map
+    # changes the digests.
+    #
+    # After replicating an issue, replicate() records the issue's
+    # digest in the defect tracker (if the defect tracker supports it
+    # by providing the issue methods replicated_digest and
+    # set_replicated_digest).  When an issue changes only in the defect
+    # tracker, the job hasn't changed since then (or there would be an
+    # entry for it in the Perforce logger), and the issue's filespecs
+    # and fixes are written only by the replicator, from the job.  So
+    # if the issue's digest is still the recorded one, then the change
+    # was to fields that aren't replicated (or the issue was merely
+    # "touched") and there is nothing to replicate.  This saves
+    # fetching the job, its fixes, and translating all the fields.
+
+    def issue_digest(self, issue):
+        digest = md5(self.rid)
+        for dt_field, p4_field, trans in self.config.field_map:
+            value = issue[dt_field]
+            if isinstance(value, types.UnicodeType):
+                value = value.encode('utf8')
+            else:
+                value = str(value)
+            digest.update('\0%s\0%s\0%d\0%s'
+                          % (dt_field, p4_field, len(value), value))
+        return digest.hexdigest()
+
+    # issue_unchanged(issue).  Return true if the issue is replicated
+    # and its digest is the one recorded when it was last replicated.
+
+    def issue_unchanged(self, issue):
+        if not issue.rid() or not hasattr(issue, 'replicated_digest'):
+            return 0
+        digest = issue.replicated_digest()
+        return digest != None and digest == self.issue_digest(issue)
+
+    def record_issue_digest(self, issue):
+        if hasattr(issue, 'set_replicated_digest') and issue.rid():
+            issue.set_replicated_digest(self.issue_digest(issue))
+
+    def forget_issue_digest(self, issue):
+        if hasattr(issue, 'set_replicated_digest') and issue.rid():
+            issue.set_replicated_digest(None)
 
     # revert_issue_dt_to_p4(self, issue, job).  This is called when an
     # error has occurred in replicating from Perforce to the defect
@@ -1598,51 +2605,68 @@ class replicator:
 
     # replicate_issue_dt_to_p4(issue, old_job).  Replicate the given
     # issue from the defect tracker to Perforce.
+    #
+    # Each write to the job costs a Perforce command, and a logger
+    # entry that the next poll has to read and discard (see
+    # changed_entities).  So we collect all the changes to the job --
+    # the issue's fields, its filespecs, and the job status that p4 fix
+    # may have disturbed -- and write the job once, after the fixes.
+    # But if the job is new, it has to be created first, because p4 fix
+    # won't accept non-existent jobnames.  (I suppose I could create a
+    # dummy job to act as a placeholder here, but that's not easy at
+    # all -- you have to know quite a lot about the jobspec to be able
+    # to create a job.)  In that case the job may need a second write
+    # to restore its status after the fixes.
 
     def replicate_issue_dt_to_p4(self, issue, job, force = False):
         assert isinstance(issue, dt_interface.defect_tracker_issue)
         assert isinstance(job, types.DictType)
 
-        # Transform the issue into a job.  This has to be done first
-        # because the job might be new, and we won't be able to
-        # replicate fixes or filespecs until the job's been created
-        # (p4 fix won't accept non-existent jobnames).  I suppose I
-        # could create a dummy job to act as a placeholder here, but
-        # that's not easy at all -- you have to know quite a lot about
-        # the jobspec to be able to create a job.
+        # Transform the issue into a job.
         changes = self.translate_issue_dt_to_p4(issue, job)
         if changes:
             # "-- Changed fields: %s."
             self.log(812, changes)
-            self.update_job(job, changes, force=force)
         else:
             # "-- No issue fields were replicated."
             self.log(813)
+        changes.update(self.filespecs_changes_dt_to_p4(issue, job))
 
-        self.replicate_filespecs_dt_to_p4(issue, job)
-        self.replicate_fixes_dt_to_p4(issue, job, force)
+        # Apply the changes to our copy of the job now, so that
+        # replicate_fixes_dt_to_p4 sees the job status we're going to
+        # write.
+        for key, value in changes.items():
+            job[key] = value
+        if job['Job'] == 'new':
+            self.update_job(job, force=force)
+            changes = {}
 
-    # replicate_filespecs_dt_to_p4(issue, job).  Replicate filespecs
-    # from the defect tracker to Perforce.
+        changes.update(self.replicate_fixes_dt_to_p4(issue, job, force))
+        if changes:
+            self.update_job(job, changes, force=force)
+
+    # filespecs_changes_dt_to_p4(issue, job).  Return the changes to
+    # the job needed to replicate the issue's filespecs to Perforce.
 
-    def replicate_filespecs_dt_to_p4(self, issue, job):
+    def filespecs_changes_dt_to_p4(self, issue, job):
         if not self.feature['filespecs']:
-            return
+            return {}
         dt_filespecs = issue.filespecs()
         p4_filespecs = self.job_filespecs(job)
         if self.filespecs_differences(dt_filespecs, p4_filespecs):
             names = map(lambda f: f.name(), dt_filespecs)
-            self.update_job(job, { 'P4DTI-filespecs':
-                                   string.join(names,'\n') })
             # "-- Filespecs changed to '%s'."
             self.log(814, string.join(names))
+            return { 'P4DTI-filespecs': string.join(names,'\n') }
+        return {}
 
     # replicate_fixes_dt_to_p4(issue, job).  Replicate fixes from the
-    # defect tracker to Perforce.
+    # defect tracker to Perforce.  Return the changes that must be
+    # written to the job afterwards (to restore its status).
 
     def replicate_fixes_dt_to_p4(self, issue, job, force=False):
         if not self.feature['fixes']:
-            return
+            return {}
         p4_fixes = self.job_fixes(job)
         dt_fixes = issue.fixes()
         job_status = None
@@ -1682,15 +2706,16 @@ class replicator:
                 # This should't happen, since fixes_differences returns
                 # only a list of pairs which differ.
                 assert 0
+        if diffs:
+            self.forget_fixes(job)
 
         # It might be the case that the job status has been changed in
         # the course of creating a fix record.  Restore the correct
         # status if necessary.
         if (job_status and job_status
             != job.get(self.config.job_status_field, None)):
-            self.update_job(job, {
-                'Status': job[self.config.job_status_field] },
-                            force=force)
+            return { 'Status': job[self.config.job_status_field] }
+        return {}
 
     # replicate_issue_p4_to_dt(issue, job).  Replicate the given job
     # from Perforce to the defect tracker.
@@ -1768,6 +2793,9 @@ class replicator:
         p4_fixes = self.job_fixes(job)
         dt_fixes = issue.fixes()
         fix_diffs = self.fixes_differences(dt_fixes, p4_fixes)
+        # Fetch the changelists for the changed fixes all at once.
+        self.fetch_changelists(map(lambda d: d[0]['Change'],
+                                   filter(lambda d: d[0], fix_diffs)))
         for p4_fix, dt_fix in fix_diffs:
             if dt_fix and not p4_fix:
                 dt_fix.delete()
@@ -1780,16 +2808,17 @@ class replicator:
                  user) = self.translate_fix_p4_to_dt(p4_fix)
                 # make sure changelist is replicated
                 try:
-                    changelist = self.p4.run('change -o %s' %
-                                             change)[0]
+                    changelist = self.changelist(change)
                 except p4.error:
                     # The changelist might have been renumbered since we
                     # called job_fixes; see job000385.  If it has, then
-                    # try again.  But don't get stuck in an infinite
-                    # loop.
+                    # fetch the fixes again and try again.  But don't
+                    # get stuck in an infinite loop.
                     if failed_before:
                         raise
                     else:
+                        self.forget_fixes(job)
+                        self.job_cache.remove(string.lower(job['Job']))
                         self.replicate_fixes_p4_to_dt(issue, job,
                                                       failed_before = 1)
                         return
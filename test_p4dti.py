@@ -0,0 +1,320 @@
+#             Perforce Defect Tracking Integration Project
+#              <http://www.ravenbrook.com/project/p4dti/>
+#
+#                 TEST_P4DTI.PY -- UNIT TESTS FOR THE P4DTI
+#
+#
+# 1. INTRODUCTION
+#
+# This module contains unit tests for parts of the P4DTI that can be
+# tested without a Perforce server or a defect tracker.  Perforce is
+# replaced by a fake client (section 2), the replicator by a replicator
+# whose databases are simulated (section 4), and the Bugzilla database
+# by a list of records (section 5).
+#
+# Run the tests with "python test_p4dti.py" in the replicator
+# directory.
+#
+# The intended readership of this document is project developers.
+#
+# This document is not confidential.
+
+import bugzilla
+import marshal
+import os
+import lru
+import p4
+import re
+import replicator
+import shutil
+import signal
+import sys
+import tempfile
+import unittest
+
+
+# 2. FAKE PERFORCE CLIENT
+#
+# fake_p4_script is a Python program that behaves like "p4 -G" for the
+# commands the tests use.  Like a real Perforce client, it reads all
+# its standard input before writing any output.  With "-x -" it writes
+# one form for each line of input; with input, it saves the job it was
+# given; otherwise it writes the job named by its last argument.
+
+fake_p4_script = '''
+import marshal, sys
+args = sys.argv[1:]
+data = sys.stdin.read()
+if '-x' in args:
+    for line in data.split('\\n'):
+        if line:
+            marshal.dump({'Job': line, 'Description': 'x' * 1000},
+                         sys.stdout)
+elif data:
+    job = marshal.loads(data)
+    marshal.dump({'code': 'info', 'data': 'Job %s saved.' % job['Job']},
+                 sys.stdout)
+else:
+    marshal.dump({'Job': args[-1]}, sys.stdout)
+'''
+
+class fake_p4(p4.p4):
+    def __init__(self, client_executable):
+        # Don't check the client and server changelevels.
+        self.client_executable = client_executable
+
+
+# 3. TESTS OF THE PERFORCE INTERFACE
+
+class p4_run(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, 'p4')
+        f = open(path, 'w')
+        f.write('#!%s\n%s' % (sys.executable, fake_p4_script))
+        f.close()
+        os.chmod(path, 0755)
+        self.p4 = fake_p4(path)
+        # A deadlocked command makes the test fail rather than hang.
+        if hasattr(signal, 'alarm'):
+            signal.alarm(60)
+
+    def tearDown(self):
+        if hasattr(signal, 'alarm'):
+            signal.alarm(0)
+        shutil.rmtree(self.directory)
+
+    def test_output(self):
+        self.assertEqual(self.p4.run('job -o job1'), [{'Job': 'job1'}])
+
+    def test_input(self):
+        # The client reads all its input before it answers.
+        self.assertEqual(self.p4.run('job -i', {'Job': 'job1'}),
+                         [{'code': 'info', 'data': 'Job job1 saved.'}])
+
+    def test_batch(self):
+        # Enough arguments and output to fill the pipe buffers.
+        jobnames = map(lambda i: 'job%06d' % i, range(10000))
+        results = self.p4.run_batch('job -o', jobnames)
+        self.assertEqual(len(results), len(jobnames))
+        for jobname, (records, message) in map(None, jobnames, results):
+            self.assertEqual(message, None)
+            self.assertEqual(records[0]['Job'], jobname)
+
+
+# 4. TESTS OF THE REPLICATOR
+#
+# simulated_p4 stands in for the p4 module's Perforce interface in the
+# replicator.  Its fixes and changelists are set by each test, and it
+# records the commands it runs.
+
+class simulated_p4:
+    def __init__(self):
+        self.fixes = {}
+        self.changelists = {}
+        self.commands = []
+
+    def run(self, arguments, input = None):
+        self.commands.append(arguments)
+        words = arguments.split()
+        if words[:2] == ['fixes', '-j']:
+            return self.fixes.get(words[2], [])
+        elif words[:2] == ['change', '-o']:
+            if not self.changelists.has_key(int(words[2])):
+                raise p4.error, "Change %s unknown." % words[2]
+            return [self.changelists[int(words[2])]]
+        raise p4.error, "Unexpected command %s." % arguments
+
+    def run_batch(self, command, arguments):
+        results = []
+        for argument in arguments:
+            try:
+                results.append((self.run('%s %s' % (command, argument)),
+                                None))
+            except p4.error, message:
+                results.append(([], message))
+        return results
+
+class identity_translator:
+    def translate_1_to_0(self, value, dt, dt_p4):
+        return value
+
+class simulated_config:
+    date_translator = identity_translator()
+    user_translator = identity_translator()
+
+class simulated_issue:
+    def __init__(self):
+        self.added = []
+
+    def fixes(self):
+        return []
+
+    def add_fix(self, change, client, date, status, user):
+        self.added.append(change)
+
+class simulated_replicator(replicator.replicator):
+    def __init__(self):
+        self.p4 = simulated_p4()
+        self.config = simulated_config()
+        self.dt = self.dt_p4 = None
+        self.feature = {'fixes': 1}
+        self.fixes_index = {}
+        self.changelist_cache = {}
+        self.job_cache = lru.lru_cache(10)
+
+    def log(self, msg, args = ()):
+        pass
+
+    def replicate_changelist_p4_to_dt(self, changelist):
+        pass
+
+def fix(change):
+    return {'Job': 'job1', 'Change': str(change), 'Client': 'client',
+            'Date': '1', 'Status': 'closed', 'User': 'user'}
+
+def changelist(change):
+    return {'Change': str(change), 'Client': 'client', 'Date': '1',
+            'Description': 'Fixed.\n', 'Status': 'submitted',
+            'User': 'user'}
+
+# Python 2.6 and later can't raise string exceptions like p4.error, so
+# the tests of the replicator replace it with a class.
+
+class p4_error(Exception):
+    pass
+
+class replicate_fixes(unittest.TestCase):
+    def setUp(self):
+        self.error = p4.error
+        p4.error = p4_error
+
+    def tearDown(self):
+        p4.error = self.error
+
+    # A pending changelist that is renumbered when it is submitted,
+    # after we've fetched the job's fixes, is found by fetching the
+    # fixes again (job000385).
+
+    def test_renumbered_change(self):
+        r = simulated_replicator()
+        job = {'Job': 'job1'}
+        r.cache_job(job)
+        r.p4.fixes['job1'] = [fix(5)]
+        r.index_fixes = lambda jobnames: None
+        r.job_fixes(job)
+        r.p4.fixes['job1'] = [fix(6)]
+        r.p4.changelists[6] = changelist(6)
+        issue = simulated_issue()
+        r.replicate_fixes_p4_to_dt(issue, job)
+        self.assertEqual(issue.added, [6])
+
+
+# 5. TESTS OF THE BUGZILLA INTERFACE
+#
+# simulated_bugzilla answers the long description queries from its
+# list of longdescs records, and records the rows it's asked to insert.
+
+class simulated_bugzilla(bugzilla.bugzilla):
+    def __init__(self):
+        self.longdesc_cache = lru.lru_cache(self.longdesc_cache_size)
+        self.records = []
+        self.queries = []
+        self.inserted = []
+
+    def quote_string(self, s):
+        return "'%s'" % s
+
+    def fetch_rows_as_list_of_dictionaries(self, select, description):
+        self.queries.append(select)
+        since = {}
+        for bug_id, when in re.findall(r"bug_id = (\d+) and "
+                                       r"longdescs.bug_when >= '([^']*)'",
+                                       select):
+            since[int(bug_id)] = when
+        for ids in re.findall(r"bug_id in \(([0-9,]*)\)", select):
+            for bug_id in ids.split(','):
+                since[int(bug_id)] = ''
+        return filter(lambda r, since=since:
+                      (since.has_key(r['bug_id'])
+                       and r['bug_when'] >= since[r['bug_id']]),
+                      self.records)
+
+    def insert_row(self, table, dict):
+        self.inserted.append((table, dict))
+
+    def comment(self, when, text):
+        self.records.append({'bug_id': 1, 'login_name': 'user@example.com',
+                             'realname': 'User', 'bug_when': when,
+                             'thetext': text})
+
+class longdescs(unittest.TestCase):
+    # Fetching a long description again fetches only the comments
+    # since the last one we have, and appends them.
+
+    def test_append(self):
+        bz = simulated_bugzilla()
+        bz.comment('2001-01-01 00:00:00', 'First.')
+        bz.comment('2001-01-02 00:00:00', 'Second.')
+        first = bz.bug_get_longdesc({'bug_id': 1})
+        bz.comment('2001-01-02 12:00:00', 'Third.')
+        bz.comment('2001-01-03 00:00:00', 'Fourth.')
+        second = bz.bug_get_longdesc({'bug_id': 1})
+        self.assert_("bug_when >= '2001-01-02 00:00:00'" in bz.queries[-1])
+        bz.longdesc_cache.remove(1)
+        self.assertEqual(second, bz.bug_get_longdesc({'bug_id': 1}))
+        footer = "\n\n------- Append additional comments below -------"
+        self.assertEqual(second[:len(first) - len(footer)],
+                         first[:-len(footer)])
+        self.assert_(second.endswith("Fourth." + footer))
+
+    # A comment appended to the job's Description becomes one new
+    # longdescs record.
+
+    def test_update(self):
+        bz = simulated_bugzilla()
+        bz.comment('2001-01-01 00:00:00', 'First.')
+        old = bz.bug_get_longdesc({'bug_id': 1})
+        bz.update_longdesc(1, 2, old, old + "\nNew comment.\n")
+        self.assertEqual(len(bz.inserted), 1)
+        table, row = bz.inserted[0]
+        self.assertEqual(table, 'longdescs')
+        self.assertEqual(row['thetext'], 'New comment.')
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# A. COPYRIGHT AND LICENSE
+#
+# This file is copyright (c) 2001 Perforce Software, Inc.  All rights
+# reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1.  Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#
+# 2.  Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in
+#     the documentation and/or other materials provided with the
+#     distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDERS AND CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+# OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+# USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+# DAMAGE.
+#
+#
+# $Id$
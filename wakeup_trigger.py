@@ -0,0 +1,117 @@
+#             Perforce Defect Tracking Integration Project
+#              <http://www.ravenbrook.com/project/p4dti/>
+#
+#      WAKEUP_TRIGGER.PY -- TELL THE REPLICATOR THAT SOMETHING CHANGED
+#
+#
+# 1. INTRODUCTION
+#
+# This script sends a wakeup message to the replicator, so that it
+# polls straight away instead of waiting for the end of its poll
+# period.  It's meant to be run by a Perforce trigger when a changelist
+# is submitted or a job is saved.
+#
+# The replicator only listens for wakeup messages if the
+# 'wakeup_socket' configuration parameter is set.
+#
+# This document is intended for administrators of the Perforce Defect
+# Tracking Integration (P4DTI).
+#
+# This document is not confidential.
+#
+#
+# 2. USING THE TRIGGER
+#
+# Set the 'wakeup_socket' parameter in the P4DTI configuration to the
+# name of a socket, for example "/var/run/p4dti/wakeup".  Make sure
+# the directory exists.  The replicator creates the socket with the
+# permissions given by the 'wakeup_socket_mode' parameter (by default,
+# only the replicator's user and group can write to it), so make sure
+# the user the Perforce server runs as can write to it.
+#
+# Be sure to read the "Triggers" section in chapter 6 of the "Perforce
+# System Administrator's Guide" [Perforce 2000-10-11].  Then use the "p4
+# triggers" command to insert lines like:
+#
+#         p4dti-change change-commit //... "/usr/local/bin/python /whatever-path-to/wakeup_trigger.py /var/run/p4dti/wakeup"
+#         p4dti-job form-commit job "/usr/local/bin/python /whatever-path-to/wakeup_trigger.py /var/run/p4dti/wakeup"
+#
+# (The "form-commit" trigger type needs Perforce 2005.1 or later; with
+# an older server, only changelist submissions will wake the
+# replicator.)
+#
+# Bugzilla doesn't need this script: to wake the replicator when a bug
+# changes in Bugzilla, set the 'bugzilla_change_queue' parameter.  The
+# replicator then installs MySQL triggers that record each change to a
+# bug, and checks for them every couple of seconds between polls.
+#
+# The trigger never fails: if the replicator isn't running, or isn't
+# listening, the message is discarded and the change will be
+# replicated at the next poll as usual.
+
+import socket
+import sys
+
+def wakeup():
+    usage = "python %s socket" % sys.argv[0]
+
+    if len(sys.argv) != 2:
+        # Print the usage, but don't fail: a failing trigger would
+        # stop the user's command.
+        print usage
+        sys.exit(0)
+
+    try:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        s.setblocking(0)
+        s.sendto('wakeup', sys.argv[1])
+        s.close()
+    except (AttributeError, socket.error):
+        # Never prevent the change just because the replicator isn't
+        # listening.
+        pass
+    sys.exit(0)
+
+if __name__ == '__main__':
+    wakeup()
+
+
+# A. REFERENCES
+#
+# [Perforce 2000-10-11] "Perforce 2000.1 System Administrator's Guide";
+# Perforce Software; 2000-10-11;
+# <http://www.perforce.com/perforce/doc.001/manuals/p4sag/>.
+#
+#
+# B. COPYRIGHT AND LICENSE
+#
+# This file is copyright (c) 2001 Perforce Software, Inc.  All rights
+# reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1.  Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#
+# 2.  Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in
+#     the documentation and/or other materials provided with the
+#     distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDERS AND CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+# OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+# TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+# USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+# DAMAGE.
+#
+#
+# $Id: //info.ravenbrook.com/project/p4dti/version/2.4/code/replicator/wakeup_trigger.py#1 $